@@ -1,81 +1,362 @@
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 from datetime import datetime, timedelta
 import time
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from difflib import SequenceMatcher
+import asyncio
+import heapq
+import itertools
 import logging
+import sys
 
 logger = logging.getLogger(__name__)
 
+# How many distinct keys the index collects per verified candidate before it stops widening.
+CANDIDATE_POOL_FACTOR = 8
+
+# Cost per token of each LLM tier, matching LLMCostOptimizer.cost_per_token.
+TIER_COST_PER_TOKEN = {
+    'fast': 0.0001,
+    'balanced': 0.0005,
+    'powerful': 0.001
+}
+
+EVICTION_POLICIES = ('lru', 'gdsf')
+
+def estimate_size(value: Any) -> int:
+    """Approximate the memory footprint of a cached value in bytes."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+def estimate_regeneration_cost(value: Any) -> float:
+    """Estimate what it would cost to regenerate a cached LLMManager.query result.
+
+    Uses the 'token_usage' and 'tier' fields of the result. Values without token
+    usage are treated as costing one unit, which makes GDSF purely size and
+    frequency aware for them.
+    """
+    if isinstance(value, dict):
+        token_usage = value.get('token_usage')
+        if isinstance(token_usage, dict):
+            tokens = token_usage.get('total') or token_usage.get('input', 0) + token_usage.get('output', 0)
+            if tokens:
+                return tokens * TIER_COST_PER_TOKEN.get(value.get('tier'), TIER_COST_PER_TOKEN['balanced'])
+    return 1.0
+
+class TrigramIndex:
+    """Inverted index from character trigrams to cache keys.
+
+    Used by AdvancedCache to narrow partial-match lookups down to the keys that share
+    character trigrams with the requested key instead of scanning every cached key.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Set[str]] = defaultdict(set)
+        self.key_lengths: Dict[str, int] = {}
+
+    @staticmethod
+    def trigrams(text: str) -> Set[str]:
+        # Pad the text so that short keys and key boundaries still produce trigrams.
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, key: str) -> None:
+        if key in self.key_lengths:
+            return
+        self.key_lengths[key] = len(key)
+        for gram in self.trigrams(key):
+            self.postings[gram].add(key)
+
+    def remove(self, key: str) -> None:
+        if self.key_lengths.pop(key, None) is None:
+            return
+        for gram in self.trigrams(key):
+            bucket = self.postings.get(gram)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.postings[gram]
+
+    def clear(self) -> None:
+        self.postings.clear()
+        self.key_lengths.clear()
+
+    def candidates(self, key: str, similarity_threshold: float, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        """Return (candidate_key, shared_trigrams) pairs, most shared trigrams first.
+
+        Posting lists are visited rarest first. Once ``limit`` distinct candidates have been
+        collected, the remaining (more common) trigrams only add to the counts of keys
+        already collected, so lookups do not degrade into a scan of every key that shares
+        a common trigram. Keys whose length alone rules out a ratio of at least
+        similarity_threshold are dropped, since SequenceMatcher.ratio() never exceeds
+        2 * min(a, b) / (a + b).
+        """
+        shared: Dict[str, int] = defaultdict(int)
+        buckets = sorted((self.postings[gram] for gram in self.trigrams(key) if gram in self.postings), key=len)
+        for bucket in buckets:
+            if limit is None or len(shared) < limit:
+                for candidate in bucket:
+                    shared[candidate] += 1
+            else:
+                for candidate in shared:
+                    if candidate in bucket:
+                        shared[candidate] += 1
+
+        key_length = len(key)
+        result = []
+        for candidate, count in shared.items():
+            candidate_length = self.key_lengths[candidate]
+            total_length = key_length + candidate_length
+            if total_length and 2 * min(key_length, candidate_length) / total_length < similarity_threshold:
+                continue
+            result.append((candidate, count))
+        result.sort(key=lambda item: item[1], reverse=True)
+        return result
+
 class AdvancedCache:
-    def __init__(self, default_expiration: int = 3600, max_size: Optional[int] = None, similarity_threshold: float = 0.8):
+    def __init__(self, default_expiration: int = 3600, max_size: Optional[int] = None, similarity_threshold: float = 0.8,
+                 use_index: bool = True, max_candidates: Optional[int] = None, max_bytes: Optional[int] = None,
+                 eviction_policy: str = 'lru', cost_function: Callable[[Any], float] = estimate_regeneration_cost):
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
         self.cache: OrderedDict[str, Dict[str, Any]] = OrderedDict()
         self.default_expiration = default_expiration
         self.max_size = max_size
         self.similarity_threshold = similarity_threshold
-        logger.info(f"AdvancedCache initialized with default_expiration={default_expiration}, max_size={max_size}, similarity_threshold={similarity_threshold}")
+        self.use_index = use_index
+        # None verifies every key that shares a trigram and passes the length bound, so partial
+        # matches agree with the linear scan; a number caps the keys verified per lookup at the
+        # cost of sometimes missing the best match among many similar keys.
+        self.max_candidates = max_candidates
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy
+        self.cost_function = cost_function
+        self.current_bytes = 0
+        # GDSF state: the inflation value L and a lazily invalidated min-heap of
+        # (priority, recency, key).
+        self._inflation = 0.0
+        self._priority_heap: List[Tuple[float, int, str]] = []
+        self.index = TrigramIndex()
+        # Monotonic counter mirroring OrderedDict order so index lookups can break ties
+        # between equally similar keys the same way a front-to-back scan would.
+        self._recency = itertools.count()
+        # Min-heap of (expiration, key). Entries are invalidated lazily: a popped entry only
+        # evicts its key if the cached item still carries that exact expiration.
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._eviction_task: Optional[asyncio.Task] = None
+        logger.info(f"AdvancedCache initialized with default_expiration={default_expiration}, max_size={max_size}, max_bytes={max_bytes}, eviction_policy={eviction_policy}, similarity_threshold={similarity_threshold}, use_index={use_index}")
 
     def set(self, key: str, value: Any, expiration: Optional[int] = None) -> None:
-        if self.max_size and len(self.cache) >= self.max_size:
-            removed_key, _ = self.cache.popitem(last=False)
-            logger.debug(f"Cache full, removed oldest item with key: {removed_key}")
-        
+        if key in self.cache:
+            self._delete(key)
+        size = estimate_size(value) if self.max_bytes or self.eviction_policy == 'gdsf' else 0
+        if self.max_bytes and size > self.max_bytes:
+            logger.debug(f"Value for key '{key}' ({size} bytes) exceeds max_bytes={self.max_bytes}, not caching")
+            return
+
+        if self._over_capacity(size):
+            # Prefer reclaiming an expired slot over evicting a live entry.
+            self.evict_expired(max_items=1)
+        while self.cache and self._over_capacity(size):
+            removed_key = self._evict_one()
+            logger.debug(f"Cache full, evicted item with key: {removed_key}")
+
         expiration_time = time.time() + (expiration or self.default_expiration)
+        recency = next(self._recency)
         self.cache[key] = {
             'value': value,
-            'expiration': expiration_time
+            'expiration': expiration_time,
+            'recency': recency,
+            'size': size,
+            'frequency': 1
         }
         self.cache.move_to_end(key)
+        self.current_bytes += size
+        self.index.add(key)
+        heapq.heappush(self._expiry_heap, (expiration_time, key))
+        if self.eviction_policy == 'gdsf':
+            item = self.cache[key]
+            item['cost'] = self.cost_function(value)
+            self._update_priority(key, item)
+        self._compact_heaps()
         logger.debug(f"Set key '{key}' with expiration {expiration_time}")
 
     def get(self, key: str, partial_match: bool = False) -> Optional[Tuple[Any, float]]:
         logger.debug(f"Attempting to get key '{key}' with partial_match={partial_match}")
-        logger.debug(f"Current cache state: {self.cache}")
-        
+
         if key in self.cache:
             item = self.cache[key]
             if time.time() < item['expiration']:
-                self.cache.move_to_end(key)
+                self._touch(key)
                 logger.debug(f"Exact match found for key '{key}'")
                 return item['value'], 1.0
             else:
-                del self.cache[key]
+                self._delete(key)
                 logger.debug(f"Key '{key}' found but expired, removed from cache")
-        
+
         if partial_match:
-            best_match = None
-            best_ratio = 0
-            for cache_key in self.cache:
-                ratio = SequenceMatcher(None, key, cache_key).ratio()
-                logger.debug(f"Partial match check: key='{key}', cache_key='{cache_key}', ratio={ratio}, threshold={self.similarity_threshold}")
-                if ratio > best_ratio and ratio >= self.similarity_threshold:
-                    best_match = cache_key
-                    best_ratio = ratio
-            
+            if self.use_index:
+                best_match, best_ratio = self._indexed_best_match(key)
+            else:
+                best_match, best_ratio = self._scan_best_match(key)
+
             if best_match:
                 item = self.cache[best_match]
                 if time.time() < item['expiration']:
-                    self.cache.move_to_end(best_match)
+                    self._touch(best_match)
                     logger.debug(f"Partial match found: requested key='{key}', matched key='{best_match}', ratio={best_ratio}")
                     return item['value'], best_ratio
                 else:
-                    del self.cache[best_match]
+                    self._delete(best_match)
                     logger.debug(f"Partial match found for key '{key}', but matched key '{best_match}' was expired")
             else:
                 logger.debug(f"No partial match found above threshold {self.similarity_threshold}")
-        
+
         logger.debug(f"No match found for key '{key}'")
         return None
 
+    def _scan_best_match(self, key: str) -> Tuple[Optional[str], float]:
+        """Compare the key against every cached key (linear scan)."""
+        return self._best_match(key, self.cache)
+
+    def _indexed_best_match(self, key: str) -> Tuple[Optional[str], float]:
+        """Compare the key only against cached keys sharing trigrams with it."""
+        if self.max_candidates is None:
+            candidates = self.index.candidates(key, self.similarity_threshold)
+        else:
+            limit = self.max_candidates * CANDIDATE_POOL_FACTOR
+            candidates = self.index.candidates(key, self.similarity_threshold, limit)[:self.max_candidates]
+        # Verify in cache order so ties resolve exactly as in the linear scan.
+        ordered = sorted((candidate for candidate, _ in candidates), key=lambda k: self.cache[k]['recency'])
+        return self._best_match(key, ordered)
+
+    def _best_match(self, key: str, cache_keys: Iterable[str]) -> Tuple[Optional[str], float]:
+        best_match = None
+        best_ratio = 0
+        matcher = SequenceMatcher(None, key)
+        for cache_key in cache_keys:
+            matcher.set_seq2(cache_key)
+            if matcher.real_quick_ratio() < max(best_ratio, self.similarity_threshold):
+                continue
+            ratio = matcher.ratio()
+            if ratio > best_ratio and ratio >= self.similarity_threshold:
+                best_match = cache_key
+                best_ratio = ratio
+        return best_match, best_ratio
+
+    def _touch(self, key: str) -> None:
+        self.cache.move_to_end(key)
+        item = self.cache[key]
+        item['recency'] = next(self._recency)
+        item['frequency'] += 1
+        if self.eviction_policy == 'gdsf':
+            self._update_priority(key, item)
+            self._compact_heaps()
+
+    def _delete(self, key: str) -> None:
+        item = self.cache.pop(key)
+        self.current_bytes -= item['size']
+        self.index.remove(key)
+
+    def _over_capacity(self, incoming_size: int) -> bool:
+        if self.max_size and len(self.cache) >= self.max_size:
+            return True
+        return bool(self.max_bytes) and self.current_bytes + incoming_size > self.max_bytes
+
+    def _update_priority(self, key: str, item: Dict[str, Any]) -> None:
+        # GDSF: H = L + frequency * cost / size. L rises to the priority of each evicted
+        # entry, so entries that stop being hit age out even if they were once popular.
+        item['priority'] = self._inflation + item['frequency'] * item['cost'] / max(item['size'], 1)
+        heapq.heappush(self._priority_heap, (item['priority'], item['recency'], key))
+
+    def _evict_one(self) -> str:
+        if self.eviction_policy == 'gdsf':
+            while self._priority_heap:
+                priority, recency, key = heapq.heappop(self._priority_heap)
+                item = self.cache.get(key)
+                if item is not None and item['recency'] == recency:
+                    self._inflation = priority
+                    self._delete(key)
+                    return key
+        key = next(iter(self.cache))
+        self._delete(key)
+        return key
+
     def remove_expired(self) -> None:
+        removed = self.evict_expired()
+        logger.debug(f"Removed {removed} expired keys")
+
+    def evict_expired(self, max_items: Optional[int] = None) -> int:
+        """Evict expired entries in expiration order.
+
+        Args:
+            max_items: Upper bound on the number of entries evicted in this call. None
+                evicts every expired entry.
+
+        Returns:
+            int: The number of entries evicted.
+        """
         current_time = time.time()
-        expired_keys = [key for key, item in self.cache.items() if current_time >= item['expiration']]
-        for key in expired_keys:
-            del self.cache[key]
-        logger.debug(f"Removed {len(expired_keys)} expired keys")
+        removed = 0
+        while self._expiry_heap and (max_items is None or removed < max_items):
+            expiration, key = self._expiry_heap[0]
+            if expiration > current_time:
+                break
+            heapq.heappop(self._expiry_heap)
+            item = self.cache.get(key)
+            if item is not None and item['expiration'] == expiration:
+                self._delete(key)
+                removed += 1
+        return removed
+
+    def _compact_heaps(self) -> None:
+        # Overwritten, touched and evicted keys leave stale heap entries behind; rebuild once
+        # they outnumber live entries so the heaps stay proportional to the cache.
+        if len(self._expiry_heap) > 2 * len(self.cache) + 64:
+            self._expiry_heap = [(item['expiration'], key) for key, item in self.cache.items()]
+            heapq.heapify(self._expiry_heap)
+        if len(self._priority_heap) > 2 * len(self.cache) + 64:
+            self._priority_heap = [(item['priority'], item['recency'], key)
+                                   for key, item in self.cache.items() if 'priority' in item]
+            heapq.heapify(self._priority_heap)
+
+    def start_background_eviction(self, interval: float = 1.0, batch_size: int = 100) -> asyncio.Task:
+        """Start an asyncio task that evicts up to batch_size expired entries every interval seconds."""
+        if self._eviction_task is None or self._eviction_task.done():
+            self._eviction_task = asyncio.get_running_loop().create_task(
+                self._background_eviction(interval, batch_size))
+            logger.info(f"Background eviction started with interval={interval}, batch_size={batch_size}")
+        return self._eviction_task
+
+    async def stop_background_eviction(self) -> None:
+        if self._eviction_task is None:
+            return
+        self._eviction_task.cancel()
+        try:
+            await self._eviction_task
+        except asyncio.CancelledError:
+            pass
+        self._eviction_task = None
+        logger.info("Background eviction stopped")
+
+    async def _background_eviction(self, interval: float, batch_size: int) -> None:
+        while True:
+            removed = self.evict_expired(max_items=batch_size)
+            if removed:
+                logger.debug(f"Background eviction removed {removed} expired keys")
+            await asyncio.sleep(interval)
 
     def clear(self) -> None:
         self.cache.clear()
+        self.index.clear()
+        self._expiry_heap.clear()
+        self._priority_heap.clear()
+        self.current_bytes = 0
+        self._inflation = 0.0
         logger.debug("Cache cleared")
 
     def size(self) -> int:
@@ -86,6 +367,10 @@ class AdvancedCache:
             'cache_contents': {k: v for k, v in self.cache.items()},
             'size': self.size(),
             'max_size': self.max_size,
+            'max_bytes': self.max_bytes,
+            'current_bytes': self.current_bytes,
+            'eviction_policy': self.eviction_policy,
             'default_expiration': self.default_expiration,
-            'similarity_threshold': self.similarity_threshold
+            'similarity_threshold': self.similarity_threshold,
+            'indexed_keys': len(self.index.key_lengths)
         }
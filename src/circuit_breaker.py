@@ -0,0 +1,146 @@
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a rolling window of request outcomes.
+
+    While closed, outcomes from the last `window` seconds are kept. Once at least
+    `min_requests` of them are in the window and the share of failures reaches `error_rate`,
+    the circuit opens and requests are refused for `open_duration` seconds. It then turns
+    half-open and lets up to `half_open_max_calls` probes through. A successful probe closes
+    the circuit with an empty window, and a failed one opens it again.
+    """
+
+    def __init__(self, window: float = 60.0, min_requests: int = 5, error_rate: float = 0.5,
+                 open_duration: float = 30.0, half_open_max_calls: int = 1):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+        self._state = CLOSED
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - self.window
+        while self._outcomes and self._outcomes[0][0] <= cutoff:
+            _, failed = self._outcomes.popleft()
+            self._failures -= failed
+
+    def state(self, now: Optional[float] = None) -> str:
+        now = time.monotonic() if now is None else now
+        if self._state == OPEN and now - self._opened_at >= self.open_duration:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def allow(self, now: Optional[float] = None) -> bool:
+        """Whether a request may be sent now. An admitted request must be followed by
+        record_success(), record_failure() or release()."""
+        state = self.state(now)
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._probes < self.half_open_max_calls:
+            self._probes += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        if self._state == HALF_OPEN:
+            self._state = CLOSED
+            self._outcomes.clear()
+            self._failures = 0
+            return
+        self._outcomes.append((now, False))
+        self._expire(now)
+
+    def record_failure(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        if self._state == HALF_OPEN:
+            self._open(now)
+            return
+        self._outcomes.append((now, True))
+        self._failures += 1
+        self._expire(now)
+        if len(self._outcomes) >= self.min_requests and self._failures >= self.error_rate * len(self._outcomes):
+            self._open(now)
+
+    def release(self) -> None:
+        """Give back an admitted request that ended without an outcome, e.g. by cancellation."""
+        if self._state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def _open(self, now: float) -> None:
+        self._state = OPEN
+        self._opened_at = now
+        self.times_opened += 1
+
+    def get_stats(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        return {
+            'state': self.state(now),
+            'requests': len(self._outcomes),
+            'failures': self._failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected
+        }
+
+class CircuitBreakers:
+    """One CircuitBreaker per model, created on first use with shared settings."""
+
+    def __init__(self, **settings: Any):
+        self.logger = logging.getLogger(__name__)
+        self.settings = settings
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'CircuitBreakers':
+        """Build from the `circuit_breaker` section of llm_config.yaml."""
+        keys = ('window', 'min_requests', 'error_rate', 'open_duration', 'half_open_max_calls')
+        return cls(**{key: config[key] for key in keys if key in config})
+
+    def get(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(**self.settings)
+        return breaker
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: breaker.get_stats() for model, breaker in self._breakers.items()}
+
+class LatencyTracker:
+    """Recent response latencies per model, for percentile estimates."""
+
+    def __init__(self, max_samples: int = 200, min_samples: int = 20):
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, model: str, seconds: float) -> None:
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.max_samples)
+        samples.append(seconds)
+
+    def percentile(self, model: str, fraction: float) -> Optional[float]:
+        """The `fraction` percentile of the model's recent latencies, or None until
+        `min_samples` have been recorded."""
+        samples = self._samples.get(model)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
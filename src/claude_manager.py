@@ -1,15 +1,20 @@
 import logging
 import json
 import asyncio
+import contextlib
 import time
-from typing import Dict, List, Any
+from typing import Any, AsyncContextManager, AsyncIterator, Dict, List, Optional, Tuple
 from unittest.mock import MagicMock
 from anthropic import AsyncAnthropic, NotFoundError, APIError, APIConnectionError, APIStatusError, RateLimitError
-from .exceptions import RateLimitError as CustomRateLimitError
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, RetryError
-from .rate_limiter import RateLimiter
+from .exceptions import RateLimitError as CustomRateLimitError, CircuitOpenError
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, retry_if_not_exception_type, RetryError
+from .rate_limiter import RateLimiter, TokenBudgetLimiter
+from .circuit_breaker import CircuitBreakers, LatencyTracker
+from .concurrency_limiter import IGNORE, OVERLOAD, SUCCESS, ConcurrencyLimiters
+from .request_scheduler import RequestScheduler
 from .token_tracker import TokenTracker
 from .token_optimizer import TokenOptimizer
+from .tokenizer import get_token_counter
 
 logging.getLogger(__name__).info(f"Imported modules in {__name__}")
 
@@ -17,8 +22,14 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 logger.setLevel(logging.DEBUG)
 
+# Tiers from most to least expensive; a hedged request goes to the next tier's model.
+HEDGE_TIER_ORDER = ('powerful', 'balanced', 'fast')
+
 class ClaudeManager:
-    def __init__(self, client=None, requests_per_minute: int = 1000, requests_per_hour: int = 10000):
+    def __init__(self, client=None, requests_per_minute: int = 1000, requests_per_hour: int = 10000,
+                 tiers: Optional[Dict[str, Dict[str, Any]]] = None, rate_limiter: Optional[RateLimiter] = None,
+                 circuit_breakers: Optional[CircuitBreakers] = None, hedging: Optional[Dict[str, Any]] = None,
+                 concurrency: Optional[ConcurrencyLimiters] = None, scheduler: Optional[RequestScheduler] = None):
         self.logger = logging.getLogger(__name__)
         self.logger.info("Initializing ClaudeManager")
         self.client = client or self.create_client()
@@ -33,8 +44,25 @@ class ClaudeManager:
         self.logger.debug("File handler added for persistent logging")
         
         self.max_test_tokens = 1000
-        self.rate_limiter = RateLimiter(requests_per_minute, requests_per_hour)
-        self.logger.debug(f"RateLimiter initialized with {requests_per_minute} rpm and {requests_per_hour} rph")
+        self.rate_limiter = rate_limiter or RateLimiter(requests_per_minute, requests_per_hour)
+        self.logger.debug(f"RateLimiter initialized with {self.rate_limiter.requests_per_minute} rpm and {self.rate_limiter.requests_per_hour} rph")
+        self.token_budget = TokenBudgetLimiter.from_tiers(tiers or {})
+        self.prompt_cache_usage = {'input_tokens': 0, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
+        self.circuit_breakers = circuit_breakers or CircuitBreakers()
+        # Per-model cap on requests in flight, adapted to observed latency and overload errors.
+        self.concurrency = concurrency or ConcurrencyLimiters()
+        # Orders sends across priority classes (see LLMManager); held only while a request is
+        # out, never across rate limit or budget waits or retry backoff.
+        self.scheduler = scheduler
+        # Hedging (off by default): once a request has run longer than the model's recent
+        # latency percentile, a duplicate goes to the next cheaper tier and the first answer wins.
+        hedging = hedging or {}
+        self.hedging_enabled = hedging.get('enabled', False)
+        self.hedge_percentile = hedging.get('percentile', 0.95)
+        self.latencies = LatencyTracker(min_samples=hedging.get('min_samples', 20))
+        tier_models = [tiers[tier]['model'] for tier in HEDGE_TIER_ORDER if tier in (tiers or {}) and 'model' in tiers[tier]]
+        self.hedge_models = dict(zip(tier_models, tier_models[1:]))
+        self.hedge_stats = {'sent': 0, 'won': 0}
         self.token_tracker = TokenTracker()
         self.token_optimizer = TokenOptimizer(self.token_tracker)
         self.max_context_length = 200000  # Updated to 200k tokens
@@ -143,22 +171,37 @@ class ClaudeManager:
     @retry(
         stop=stop_after_attempt(3),
         wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception_type((APIError, APIConnectionError, TimeoutError)),
+        # Circuit-open and timed-out requests already waited or failed fast on purpose;
+        # retrying them would only add the backoff on top.
+        retry=retry_if_exception_type((APIError, APIConnectionError)) & retry_if_not_exception_type((CircuitOpenError, TimeoutError)),
         reraise=True
     )
-    async def generate_response(self, prompt, model=None):
+    async def generate_response(self, prompt, model=None, system: Optional[List[Dict[str, Any]]] = None,
+                                max_tokens: int = 4096, priority: int = 0, priority_class: Optional[str] = None,
+                                deadline: Optional[float] = None):
+        """Generate a response to `prompt`. With `system`, the request is sent through the
+        Messages API with those system blocks, whose cache_control markers let the API serve
+        an unchanged prefix from its prompt cache. When the model's concurrency limit is
+        reached, requests with a lower `priority` value are sent first. With a scheduler, the
+        send waits for a slot in `priority_class`, for at most `deadline` seconds from now.
+
+        Raises:
+            CircuitOpenError: If the model's circuit breaker is open, or this request's failure
+                opened it.
+        """
         self.logger.debug(f"Entering generate_response with prompt: {prompt[:50]}... and model: {model}")
         self.logger.debug(f"Prompt length: {len(prompt)}")
         start_time = time.time()
+        expires = None if deadline is None else time.monotonic() + deadline
         try:
-            if not await self.rate_limiter.is_allowed():
-                self.logger.warning("Rate limit reached, waiting for next available slot")
-                await self.rate_limiter.wait_for_next_slot()
+            waited = await self.rate_limiter.acquire()
+            if waited:
+                self.logger.warning(f"Rate limit reached, waited {waited:.2f} seconds for a slot")
             if not isinstance(prompt, str):
                 raise ValueError(f"Invalid prompt type: {type(prompt)}. Must be a string.")
             if not prompt.strip():
                 raise ValueError("Invalid prompt: must be a non-empty string")
-            token_count = await self.count_tokens(prompt)
+            token_count = await self.count_tokens(prompt) + await self._count_system_tokens(system)
             self.logger.debug(f"Token count for prompt: {token_count}")
             if token_count > self.max_context_length:
                 self.logger.error(f"Prompt length ({token_count} tokens) exceeds maximum context length of {self.max_context_length} tokens")
@@ -170,13 +213,32 @@ class ClaudeManager:
             self.logger.debug(f"Using model: {model if model else 'default'}")
 
             selected_model = await self.select_model(prompt) if model is None else model
-            response_text = await self.client.generate_response(prompt, selected_model)
+            if self.circuit_breakers.get(selected_model).state() == 'open':
+                raise CircuitOpenError(f"Circuit open for model {selected_model}")
+            reservation = await self.token_budget.reserve(selected_model, token_count, self._reserved_output(system, max_tokens))
+            output_tokens = 0
+            answered_by = selected_model
+            try:
+                # The reservation may have waited for budget while the circuit opened.
+                if self.circuit_breakers.get(selected_model).state() == 'open':
+                    raise CircuitOpenError(f"Circuit open for model {selected_model}")
+                response_text, answered_by = await self._generate_hedged(prompt, selected_model, system, max_tokens, token_count,
+                                                                         priority, priority_class, expires)
+                output_tokens = await self.count_tokens(response_text)
+            finally:
+                # A hedge that answered settles its output against its own model's budget.
+                self.token_budget.settle(reservation, token_count, output_tokens if answered_by == selected_model else 0)
 
-            await self.token_tracker.add_tokens("generate_response", token_count, await self.count_tokens(response_text))
+            await self.token_tracker.add_tokens("generate_response", token_count, output_tokens)
             parsed_response = self.parse_response(response_text)
             end_time = time.time()
-            self.logger.info(f"Response generated in {end_time - start_time:.2f} seconds. Model: {selected_model}, Input tokens: {token_count}, Output tokens: {await self.count_tokens(response_text)}")
+            self.logger.info(f"Response generated in {end_time - start_time:.2f} seconds. Model: {answered_by}, Input tokens: {token_count}, Output tokens: {output_tokens}")
             return parsed_response
+        except CircuitOpenError as e:
+            # Raised rather than answered with the fallback text, so callers can move to another
+            # tier and do not mistake the fallback for a response worth caching.
+            self.logger.warning(f"{str(e)}, failing fast")
+            raise
         except CustomRateLimitError as e:
             self.logger.error(f"Rate limit error in generate_response: {str(e)}", exc_info=True)
             raise
@@ -186,6 +248,9 @@ class ClaudeManager:
         except RateLimitError as e:
             self.logger.warning(f"Rate limit reached: {str(e)}")
             raise
+        except TimeoutError as e:
+            self.logger.warning(f"Timed out in generate_response: {str(e)}")
+            raise
         except (NotFoundError, APIError, APIConnectionError) as e:
             self.logger.error(f"API error in generate_response: {str(e)}", exc_info=True)
             return await self._handle_error(e, prompt)
@@ -199,8 +264,266 @@ class ClaudeManager:
             end_time = time.time()
             self.logger.debug(f"Total time in generate_response: {end_time - start_time:.2f} seconds")
 
+    async def stream_response(self, prompt: str, model: Optional[str] = None, max_tokens: int = 4096,
+                              system: Optional[List[Dict[str, Any]]] = None, priority: int = 0,
+                              priority_class: Optional[str] = None, deadline: Optional[float] = None) -> AsyncIterator[str]:
+        """Generate a response like generate_response(), yielding the text as it arrives.
+
+        Rate limits, token budgets, the model's circuit breaker and its concurrency limit are
+        applied before the request is sent; the output tokens are settled against the budget
+        once the stream ends. With a scheduler, the stream holds a slot from its send until it
+        ends.
+
+        Raises:
+            CircuitOpenError: If the model's circuit breaker is open.
+            DeadlineExceededError: If no scheduler slot was free within `deadline` seconds.
+        """
+        start_time = time.time()
+        expires = None if deadline is None else time.monotonic() + deadline
+        waited = await self.rate_limiter.acquire()
+        if waited:
+            self.logger.warning(f"Rate limit reached, waited {waited:.2f} seconds for a slot")
+        if not isinstance(prompt, str):
+            raise ValueError(f"Invalid prompt type: {type(prompt)}. Must be a string.")
+        if not prompt.strip():
+            raise ValueError("Invalid prompt: must be a non-empty string")
+        token_count = await self.count_tokens(prompt) + await self._count_system_tokens(system)
+        if token_count > self.max_context_length:
+            raise ValueError(f"Prompt length ({token_count} tokens) exceeds maximum context length of {self.max_context_length} tokens")
+        if '<script>' in prompt.lower() or 'ssn:' in prompt.lower():
+            raise ValueError("Invalid prompt: contains potentially sensitive information")
+
+        selected_model = await self.select_model(prompt) if model is None else model
+        breaker = self.circuit_breakers.get(selected_model)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for model {selected_model}")
+        limiter = self.concurrency.get(selected_model)
+        reservation = permit = None
+        chunks: List[str] = []
+        error: Optional[Exception] = None
+        completed = False
+        try:
+            reservation = await self.token_budget.reserve(selected_model, token_count, max_tokens)
+            async with self._scheduler_slot(priority_class, expires):
+                permit = await limiter.acquire(priority)
+                request = {'model': selected_model, 'max_tokens': max_tokens,
+                           'messages': [{'role': 'user', 'content': prompt}], 'stream': True}
+                if system is not None:
+                    request['system'] = system
+                stream = await self.messages.create(**request)
+                async for event in stream:
+                    event_data = self._as_dict(event)
+                    if event_data.get('type') == 'message_start':
+                        self._record_prompt_cache_usage(self._as_dict(event_data.get('message') or {}).get('usage'))
+                    text = self._stream_event_text(event)
+                    if text:
+                        chunks.append(text)
+                        yield text
+                completed = True
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Requests that were never sent, or were abandoned by the caller, carry no outcome.
+            if completed:
+                breaker.record_success()
+            elif permit is not None and error is not None:
+                breaker.record_failure()
+            else:
+                breaker.release()
+            if permit is not None:
+                limiter.release(permit, SUCCESS if completed else OVERLOAD if error is not None and self._is_overload(error) else IGNORE)
+            if reservation is not None:
+                output_tokens = await self.count_tokens(''.join(chunks))
+                self.token_budget.settle(reservation, token_count, output_tokens)
+                await self.token_tracker.add_tokens("stream_response", token_count, output_tokens)
+                self.logger.info(f"Response streamed in {time.time() - start_time:.2f} seconds. Model: {selected_model}, Input tokens: {token_count}, Output tokens: {output_tokens}")
+
+    @staticmethod
+    def _reserved_output(system: Optional[List[Dict[str, Any]]], max_tokens: int) -> Optional[int]:
+        """Output tokens to reserve: the max_tokens sent with a Messages API request, or None
+        (the tier's max_tokens) when the client picks the limit itself."""
+        return max_tokens if system is not None else None
+
+    async def _send_request(self, prompt: str, model: str, system: Optional[List[Dict[str, Any]]], max_tokens: int) -> str:
+        if system is None:
+            return await self.client.generate_response(prompt, model)
+        message = self._as_dict(await self.messages.create(
+            model=model,
+            max_tokens=max_tokens,
+            system=system,
+            messages=[{'role': 'user', 'content': prompt}]
+        ))
+        self._record_prompt_cache_usage(message.get('usage'))
+        return ''.join(self._as_dict(block).get('text', '') for block in message.get('content', []))
+
+    def _scheduler_slot(self, priority_class: Optional[str], expires: Optional[float]) -> AsyncContextManager[Any]:
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.slot(priority_class, None if expires is None else max(0.0, expires - time.monotonic()))
+
+    async def _send_guarded(self, prompt: str, model: str, system: Optional[List[Dict[str, Any]]], max_tokens: int,
+                            priority: int = 0, priority_class: Optional[str] = None, expires: Optional[float] = None) -> str:
+        """Send one request through the scheduler, the model's circuit breaker and its
+        concurrency limiter, recording its outcome and latency.
+
+        Raises:
+            CircuitOpenError: If the circuit is open, or this request's failure opened it.
+            DeadlineExceededError: If no scheduler slot was free before `expires`.
+        """
+        async with self._scheduler_slot(priority_class, expires):
+            return await self._send_admitted(prompt, model, system, max_tokens, priority)
+
+    async def _send_admitted(self, prompt: str, model: str, system: Optional[List[Dict[str, Any]]], max_tokens: int,
+                             priority: int) -> str:
+        breaker = self.circuit_breakers.get(model)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for model {model}")
+        limiter = self.concurrency.get(model)
+        try:
+            permit = await limiter.acquire(priority)
+        except BaseException:
+            breaker.release()
+            raise
+        start = time.monotonic()
+        try:
+            response_text = await self._send_request(prompt, model, system, max_tokens)
+        except asyncio.CancelledError:
+            limiter.release(permit, IGNORE)
+            breaker.release()
+            raise
+        except Exception as e:
+            limiter.release(permit, OVERLOAD if self._is_overload(e) else IGNORE)
+            breaker.record_failure()
+            if breaker.state() == 'open':
+                raise CircuitOpenError(f"Circuit open for model {model} after error: {str(e)}") from e
+            raise
+        limiter.release(permit, SUCCESS)
+        breaker.record_success()
+        self.latencies.record(model, time.monotonic() - start)
+        return response_text
+
+    @staticmethod
+    def _is_overload(error: Exception) -> bool:
+        """Whether an error signals that the upstream is over capacity (429, 529 or a timeout)."""
+        if isinstance(error, (RateLimitError, CustomRateLimitError, TimeoutError)):
+            return True
+        return getattr(error, 'status_code', None) in (429, 529)
+
+    async def _generate_hedged(self, prompt: str, model: str, system: Optional[List[Dict[str, Any]]], max_tokens: int,
+                               token_count: int, priority: int = 0, priority_class: Optional[str] = None,
+                               expires: Optional[float] = None) -> Tuple[str, str]:
+        """Response text and the model that produced it.
+
+        With hedging enabled, a request still running after the model's recent latency
+        percentile is duplicated to the next cheaper tier; the first successful answer wins
+        and the other request is cancelled.
+        """
+        hedge_model = self.hedge_models.get(model) if self.hedging_enabled else None
+        delay = self.latencies.percentile(model, self.hedge_percentile) if hedge_model else None
+        if delay is None:
+            return await self._send_guarded(prompt, model, system, max_tokens, priority, priority_class, expires), model
+
+        primary = asyncio.ensure_future(self._send_guarded(prompt, model, system, max_tokens, priority, priority_class, expires))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result(), model
+
+        self.logger.info(f"No response from {model} after {delay:.2f} seconds, hedging with {hedge_model}")
+        self.hedge_stats['sent'] += 1
+        hedge = asyncio.ensure_future(self._send_hedge(prompt, hedge_model, system, max_tokens, token_count, priority,
+                                                       priority_class, expires))
+        models = {primary: model, hedge: hedge_model}
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: task is hedge):
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_stats['won'] += 1
+                        return task.result(), models[task]
+            # Both failed: report the primary request's error.
+            return primary.result(), model
+        finally:
+            for task in pending:
+                task.cancel()
+            # Let the losing request settle its breaker slot and token budget before returning.
+            await asyncio.gather(*pending, return_exceptions=True)
+            if hedge.done() and not hedge.cancelled() and hedge.exception() is not None:
+                self.logger.warning(f"Hedged request to {hedge_model} failed: {str(hedge.exception())}")
+
+    async def _send_hedge(self, prompt: str, model: str, system: Optional[List[Dict[str, Any]]], max_tokens: int,
+                          token_count: int, priority: int = 0, priority_class: Optional[str] = None,
+                          expires: Optional[float] = None) -> str:
+        reservation = await self.token_budget.reserve(model, token_count, self._reserved_output(system, max_tokens), timeout=1.0)
+        output_tokens = 0
+        try:
+            response_text = await self._send_guarded(prompt, model, system, max_tokens, priority, priority_class, expires)
+            output_tokens = await self.count_tokens(response_text)
+            return response_text
+        finally:
+            self.token_budget.settle(reservation, token_count, output_tokens)
+
+    def get_resilience_stats(self) -> Dict[str, Any]:
+        return {'circuits': self.circuit_breakers.get_stats(), 'hedges': dict(self.hedge_stats),
+                'concurrency': self.concurrency.get_stats()}
+
+    async def _count_system_tokens(self, system: Optional[List[Dict[str, Any]]]) -> int:
+        return sum([await self.count_tokens(block.get('text', '')) for block in system or []])
+
+    def _record_prompt_cache_usage(self, usage: Any) -> None:
+        """Add a response's input token usage, split into uncached, cache-write and cache-read tokens."""
+        if not usage:
+            return
+        usage = self._as_dict(usage)
+        for field in self.prompt_cache_usage:
+            self.prompt_cache_usage[field] += usage.get(field) or 0
+        self.logger.debug(f"Prompt cache usage: {usage.get('cache_read_input_tokens') or 0} tokens read, "
+                          f"{usage.get('cache_creation_input_tokens') or 0} written")
+
+    @staticmethod
+    def _stream_event_text(event: Any) -> str:
+        """Text carried by a streaming event, for both SDK event objects and plain dicts."""
+        if isinstance(event, dict):
+            if event.get('type') != 'content_block_delta':
+                return ''
+            return event.get('delta', {}).get('text') or ''
+        if getattr(event, 'type', None) != 'content_block_delta':
+            return ''
+        return getattr(event.delta, 'text', None) or ''
+
+    async def submit_batch(self, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Submit requests to the Message Batches API for asynchronous processing.
+
+        Each request is {'custom_id': ..., 'params': {...Messages API parameters...}}. Returns
+        the batch, including its 'id' and 'processing_status'.
+        """
+        batches = getattr(self.messages, 'batches', None)
+        if batches is None:
+            raise NotImplementedError("The Anthropic client does not support message batches")
+        batch = self._as_dict(await batches.create(requests=requests))
+        self.logger.info(f"Submitted message batch {batch.get('id')} with {len(requests)} requests")
+        return batch
+
+    async def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        return self._as_dict(await self.messages.batches.retrieve(batch_id))
+
+    async def batch_results(self, batch_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """Results of an ended batch, one {'custom_id', 'result'} entry per request."""
+        async for entry in await self.messages.batches.results(batch_id):
+            yield self._as_dict(entry)
+
+    @staticmethod
+    def _as_dict(value: Any) -> Dict[str, Any]:
+        if isinstance(value, dict):
+            return value
+        if hasattr(value, 'model_dump'):
+            return value.model_dump()
+        return dict(vars(value))
+
     async def count_tokens(self, text: str) -> int:
-        return await self.client.count_tokens(text)
+        return get_token_counter().count(text)
 
     async def select_model(self, task_description: str) -> str:
         if "simple" in task_description.lower():
@@ -0,0 +1,226 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+SUCCESS = 'success'
+OVERLOAD = 'overload'
+IGNORE = 'ignore'
+
+DEFAULT_INITIAL_LIMIT = 20
+
+class AIMDLimit:
+    """Additive increase, multiplicative decrease on overload signals.
+
+    Every success while the limit is in use adds 1/limit, i.e. about one slot per round of
+    requests; every overload (429, 529, timeout) multiplies the limit by `backoff`.
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int, backoff: float = 0.9):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+
+    def update(self, latency: float, in_flight: int, overload: bool) -> None:
+        if overload:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+class GradientLimit:
+    """Vegas-style limit following the ratio of long-term to current latency.
+
+    The baseline latency follows drops at once and rises only as a long exponential average,
+    so it tracks the uncongested round trip rather than the latency under load. While
+    the latest sample stays within `tolerance` of it the limit grows by a queue allowance of
+    sqrt(limit); once latency rises past it the limit shrinks in proportion (by at most
+    half per sample) before queueing upstream turns into latency collapse. Overload signals
+    cut the limit by `backoff` as in AIMD.
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int, backoff: float = 0.9,
+                 tolerance: float = 1.5, smoothing: float = 0.2, long_window: int = 600):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.long_window = long_window
+        self.long_latency: Optional[float] = None
+
+    def update(self, latency: float, in_flight: int, overload: bool) -> None:
+        if overload:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            return
+        if self.long_latency is None or latency < self.long_latency:
+            self.long_latency = latency
+        else:
+            self.long_latency += (latency - self.long_latency) / self.long_window
+        # A limit that is far from used says nothing about the upstream's capacity.
+        if in_flight * 2 < self.limit or latency <= 0:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / latency))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = (1 - self.smoothing) * self.limit + self.smoothing * target
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+CONCURRENCY_ALGORITHMS = {
+    'aimd': AIMDLimit,
+    'gradient': GradientLimit
+}
+
+ALGORITHM_OPTIONS = {
+    'aimd': ('backoff',),
+    'gradient': ('backoff', 'tolerance', 'smoothing', 'long_window')
+}
+
+@dataclass
+class ConcurrencyPermit:
+    started: float
+    in_flight: int
+    released: bool = False
+
+class AdaptiveConcurrencyLimiter:
+    """Caps requests in flight at a limit that adapts to observed latency and overload.
+
+    Callers acquire a permit before sending and release it with the outcome once the
+    response (or error) arrives. Callers over the limit wait in a priority queue, lower
+    `priority` values first and FIFO within a priority.
+    """
+
+    def __init__(self, algorithm: str = 'gradient', initial_limit: int = DEFAULT_INITIAL_LIMIT, min_limit: int = 1,
+                 max_limit: int = 200, **options: Any):
+        if algorithm not in CONCURRENCY_ALGORITHMS:
+            raise ValueError(f"Unknown concurrency algorithm: {algorithm}")
+        self.logger = logging.getLogger(__name__)
+        self.algorithm = algorithm
+        self.limit_algorithm = CONCURRENCY_ALGORITHMS[algorithm](initial_limit, min_limit, max_limit, **options)
+        self.in_flight = 0
+        # Heap of (priority, sequence, future) for callers waiting on a permit.
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self.granted = 0
+        self.queued = 0
+        self.timed_out = 0
+        self.overloads = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self.limit_algorithm.limit)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0, timeout: Optional[float] = None) -> ConcurrencyPermit:
+        """Wait for a permit to send one request.
+
+        Raises:
+            TimeoutError: If no permit was granted within `timeout` seconds.
+        """
+        self._prune()
+        if not self._waiters and self.in_flight < self.limit:
+            return self._grant()
+
+        start_time = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            permit = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise TimeoutError("Waited too long for a concurrency slot")
+        except BaseException:
+            # Granted just as the caller was cancelled: hand the slot on.
+            if future.done() and not future.cancelled():
+                self.release(future.result(), IGNORE)
+            raise
+        self.total_wait += time.monotonic() - start_time
+        return permit
+
+    def release(self, permit: ConcurrencyPermit, outcome: str = SUCCESS) -> None:
+        """Return a permit. SUCCESS and OVERLOAD outcomes update the limit; IGNORE is for
+        requests whose result says nothing about upstream load (cancellations, bad requests)."""
+        if permit.released:
+            return
+        permit.released = True
+        self.in_flight -= 1
+        if outcome != IGNORE:
+            if outcome == OVERLOAD:
+                self.overloads += 1
+            previous = self.limit
+            self.limit_algorithm.update(time.monotonic() - permit.started, permit.in_flight, outcome == OVERLOAD)
+            if self.limit != previous:
+                self.logger.debug(f"Concurrency limit changed from {previous} to {self.limit}")
+        self._dispatch()
+
+    def _grant(self) -> ConcurrencyPermit:
+        self.in_flight += 1
+        self.granted += 1
+        return ConcurrencyPermit(time.monotonic(), self.in_flight)
+
+    def _prune(self) -> None:
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+    def _dispatch(self) -> None:
+        self._prune()
+        while self._waiters and self.in_flight < self.limit:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(self._grant())
+            self._prune()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'algorithm': self.algorithm,
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'granted': self.granted,
+            'queued': self.queued,
+            'timed_out': self.timed_out,
+            'overloads': self.overloads,
+            'average_wait': self.total_wait / self.queued if self.queued else 0.0
+        }
+
+class ConcurrencyLimiters:
+    """One AdaptiveConcurrencyLimiter per model, created on first use with shared settings."""
+
+    def __init__(self, **settings: Any):
+        self.settings = settings
+        self._limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'ConcurrencyLimiters':
+        """Build from the `concurrency` section of llm_config.yaml."""
+        algorithm = config.get('algorithm', 'gradient')
+        if algorithm not in CONCURRENCY_ALGORITHMS:
+            raise ValueError(f"Unknown concurrency algorithm: {algorithm}")
+        keys = ('initial_limit', 'min_limit', 'max_limit') + ALGORITHM_OPTIONS[algorithm]
+        return cls(algorithm=algorithm, **{key: config[key] for key in keys if key in config})
+
+    def get(self, model: str) -> AdaptiveConcurrencyLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limiter = self._limiters[model] = AdaptiveConcurrencyLimiter(**self.settings)
+        return limiter
+
+    def total_limit(self) -> int:
+        """Sum of the current per-model limits, and at least one model's initial limit."""
+        return max(sum(limiter.limit for limiter in self._limiters.values()),
+                   self.settings.get('initial_limit', DEFAULT_INITIAL_LIMIT))
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: limiter.get_stats() for model, limiter in self._limiters.items()}
@@ -0,0 +1,124 @@
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+from src.prompt_segments import PromptSegment, PromptSegmentCache
+
+@dataclass
+class ContextBlock:
+    """A block of prompt context with its packing rules.
+
+    Blocks with a lower priority are reduced first. Blocks with a `summary` are replaced by
+    it, and only if that is not enough are blocks truncated or dropped. `required` blocks are
+    never dropped, and blocks that are not `truncatable` are never cut mid-text.
+    """
+    name: str
+    text: str
+    priority: int
+    summary: Optional[str] = None
+    truncatable: bool = True
+    required: bool = False
+
+@dataclass
+class ContextReduction:
+    name: str
+    action: str  # 'summarized', 'truncated' or 'dropped'
+    tokens_before: int
+    tokens_after: int
+
+@dataclass
+class PackedContext:
+    # One entry per input block, in input order; None where the block was dropped.
+    segments: List[Optional[PromptSegment]]
+    tokens: int
+    budget: int
+    reductions: List[ContextReduction] = field(default_factory=list)
+
+    @property
+    def fits(self) -> bool:
+        return self.tokens <= self.budget
+
+    @property
+    def dropped(self) -> List[str]:
+        return [reduction.name for reduction in self.reductions if reduction.action == 'dropped']
+
+class ContextPacker:
+    """Fits prompt context blocks into a token budget by priority.
+
+    Blocks are counted through the PromptSegmentCache, so an unchanged block costs a lookup
+    rather than a tokenization, and a reduced block is cached under its own name so it is
+    not recounted while it stays reduced. If the budget is still exceeded once every block
+    that may be reduced has been, the packed context is returned as is with fits False.
+    """
+
+    def __init__(self, segment_cache: Optional[PromptSegmentCache] = None, min_block_tokens: int = 32):
+        self.logger = logging.getLogger(__name__)
+        self.segment_cache = segment_cache or PromptSegmentCache()
+        self.min_block_tokens = min_block_tokens
+        self.packs = 0
+        self.reduced_packs = 0
+        self.over_budget = 0
+        self.tokens_saved = 0
+        self.actions: Counter = Counter()
+        self.dropped_blocks: Counter = Counter()
+
+    def pack(self, blocks: Sequence[ContextBlock], budget: int) -> PackedContext:
+        segments: List[Optional[PromptSegment]] = [self.segment_cache.segment(block.name, block.text) for block in blocks]
+        total = sum(segment.tokens for segment in segments)
+        reductions = []
+        order = sorted(range(len(blocks)), key=lambda i: blocks[i].priority)
+        # Summaries keep the gist of a block, so every summary is tried before anything is cut.
+        for index in order:
+            if total <= budget:
+                break
+            block, segment = blocks[index], segments[index]
+            if block.summary is not None:
+                summary = self.segment_cache.segment(f"{block.name}:summary", block.summary)
+                if summary.tokens < segment.tokens:
+                    reductions.append(ContextReduction(block.name, 'summarized', segment.tokens, summary.tokens))
+                    total += summary.tokens - segment.tokens
+                    segments[index] = summary
+        for index in order:
+            if total <= budget:
+                break
+            block, segment = blocks[index], segments[index]
+            allowance = segment.tokens - (total - budget)
+            if block.truncatable and (allowance >= self.min_block_tokens or block.required and allowance > 0):
+                text = self.segment_cache.counter.truncate(segment.text, allowance)
+                truncated = self.segment_cache.segment(f"{block.name}:truncated", text)
+                reductions.append(ContextReduction(block.name, 'truncated', segment.tokens, truncated.tokens))
+                total += truncated.tokens - segment.tokens
+                segments[index] = truncated
+            elif not block.required:
+                reductions.append(ContextReduction(block.name, 'dropped', segment.tokens, 0))
+                total -= segment.tokens
+                segments[index] = None
+        packed = PackedContext(segments, total, budget, reductions)
+        self._record(packed)
+        return packed
+
+    def _record(self, packed: PackedContext) -> None:
+        self.packs += 1
+        if packed.reductions:
+            self.reduced_packs += 1
+            for reduction in packed.reductions:
+                self.actions[reduction.action] += 1
+                self.tokens_saved += reduction.tokens_before - reduction.tokens_after
+            self.dropped_blocks.update(packed.dropped)
+            self.logger.info(f"Packed context into {packed.tokens}/{packed.budget} tokens: " + ', '.join(
+                f"{r.name} {r.action} ({r.tokens_before} -> {r.tokens_after})" for r in packed.reductions))
+        if not packed.fits:
+            self.over_budget += 1
+            self.logger.warning(f"Context needs {packed.tokens} tokens after packing, over the budget of {packed.budget}")
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            'packs': self.packs,
+            'reduced_packs': self.reduced_packs,
+            'over_budget': self.over_budget,
+            'tokens_saved': self.tokens_saved,
+            'summarized': self.actions['summarized'],
+            'truncated': self.actions['truncated'],
+            'dropped': self.actions['dropped'],
+            'dropped_blocks': dict(self.dropped_blocks)
+        }
@@ -20,43 +20,56 @@ class CostAnalyzer:
         cost = self.calculate_cost(model, tokens)
         return performance_score / cost if cost > 0 else float('inf')
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from src.usage_ledger import UsageLedger
 
 class CostAnalyzer:
-    def __init__(self):
+    def __init__(self, usage_ledger: Optional[UsageLedger] = None):
         self.logger = logging.getLogger(__name__)
         self.model_costs: Dict[str, float] = {
             "claude-3-opus-20240229": 0.015,  # Cost per 1K tokens
             "claude-3-sonnet-20240229": 0.003,
             "claude-3-haiku-20240307": 0.0015
         }
-        self.model_usage: Dict[str, Dict[str, Any]] = {
-            model: {"tokens": 0, "cost": 0.0} for model in self.model_costs
-        }
+        self.default_cost_per_1k = 0.01
+        self.usage_ledger = usage_ledger or UsageLedger()
+
+    def _cost_per_1k(self, model: str) -> float:
+        return self.model_costs.get(model, self.default_cost_per_1k)
 
     def calculate_cost(self, model: str, tokens: int) -> float:
         if model not in self.model_costs:
             self.logger.warning(f"Unknown model: {model}. Using default cost.")
-            cost_per_1k = 0.01  # Default cost
-        else:
-            cost_per_1k = self.model_costs[model]
-        
-        cost = (tokens / 1000) * cost_per_1k
-        self.model_usage[model]["tokens"] += tokens
-        self.model_usage[model]["cost"] += cost
+        cost = (tokens / 1000) * self._cost_per_1k(model)
+        self.usage_ledger.record(model, None, tokens, 0)
         return cost
 
+    def get_usage(self, since: Optional[float] = None, until: Optional[float] = None,
+                  resolution: str = '1m') -> Dict[str, Dict[str, Any]]:
+        """Tokens and cost per model from the usage ledger, optionally within a time range."""
+        usage = {model: {"tokens": 0, "cost": 0.0} for model in self.model_costs}
+        for model, totals in self.usage_ledger.totals('model', since, until, resolution).items():
+            if not model:
+                continue
+            usage[model] = {"tokens": totals.total_tokens, "cost": (totals.total_tokens / 1000) * self._cost_per_1k(model)}
+        return usage
+
+    @property
+    def model_usage(self) -> Dict[str, Dict[str, Any]]:
+        return self.get_usage()
+
     def get_total_cost(self) -> float:
         return sum(usage["cost"] for usage in self.model_usage.values())
 
     def get_model_usage(self, model: str) -> Dict[str, Any]:
         return self.model_usage.get(model, {"tokens": 0, "cost": 0.0})
 
-    def generate_cost_report(self) -> str:
+    def generate_cost_report(self, since: Optional[float] = None, until: Optional[float] = None) -> str:
+        model_usage = self.get_usage(since, until)
         report = "Cost Analysis Report:\n"
-        report += f"Total Cost: ${self.get_total_cost():.4f}\n\n"
+        report += f"Total Cost: ${sum(usage['cost'] for usage in model_usage.values()):.4f}\n\n"
         report += "Model Usage:\n"
-        for model, usage in self.model_usage.items():
+        for model, usage in model_usage.items():
             report += f"- {model}:\n"
             report += f"  Tokens: {usage['tokens']}\n"
             report += f"  Cost: ${usage['cost']:.4f}\n"
@@ -64,12 +77,13 @@ class CostAnalyzer:
 
     def suggest_cost_optimization(self) -> str:
         suggestion = "Cost Optimization Suggestions:\n"
-        total_tokens = sum(usage["tokens"] for usage in self.model_usage.values())
+        model_usage = self.model_usage
+        total_tokens = sum(usage["tokens"] for usage in model_usage.values())
         
         if total_tokens == 0:
             return "No usage data available for optimization suggestions."
         
-        for model, usage in self.model_usage.items():
+        for model, usage in model_usage.items():
             percentage = (usage["tokens"] / total_tokens) * 100
             if percentage > 50 and model == "claude-3-opus-20240229":
                 suggestion += f"- Consider using claude-3-sonnet-20240229 for some tasks to reduce costs. {model} usage: {percentage:.2f}%\n"
@@ -5,3 +5,11 @@ class RateLimitError(Exception):
 class CustomRateLimitError(Exception):
     """Exception raised for custom rate limit scenarios."""
     pass
+
+class CircuitOpenError(Exception):
+    """Exception raised when a model's circuit breaker is open and requests fail fast."""
+    pass
+
+class DeadlineExceededError(TimeoutError):
+    """Exception raised when a scheduled request reaches its deadline before being dispatched."""
+    pass
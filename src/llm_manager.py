@@ -3,57 +3,120 @@ import time
 import yaml
 import os
 import ast
-from typing import Dict, Any, Optional, List
+import asyncio
+import contextlib
+import hashlib
+import json
+import sqlite3
+import string
+from typing import Dict, Any, AsyncContextManager, AsyncIterator, Optional, List, Sequence, Tuple, Union
 from .error_handler import ErrorHandler
+from .advanced_cache import AdvancedCache
 from anthropic import Anthropic, NotFoundError, APIError, APIConnectionError
 from .claude_manager import ClaudeManager
-from .exceptions import RateLimitError
+from .circuit_breaker import CircuitBreakers
+from .concurrency_limiter import ConcurrencyLimiters
+from .rate_limiter import RateLimiter
+from .exceptions import CircuitOpenError, DeadlineExceededError, RateLimitError
 from .token_tracker import TokenTracker
 from .token_optimizer import TokenOptimizer
+from .persistent_cache import PersistentCache
+from .tokenizer import get_token_counter
+from .prompt_segments import PromptPrefixTracker, PromptSegmentCache, SegmentedPrompt
+from .context_packer import ContextBlock, ContextPacker
+from .request_scheduler import DEFAULT_MAX_CONCURRENT, RequestScheduler
+from .usage_ledger import UsageLedger, UsageTotals
+from .structured_response import RESULT_SECTION, STRUCTURED_SECTIONS, ResponseSection, SectionParser, parse_structured_response, stream_sections
+
+RESPONSE_FORMAT_INSTRUCTIONS = """        Please structure your response using the following XML tags:
+        <task_progress>
+        [Provide a float value between 0 and 1 indicating the progress of the current task]
+        </task_progress>
+
+        <state_updates>
+        [Provide any updates to the project state as key-value pairs]
+        </state_updates>
+
+        <actions>
+        [List any actions that should be taken based on your response]
+        </actions>
+
+        <suggestions>
+        [Provide any suggestions for the user or the workflow director]
+        </suggestions>
+
+        <response>
+        [Your main response to the prompt]
+        </response>
+        """
+
+CONTEXT_PREAMBLE = """
+        <context>
+        You are Claude, an AI language model. You are currently being directed by an automated LLM-Workflow Director as part of an AI-assisted software development process. Your task is to assist with the current workflow step. Please process the following information and respond accordingly.
+        </context>
+
+"""
+
+# Context token budget for tiers without a context_budget setting: the 200k window less room for output.
+DEFAULT_CONTEXT_BUDGET = 190000
+
+# Workflow history entries kept when the history block is summarized to fit the budget.
+SUMMARY_HISTORY_ENTRIES = 3
+
+# Result handed to coalesced waiters when the leading query was cancelled or ran out of its
+# deadline: an outcome of that caller, not of the API, so each waiter sends the query itself.
+REISSUE = object()
 
 class LLMCostOptimizer:
-    def __init__(self):
+    def __init__(self, usage_ledger: Optional[UsageLedger] = None):
         self.logger = logging.getLogger(__name__)
-        self.usage_stats = {
-            'fast': {'count': 0, 'total_tokens': 0, 'total_cost': 0},
-            'balanced': {'count': 0, 'total_tokens': 0, 'total_cost': 0},
-            'powerful': {'count': 0, 'total_tokens': 0, 'total_cost': 0}
-        }
+        # Usage and performance figures are read from the shared ledger rather than kept
+        # as separate running totals.
+        self.usage_ledger = usage_ledger or UsageLedger()
         self.cost_per_token = {
             'fast': 0.0001,
             'balanced': 0.0005,
             'powerful': 0.001
         }
-        self.performance_metrics = {
-            'fast': {'avg_response_time': 0, 'success_rate': 1.0},
-            'balanced': {'avg_response_time': 0, 'success_rate': 1.0},
-            'powerful': {'avg_response_time': 0, 'success_rate': 1.0}
+
+    def _tier_totals(self) -> Dict[str, UsageTotals]:
+        totals = self.usage_ledger.totals(group_by='tier')
+        return {tier: totals.get(tier, UsageTotals()) for tier in self.cost_per_token}
+
+    @property
+    def usage_stats(self) -> Dict[str, Dict[str, Any]]:
+        # Cache hits never reach the LLM, so they are reported separately from the count.
+        return {
+            tier: {
+                'count': totals.requests - totals.cache_hits,
+                'total_tokens': totals.total_tokens,
+                'total_cost': totals.total_tokens * self.cost_per_token[tier],
+                'cache_hits': totals.cache_hits
+            }
+            for tier, totals in self._tier_totals().items()
+        }
+
+    @property
+    def performance_metrics(self) -> Dict[str, Dict[str, float]]:
+        return {
+            tier: {
+                'avg_response_time': totals.avg_latency,
+                'success_rate': 1.0 - totals.errors / totals.requests if totals.requests else 1.0
+            }
+            for tier, totals in self._tier_totals().items()
         }
 
     async def update_usage(self, tier: str, tokens: int, response_time: float, success: bool):
-        if tier in self.usage_stats:
-            self.usage_stats[tier]['count'] += 1
-            self.usage_stats[tier]['total_tokens'] += tokens
-            cost = tokens * self.cost_per_token[tier]
-            self.usage_stats[tier]['total_cost'] += cost
-
-            # Update performance metrics
-            self.performance_metrics[tier]['avg_response_time'] = (
-                (self.performance_metrics[tier]['avg_response_time'] * (self.usage_stats[tier]['count'] - 1) + response_time)
-                / self.usage_stats[tier]['count']
-            )
-            if not success:
-                self.performance_metrics[tier]['success_rate'] = (
-                    (self.performance_metrics[tier]['success_rate'] * (self.usage_stats[tier]['count'] - 1) + 0)
-                    / self.usage_stats[tier]['count']
-                )
+        if tier in self.cost_per_token:
+            self.usage_ledger.record(None, tier, tokens, 0, response_time, success=success)
         else:
             self.logger.warning(f"Unknown tier: {tier}")
 
     async def get_usage_report(self) -> Dict[str, Any]:
-        total_cost = sum(self.usage_stats[tier]['total_cost'] for tier in self.usage_stats)
+        usage_stats = self.usage_stats
+        total_cost = sum(usage_stats[tier]['total_cost'] for tier in usage_stats)
         return {
-            'usage_stats': self.usage_stats,
+            'usage_stats': usage_stats,
             'performance_metrics': self.performance_metrics,
             'total_cost': total_cost
         }
@@ -93,7 +156,7 @@ class LLMCostOptimizer:
             return 'powerful'
 
 class LLMManager:
-    def __init__(self, config_path='src/llm_config.yaml', claude_manager=None):
+    def __init__(self, config_path='src/llm_config.yaml', claude_manager=None, persistent_cache=None):
         self.error_handler = ErrorHandler()
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
@@ -108,27 +171,122 @@ class LLMManager:
         console_handler.setLevel(logging.DEBUG)
         console_handler.setFormatter(formatter)
         self.logger.addHandler(console_handler)
-        self.cache = {}
-        self.cost_optimizer = LLMCostOptimizer()
         self.config = self._load_config(config_path)
+        self.cache = self._create_query_cache()
+        self.usage_ledger = self._create_usage_ledger()
+        self.cost_optimizer = LLMCostOptimizer(self.usage_ledger)
         self.tiers = self.config.get('tiers', {
-            'fast': {'model': 'claude-3-haiku-20240307', 'max_tokens': 1000},
-            'balanced': {'model': 'claude-3-sonnet-20240229', 'max_tokens': 4000},
-            'powerful': {'model': 'claude-3-opus-20240229', 'max_tokens': 4000}
+            'fast': {'model': 'claude-3-haiku-20240307', 'max_tokens': 1000, 'context_budget': 8000},
+            'balanced': {'model': 'claude-3-sonnet-20240229', 'max_tokens': 4000, 'context_budget': 16000},
+            'powerful': {'model': 'claude-3-opus-20240229', 'max_tokens': 4000, 'context_budget': 32000}
         })
         self.logger.info("LLMManager initialized with config: %s", self.config)
         self.prompt_templates = self.config.get('prompt_templates', {})
+        self.scheduler = self._create_scheduler()
         self.claude_manager = claude_manager or self._create_claude_manager()
         self.token_tracker = TokenTracker()
         self.token_optimizer = TokenOptimizer(self.token_tracker)
+        self.persistent_cache = persistent_cache or self._create_persistent_cache()
+        # Single-flight bookkeeping: futures of queries currently in flight, keyed by cache key
+        # and priority class.
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._inflight_waiters: Dict[Tuple[str, str], int] = {}
+        self.coalesced_requests = 0
+        self.prompt_segments = PromptSegmentCache()
+        self.prefix_tracker = PromptPrefixTracker()
+        self.context_packer = ContextPacker(self.prompt_segments)
         self.logger.info("LLMManager initialization complete")
 
     async def count_tokens(self, text: str) -> int:
-        words = text.split()
-        return max(1, len(words))  # Ensure we always return at least 1 token
+        return max(1, get_token_counter().count(text))  # Ensure we always return at least 1 token
 
     def _create_claude_manager(self):
-        return ClaudeManager()
+        return ClaudeManager(tiers=self.tiers, rate_limiter=self._create_rate_limiter(),
+                             circuit_breakers=CircuitBreakers.from_config(self.config.get('circuit_breaker') or {}),
+                             hedging=self.config.get('hedging'),
+                             concurrency=ConcurrencyLimiters.from_config(self.config.get('concurrency') or {}),
+                             scheduler=self.scheduler)
+
+    def _create_rate_limiter(self) -> Optional[RateLimiter]:
+        limit_config = self.config.get('rate_limits')
+        if not limit_config:
+            return None
+        try:
+            return RateLimiter.from_config(limit_config)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            self.logger.error(f"Error initializing configured rate limiter, using the default: {str(e)}")
+            return None
+
+    def _create_scheduler(self) -> RequestScheduler:
+        try:
+            return RequestScheduler.from_config(self.config.get('scheduler') or {}, capacity=self._concurrency_capacity)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.logger.error(f"Error initializing configured request scheduler, using the default: {str(e)}")
+            return RequestScheduler(max_concurrent=None, capacity=self._concurrency_capacity)
+
+    def _concurrency_capacity(self) -> int:
+        # Scheduler slots follow the adaptive per-model concurrency limits, which decide how
+        # many requests the API takes; the scheduler only decides which go first.
+        concurrency = getattr(self.claude_manager, 'concurrency', None)
+        if isinstance(concurrency, ConcurrencyLimiters):
+            return concurrency.total_limit()
+        return DEFAULT_MAX_CONCURRENT
+
+    def _schedules_sends(self) -> bool:
+        # A ClaudeManager built with this scheduler takes a slot around each send itself, so it
+        # is not held across rate limit or budget waits or retry backoff.
+        return getattr(self.claude_manager, 'scheduler', None) is self.scheduler
+
+    def _send_slot(self, priority: Optional[str], expires: Optional[float]) -> AsyncContextManager[Any]:
+        if self._schedules_sends():
+            return contextlib.nullcontext()
+        return self.scheduler.slot(priority, self._remaining(expires))
+
+    def _schedule_kwargs(self, priority: Optional[str], expires: Optional[float]) -> Dict[str, Any]:
+        if not self._schedules_sends():
+            return {}
+        kwargs: Dict[str, Any] = {'priority_class': priority}
+        remaining = self._remaining(expires)
+        if remaining is not None:
+            kwargs['deadline'] = remaining
+        return kwargs
+
+    def _create_query_cache(self) -> AdvancedCache:
+        cache_config = self.config.get('query_cache') or {}
+        try:
+            return AdvancedCache(
+                default_expiration=cache_config.get('ttl', 86400),
+                max_size=cache_config.get('max_entries'),
+                max_bytes=cache_config.get('max_bytes', 64 * 1024 * 1024),
+                eviction_policy=cache_config.get('eviction_policy', 'gdsf'),
+                use_index=False
+            )
+        except (ValueError, TypeError) as e:
+            self.logger.error(f"Error initializing configured query cache, using the default: {str(e)}")
+            return AdvancedCache(default_expiration=86400, max_bytes=64 * 1024 * 1024, eviction_policy='gdsf',
+                                 use_index=False)
+
+    def _create_usage_ledger(self) -> UsageLedger:
+        ledger_config = self.config.get('usage_ledger') or {}
+        return UsageLedger(
+            spill_dir=ledger_config.get('spill_dir'),
+            max_records=ledger_config.get('max_records', 65536)
+        )
+
+    def _create_persistent_cache(self) -> Optional[PersistentCache]:
+        cache_config = self.config.get('persistent_cache') or {}
+        if not cache_config.get('enabled', False):
+            return None
+        try:
+            return PersistentCache(
+                path=cache_config.get('path', '.llm_cache/responses.sqlite3'),
+                default_ttl=cache_config.get('ttl', 86400),
+                max_bytes=cache_config.get('max_bytes', 100 * 1024 * 1024),
+                max_entries=cache_config.get('max_entries')
+            )
+        except Exception as e:
+            self.logger.error(f"Error initializing persistent cache, continuing without it: {str(e)}")
+            return None
 
     def _load_config(self, config_path):
         try:
@@ -142,13 +300,21 @@ class LLMManager:
             self.logger.error(f"Error loading LLM configuration: {str(e)}")
             return {}
 
-    async def query(self, prompt: str, context: Optional[Dict[str, Any]] = None, tier: Optional[str] = None, model: Optional[str] = None) -> Dict[str, Any]:
+    async def query(self, prompt: str, context: Optional[Dict[str, Any]] = None, tier: Optional[str] = None, model: Optional[str] = None,
+                    priority: Optional[str] = None, deadline: Optional[float] = None) -> Dict[str, Any]:
+        """Query the LLM, answering from the cache or an identical in-flight query where possible.
+
+        The request waits for an LLM slot in the scheduler's `priority` class (interactive by
+        default). With a `deadline`, in seconds from now, a request still waiting for a slot
+        when it passes raises DeadlineExceededError instead of falling back.
+        """
         self.logger.debug(f"Querying LLM with prompt: {prompt[:50]}...")
         self.logger.debug(f"Context: {context}")
         self.logger.debug(f"Tier: {tier}")
         self.logger.debug(f"Model: {model}")
         
         start_time = time.time()
+        expires = None if deadline is None else time.monotonic() + deadline
         self.logger.debug(f"Query start time: {start_time}")
         
         try:
@@ -160,90 +326,412 @@ class LLMManager:
             self.logger.info(f"Query details - Tier: {tier}, Model: {model or 'default'}, Prompt length: {len(prompt)}")
 
             cache_key = await self._generate_cache_key(prompt, context, tier)
-            if cache_key in self.cache:
-                self.logger.info(f"Using cached response for prompt: {prompt[:50]}... (tier: {tier})")
-                return self.cache[cache_key]
-
-            max_retries = 3
-            original_tier = tier
-
-            while max_retries > 0:
-                try:
-                    enhanced_prompt = await self._enhance_prompt(prompt, context)
-                    optimized_prompt = await self.token_optimizer.optimize_prompt(enhanced_prompt)
-                    tier_config = self.tiers.get(tier, self.tiers['balanced'])
-
-                    if model is None:
-                        model = tier_config['model']
-
-                    input_tokens = await self.claude_manager.count_tokens(optimized_prompt)
-                    response = await self.claude_manager.generate_response(optimized_prompt, model=model)
-                    output_tokens = await self.claude_manager.count_tokens(response)
-                    
-                    await self.token_tracker.add_tokens(cache_key, input_tokens, output_tokens)
-                    
-                    result = await self._process_response(response, tier, start_time)
-                    result['raw_response'] = response
-                    self.cache[cache_key] = result
-                    self.logger.debug(f"Processed response: {result}")
-                    
-                    await self.token_tracker.add_tokens(prompt, input_tokens, output_tokens)
-                    
-                    self.logger.debug(f"Token usage for query '{prompt[:30]}...': {await self.token_tracker.get_token_usage(prompt)}")
-                    
-                    await self.cost_optimizer.update_usage(tier, input_tokens + output_tokens, time.time() - start_time, True)
-                    
-                    return {
-                        "response": result.get('response', ''),
-                        "task_progress": result.get('task_progress', 0),
-                        "state_updates": result.get('state_updates', {}),
-                        "actions": result.get('actions', []),
-                        "suggestions": result.get('suggestions', []),
-                        "raw_response": result.get('raw_response', ''),
-                        "token_usage": {
-                            "input": input_tokens,
-                            "output": output_tokens,
-                            "total": input_tokens + output_tokens
-                        }
-                    }
-                except RateLimitError:
-                    self.logger.warning(f"Rate limit reached for tier: {tier}")
-                    max_retries -= 1
-                    if max_retries == 0:
-                        return await self._fallback_response(prompt, context, original_tier)
-                    tier = await self._get_fallback_tier(tier)
-                    if tier is None:
-                        return await self._fallback_response(prompt, context, original_tier)
-                    self.logger.info(f"Falling back to a lower-tier LLM: {tier}")
-                except Exception as e:
-                    self.logger.error(f"Error querying LLM: {str(e)} (tier: {tier})")
-                    await self.cost_optimizer.update_usage(tier, 0, time.time() - start_time, False)
-                    max_retries -= 1
-                    if max_retries == 0:
-                        return await self._fallback_response(prompt, context, original_tier)
-            
-            return await self._fallback_response(prompt, context, original_tier)
+            cached = await self._get_cached_response(cache_key, prompt, model, tier, start_time)
+            if cached is not None:
+                return cached
+
+            # Only queries of the same priority class share a request, so an interactive query
+            # never waits behind a background one's place in the scheduler.
+            inflight_key = (cache_key, priority or self.scheduler.default_class)
+            inflight = self._inflight.get(inflight_key)
+            while inflight is not None:
+                result = await self._await_inflight(inflight_key, inflight, prompt)
+                if result is not REISSUE:
+                    return result
+                inflight = self._inflight.get(inflight_key)
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[inflight_key] = future
+            try:
+                result = await self._execute_query(prompt, context, tier, model, cache_key, start_time, priority, expires)
+            except BaseException as e:
+                if not self._inflight_waiters.get(inflight_key):
+                    # Cancel the future so its exception is not reported as never retrieved.
+                    future.cancel()
+                elif isinstance(e, (asyncio.CancelledError, DeadlineExceededError)):
+                    future.set_result(REISSUE)
+                else:
+                    future.set_exception(e)
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                self._inflight.pop(inflight_key, None)
+        except DeadlineExceededError:
+            raise
         except Exception as e:
             self.logger.exception(f"Unexpected error in query method: {str(e)}")
-            return await self._fallback_response(prompt, context, original_tier)
+            return await self._fallback_response(prompt, context, tier)
+
+    async def _get_cached_response(self, cache_key: str, prompt: str, model: Optional[str], tier: str,
+                                   start_time: float) -> Optional[Dict[str, Any]]:
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.logger.info(f"Using cached response for prompt: {prompt[:50]}... (tier: {tier})")
+            self._record_cache_hit(model, tier, start_time)
+            return cached[0]
+        if self.persistent_cache is not None:
+            # SQLite calls wait on other processes' locks, so they run off the event loop.
+            persisted = await asyncio.to_thread(self.persistent_cache.get, cache_key)
+            if persisted is not None:
+                self.logger.info(f"Using persisted response for prompt: {prompt[:50]}... (tier: {tier})")
+                self.cache.set(cache_key, persisted)
+                self._record_cache_hit(model, tier, start_time)
+                return persisted
+        return None
+
+    def _record_cache_hit(self, model: Optional[str], tier: str, start_time: float) -> None:
+        self.usage_ledger.record(model or self.tiers.get(tier, {}).get('model'), tier,
+                                 latency=time.time() - start_time, cache_hit=True)
+
+    async def _await_inflight(self, inflight_key: Tuple[str, str], future: asyncio.Future, prompt: str) -> Any:
+        """Wait for an identical query that is already in flight instead of sending another one.
+
+        Returns the leader's result, or REISSUE if the leader was cancelled or ran out of its
+        deadline and this caller should send the query itself.
+        """
+        self._inflight_waiters[inflight_key] = self._inflight_waiters.get(inflight_key, 0) + 1
+        self.coalesced_requests += 1
+        self.logger.info(f"Coalescing with in-flight request for prompt: {prompt[:50]}... ({self._inflight_waiters[inflight_key]} waiting)")
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self._inflight_waiters[inflight_key] -= 1
+            if not self._inflight_waiters[inflight_key]:
+                del self._inflight_waiters[inflight_key]
+
+    @staticmethod
+    def _remaining(expires: Optional[float]) -> Optional[float]:
+        return None if expires is None else max(0.0, expires - time.monotonic())
+
+    def get_inflight_stats(self) -> Dict[str, Any]:
+        return {
+            "inflight_requests": len(self._inflight),
+            "waiters": dict(self._inflight_waiters),
+            "coalesced_requests": self.coalesced_requests
+        }
+
+    async def _execute_query(self, prompt: str, context: Optional[Dict[str, Any]], tier: str, model: Optional[str], cache_key: str, start_time: float,
+                             priority: Optional[str] = None, expires: Optional[float] = None) -> Dict[str, Any]:
+        max_retries = 3
+        original_tier = tier
+        requested_model = model
+
+        while max_retries > 0:
+            try:
+                system, optimized_prompt = await self._prepare_prompt(prompt, context, tier)
+                tier_config = self.tiers.get(tier, self.tiers['balanced'])
+
+                if model is None:
+                    model = tier_config['model']
+
+                input_tokens = await self._count_request_tokens(system, optimized_prompt)
+                async with self._send_slot(priority, expires):
+                    response = await self.claude_manager.generate_response(optimized_prompt, model=model, **self._system_kwargs(system),
+                                                                           **self._priority_kwargs(priority),
+                                                                           **self._schedule_kwargs(priority, expires))
+                output_tokens = await self.claude_manager.count_tokens(response)
+                
+                return await self._complete_query(prompt, tier, model, cache_key, response,
+                                                  input_tokens, output_tokens, start_time)
+            except RateLimitError:
+                self.logger.warning(f"Rate limit reached for tier: {tier}")
+                max_retries -= 1
+                if max_retries == 0:
+                    return await self._fallback_response(prompt, context, original_tier)
+                tier = await self._get_fallback_tier(tier)
+                if tier is None:
+                    return await self._fallback_response(prompt, context, original_tier)
+                self.logger.info(f"Falling back to a lower-tier LLM: {tier}")
+            except CircuitOpenError as e:
+                # Nothing was sent, so nothing is recorded or cached; a pinned model or the
+                # last tier has nowhere to go but the uncached fallback response.
+                self.logger.warning(f"{str(e)} (tier: {tier})")
+                fallback_tier = await self._get_fallback_tier(tier)
+                if requested_model is not None or fallback_tier == tier:
+                    return await self._fallback_response(prompt, context, original_tier)
+                tier, model = fallback_tier, None
+                self.logger.info(f"Falling back to a lower-tier LLM: {tier}")
+            except DeadlineExceededError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Error querying LLM: {str(e)} (tier: {tier})")
+                self.usage_ledger.record(model or self.tiers.get(tier, {}).get('model'), tier,
+                                         latency=time.time() - start_time, success=False)
+                max_retries -= 1
+                if max_retries == 0:
+                    return await self._fallback_response(prompt, context, original_tier)
+        
+        return await self._fallback_response(prompt, context, original_tier)
+
+    async def _complete_query(self, prompt: str, tier: str, model: str, cache_key: str, response: str,
+                              input_tokens: int, output_tokens: int, start_time: float,
+                              structured_response: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Record, process and cache a successful response, returning the query result."""
+        await self.token_tracker.add_tokens(cache_key, input_tokens, output_tokens,
+                                            label=self._cache_key_label(prompt, tier))
+
+        result = await self._process_response(response, tier, start_time, structured_response)
+        result['raw_response'] = response
+        result['token_usage'] = {
+            "input": input_tokens,
+            "output": output_tokens,
+            "total": input_tokens + output_tokens
+        }
+        self.cache.set(cache_key, result)
+        if self.persistent_cache is not None:
+            await asyncio.to_thread(self.persistent_cache.set, cache_key, result)
+        self.logger.debug(f"Processed response: {result}")
+
+        self.logger.debug(f"Token usage for query '{prompt[:30]}...' ({cache_key}): {await self.token_tracker.get_token_usage(cache_key)}")
+
+        self.usage_ledger.record(model, tier, input_tokens, output_tokens, time.time() - start_time)
+
+        return self._query_result(result)
+
+    @staticmethod
+    def _query_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "response": result.get('response', ''),
+            "task_progress": result.get('task_progress', 0),
+            "state_updates": result.get('state_updates', {}),
+            "actions": result.get('actions', []),
+            "suggestions": result.get('suggestions', []),
+            "raw_response": result.get('raw_response', ''),
+            "token_usage": result['token_usage']
+        }
+
+    async def query_stream(self, prompt: str, context: Optional[Dict[str, Any]] = None, tier: Optional[str] = None,
+                           model: Optional[str] = None, priority: Optional[str] = None,
+                           deadline: Optional[float] = None) -> AsyncIterator[ResponseSection]:
+        """Query the LLM like query(), yielding each section of the structured response as soon
+        as its closing tag has streamed in.
+
+        Sections are yielded as ResponseSection(name, value), with values processed as in
+        query(). The last event is ResponseSection(RESULT_SECTION, result) carrying the dict
+        query() would have returned. Cached responses are replayed section by section, and a
+        stream that fails before its first section is retried through the non-streaming path.
+        The stream holds a scheduler slot as in query() until it ends.
+        """
+        self.logger.debug(f"Streaming LLM query with prompt: {prompt[:50]}...")
+        start_time = time.time()
+        expires = None if deadline is None else time.monotonic() + deadline
+        if tier is None:
+            query_complexity = await self._estimate_query_complexity(prompt)
+            tier = await self.cost_optimizer.select_optimal_tier(query_complexity)
+        cache_key = await self._generate_cache_key(prompt, context, tier)
+        cached = await self._get_cached_response(cache_key, prompt, model, tier, start_time)
+        if cached is not None:
+            for name in STRUCTURED_SECTIONS:
+                if name in cached:
+                    yield ResponseSection(name, cached[name])
+            yield ResponseSection(RESULT_SECTION, cached)
+            return
+
+        emitted: Dict[str, Any] = {}
+        chunks: List[str] = []
+        try:
+            system, optimized_prompt = await self._prepare_prompt(prompt, context, tier)
+            if model is None:
+                model = self.tiers.get(tier, self.tiers['balanced'])['model']
+            input_tokens = await self._count_request_tokens(system, optimized_prompt)
+
+            async def collect():
+                async for chunk in self.claude_manager.stream_response(optimized_prompt, model=model, **self._system_kwargs(system),
+                                                                     **self._priority_kwargs(priority),
+                                                                     **self._schedule_kwargs(priority, expires)):
+                    chunks.append(chunk)
+                    yield chunk
+
+            async with self._send_slot(priority, expires):
+                async for section in stream_sections(collect()):
+                    value = await self._process_section(section)
+                    emitted[section.name] = value
+                    yield ResponseSection(section.name, value)
+
+            response = ''.join(chunks)
+            output_tokens = await self.claude_manager.count_tokens(response)
+            structured_response = {
+                "task_progress": 0,
+                "state_updates": {},
+                "actions": [],
+                "suggestions": [],
+                "response": ""
+            }
+            structured_response.update(emitted)
+            result = await self._complete_query(prompt, tier, model, cache_key, response, input_tokens,
+                                                output_tokens, start_time, structured_response)
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Error streaming LLM response: {str(e)} (tier: {tier})")
+            self.usage_ledger.record(model or self.tiers.get(tier, {}).get('model'), tier,
+                                     latency=time.time() - start_time, success=False)
+            if emitted:
+                result = await self._fallback_response(prompt, context, tier)
+            else:
+                result = await self._execute_query(prompt, context, tier, model, cache_key, start_time, priority, expires)
+            for name in STRUCTURED_SECTIONS:
+                if name in result and name not in emitted:
+                    yield ResponseSection(name, result[name])
+        yield ResponseSection(RESULT_SECTION, result)
+
+    async def query_batch(self, requests: Sequence[Union[str, Tuple]], wave_size: int = 8, bulk: bool = False,
+                          poll_interval: float = 10.0, batch_timeout: float = 86400.0,
+                          max_tokens: int = 4096, priority: Optional[str] = 'background') -> List[Dict[str, Any]]:
+        """Answer many independent queries, returning one result per request in input order.
+
+        Each request is a prompt or a (prompt, context, tier) tuple, where context and tier may
+        be omitted. Requests already in the cache are answered from it, and identical requests
+        are sent once. The rest are grouped by model. Each group is sent in waves of at most
+        `wave_size` concurrent queries, with the groups running side by side, in the
+        scheduler's `priority` class so interactive queries are not held up behind them.
+
+        With `bulk`, the uncached requests are submitted together to the Message Batches API
+        instead. The batch is polled every `poll_interval` seconds until it ends or
+        `batch_timeout` passes. If the client has no batch support, waves are used.
+
+        A request that fails yields a result with an 'error' key rather than failing the batch.
+        """
+        start_time = time.time()
+        items = []
+        for request in requests:
+            if isinstance(request, str):
+                request = (request,)
+            prompt, context, tier = (tuple(request) + (None, None))[:3]
+            if tier is None:
+                tier = await self.cost_optimizer.select_optimal_tier(await self._estimate_query_complexity(prompt))
+            items.append((prompt, context, tier, await self._generate_cache_key(prompt, context, tier)))
+
+        results: Dict[str, Dict[str, Any]] = {}
+        pending: Dict[str, Tuple[str, Optional[Dict[str, Any]], str]] = {}
+        for prompt, context, tier, cache_key in items:
+            if cache_key in results or cache_key in pending:
+                continue
+            cached = await self._get_cached_response(cache_key, prompt, None, tier, start_time)
+            if cached is not None:
+                results[cache_key] = cached
+            else:
+                pending[cache_key] = (prompt, context, tier)
+        self.logger.info(f"Batch of {len(items)} queries: {len(results)} cached, "
+                         f"{len(items) - len(results) - len(pending)} duplicates, {len(pending)} to send")
+
+        if pending and bulk:
+            try:
+                results.update(await self._query_bulk(pending, poll_interval, batch_timeout, max_tokens))
+                pending = {}
+            except NotImplementedError as e:
+                self.logger.warning(f"Bulk submission unavailable, sending the batch in waves: {str(e)}")
+
+        if pending:
+            groups: Dict[str, List[str]] = {}
+            for cache_key, (_, _, tier) in pending.items():
+                groups.setdefault(self.tiers.get(tier, self.tiers['balanced'])['model'], []).append(cache_key)
+
+            async def run_group(cache_keys: List[str]) -> None:
+                for start in range(0, len(cache_keys), wave_size):
+                    wave = cache_keys[start:start + wave_size]
+                    answers = await asyncio.gather(*(self.query(*pending[cache_key], priority=priority) for cache_key in wave),
+                                                   return_exceptions=True)
+                    for cache_key, answer in zip(wave, answers):
+                        if isinstance(answer, BaseException):
+                            answer = await self._batch_error(*pending[cache_key], str(answer))
+                        results[cache_key] = answer
+
+            await asyncio.gather(*(run_group(cache_keys) for cache_keys in groups.values()))
+
+        return [results[cache_key] for _, _, _, cache_key in items]
+
+    async def _query_bulk(self, pending: Dict[str, Tuple[str, Optional[Dict[str, Any]], str]], poll_interval: float,
+                          batch_timeout: float, max_tokens: int) -> Dict[str, Dict[str, Any]]:
+        start_time = time.time()
+        prepared = {}
+        batch_requests = []
+        for cache_key, (prompt, context, tier) in pending.items():
+            system, optimized_prompt = await self._prepare_prompt(prompt, context, tier)
+            model = self.tiers.get(tier, self.tiers['balanced'])['model']
+            prepared[cache_key] = (system, optimized_prompt, model)
+            params = {
+                'model': model,
+                'max_tokens': max_tokens,
+                'messages': [{'role': 'user', 'content': optimized_prompt}]
+            }
+            if system is not None:
+                params['system'] = system
+            batch_requests.append({'custom_id': cache_key, 'params': params})
+
+        results: Dict[str, Dict[str, Any]] = {}
+        try:
+            batch = await self.claude_manager.submit_batch(batch_requests)
+            deadline = time.monotonic() + batch_timeout
+            while batch.get('processing_status') != 'ended':
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Message batch {batch.get('id')} did not end within {batch_timeout:g} seconds")
+                await asyncio.sleep(poll_interval)
+                batch = await self.claude_manager.retrieve_batch(batch['id'])
+
+            async for entry in self.claude_manager.batch_results(batch['id']):
+                cache_key = entry.get('custom_id')
+                if cache_key not in pending:
+                    continue
+                prompt, context, tier = pending[cache_key]
+                system, optimized_prompt, model = prepared[cache_key]
+                outcome = entry.get('result') or {}
+                if outcome.get('type') != 'succeeded':
+                    self.usage_ledger.record(model, tier, latency=time.time() - start_time, success=False)
+                    results[cache_key] = await self._batch_error(prompt, context, tier,
+                                                                 f"Batch request {outcome.get('type', 'failed')}: {outcome.get('error')}")
+                    continue
+                message = outcome.get('message') or {}
+                response = ''.join(block.get('text', '') for block in message.get('content', []) if block.get('type') == 'text')
+                usage = message.get('usage') or {}
+                input_tokens = (sum(usage.get(field) or 0 for field in ('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'))
+                                or await self._count_request_tokens(system, optimized_prompt))
+                output_tokens = usage.get('output_tokens') or await self.claude_manager.count_tokens(response)
+                results[cache_key] = await self._complete_query(prompt, tier, model, cache_key, response,
+                                                                input_tokens, output_tokens, start_time)
+        except NotImplementedError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Error processing message batch: {str(e)}")
+            for cache_key, (prompt, context, tier) in pending.items():
+                if cache_key not in results:
+                    results[cache_key] = await self._batch_error(prompt, context, tier, str(e))
+
+        for cache_key, (prompt, context, tier) in pending.items():
+            if cache_key not in results:
+                results[cache_key] = await self._batch_error(prompt, context, tier, "No result returned for batch request")
+        return results
+
+    async def _batch_error(self, prompt: str, context: Optional[Dict[str, Any]], tier: str, error: str) -> Dict[str, Any]:
+        result = await self._fallback_response(prompt, context, tier)
+        result['error'] = error
+        return result
 
     async def get_optimization_suggestion(self) -> str:
         return await self.cost_optimizer.suggest_optimization()
 
-    async def get_usage_report(self) -> Dict[str, Any]:
-        return await self.cost_optimizer.get_usage_report()
+    async def get_usage_report(self, resolution: Optional[str] = None, since: Optional[float] = None) -> Dict[str, Any]:
+        """Usage and cost per tier; with a `resolution` ('1m', '1h' or '1d') the report also
+        carries a per-model timeline of the ledger's rollup buckets since `since`."""
+        report = await self.cost_optimizer.get_usage_report()
+        if resolution is not None:
+            report['timeline'] = self.usage_ledger.query(resolution, since=since)
+        return report
 
     async def calculate_cost(self, model: str, tokens: int) -> float:
         cost_per_token = 0.0001  # Example cost per token
         return tokens * cost_per_token
 
-    async def _process_response(self, response: str, tier: str, start_time: float) -> Dict[str, Any]:
+    async def _process_response(self, response: str, tier: str, start_time: float,
+                                structured_response: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         end_time = time.time()
         response_time = end_time - start_time
-        tokens = await self.claude_manager.count_tokens(response)
 
         self.logger.debug(f"Received response from LLM: {response[:50]}...")
-        structured_response = await self._parse_structured_response(response)
+        if structured_response is None:
+            structured_response = await self._parse_structured_response(response)
         
         response_with_id = await self._add_unique_id(structured_response)
         response_with_id['response_time'] = response_time
@@ -279,70 +767,141 @@ class LLMManager:
         complexity = await self._estimate_query_complexity(query)
         return await self.cost_optimizer.select_optimal_tier(complexity)
 
-    async def _enhance_prompt(self, prompt: str, context: Optional[Dict[str, Any]]) -> str:
+    async def _enhance_prompt(self, prompt: str, context: Optional[Dict[str, Any]], tier: str = 'balanced') -> str:
         if context is None:
             return prompt
+        enhanced_prompt = self._segment_prompt(prompt, context, tier).render()
+        self.logger.debug(f"Enhanced prompt generated: {enhanced_prompt[:100]}...")
+        return enhanced_prompt
+
+    def _context_budget(self, tier: str) -> int:
+        return self.tiers.get(tier, self.tiers.get('balanced', {})).get('context_budget', DEFAULT_CONTEXT_BUDGET)
+
+    def _segment_prompt(self, prompt: str, context: Dict[str, Any], tier: str = 'balanced') -> SegmentedPrompt:
+        """Lay out the prompt from its most to least stable blocks, packed into the tier's context budget.
 
+        The preamble, project structure, conventions, workflow configuration and response
+        format rarely change within a project, and the stage block only changes between stages.
+        Each group ends in a cache breakpoint, so only the history and per-turn prompt after
+        them are new. When the blocks exceed the budget, the workflow configuration and older
+        history are summarized first, then the lowest-priority blocks are truncated or dropped;
+        the preamble and response format are always sent whole.
+        """
         workflow_stage = context.get('workflow_stage', 'Unknown')
         stage_description = context.get('stage_description', 'No description available')
         stage_tasks = context.get('stage_tasks', [])
         project_structure = context.get('project_structure_instructions', '')
         coding_conventions = context.get('coding_conventions', '')
         workflow_config = context.get('workflow_config', {})
+        workflow_history = context.get('workflow_history', [])
 
-        enhanced_prompt = f"""
-        <context>
-        You are Claude, an AI language model. You are currently being directed by an automated LLM-Workflow Director as part of an AI-assisted software development process. The project is currently in the {workflow_stage} stage. Your task is to assist with the current workflow step. Please process the following information and respond accordingly.
-        </context>
-
-        Current Workflow Stage: {workflow_stage}
+        stage_block = f"""        Current Workflow Stage: {workflow_stage}
         Stage Description: {stage_description}
         Stage Tasks:
         {' '.join(f'- {task}' for task in stage_tasks)}
 
-        Project Structure:
-        {project_structure}
-
-        Coding Conventions:
-        {coding_conventions}
-
-        Workflow Configuration:
-        Stages: {', '.join(stage['name'] for stage in workflow_config.get('stages', []))}
+"""
+        stage_names = ', '.join(stage['name'] for stage in workflow_config.get('stages', []))
+        workflow_block = f"""        Workflow Configuration:
+        Stages: {stage_names}
         Transitions: {', '.join(f"{t['from']} -> {t['to']}" for t in workflow_config.get('transitions', []))}
 
-        Given the above context, please respond to the following prompt:
-
-        {prompt}
-
-        Please structure your response using the following XML tags:
-        <task_progress>
-        [Provide a float value between 0 and 1 indicating the progress of the current task]
-        </task_progress>
-
-        <state_updates>
-        [Provide any updates to the project state as key-value pairs]
-        </state_updates>
-
-        <actions>
-        [List any actions that should be taken based on your response]
-        </actions>
-
-        <suggestions>
-        [Provide any suggestions for the user or the workflow director]
-        </suggestions>
-
-        <response>
-        [Your main response to the prompt]
-        </response>
+"""
+        history_lines = [f"        - {entry.get('action')}: {entry.get('details')}\n" for entry in workflow_history]
+        history_block = "        Workflow History:\n" + ''.join(history_lines) + "\n" if history_lines else ''
+        history_summary = None
+        if len(history_lines) > SUMMARY_HISTORY_ENTRIES:
+            omitted = len(history_lines) - SUMMARY_HISTORY_ENTRIES
+            history_summary = (f"        Workflow History ({omitted} earlier entries omitted):\n"
+                               + ''.join(history_lines[-SUMMARY_HISTORY_ENTRIES:]) + "\n")
+
+        # Groups of blocks, each ending in a cache breakpoint except the last. Higher priority
+        # blocks keep more of their text when the context has to shrink.
+        groups = [
+            [ContextBlock('preamble', CONTEXT_PREAMBLE, 100, truncatable=False, required=True),
+             ContextBlock('project_structure', f"        Project Structure:\n        {project_structure}\n\n", 50),
+             ContextBlock('coding_conventions', f"        Coding Conventions:\n        {coding_conventions}\n\n", 60),
+             ContextBlock('workflow_config', workflow_block, 10,
+                          summary=f"        Workflow Stages: {stage_names}\n\n" if stage_names else None),
+             ContextBlock('response_format', RESPONSE_FORMAT_INSTRUCTIONS, 100, truncatable=False, required=True)],
+            [ContextBlock('stage', stage_block, 80, required=True)],
+            [ContextBlock('workflow_history', history_block, 20, summary=history_summary),
+             ContextBlock('prompt_intro', "        Given the above context, please respond to the following prompt:\n\n        ",
+                          100, truncatable=False, required=True),
+             ContextBlock('prompt', prompt, 90, required=True),
+             ContextBlock('prompt_outro', "\n\n", 100, truncatable=False, required=True)]
+        ]
+        groups = [[block for block in group if block.text] for group in groups]
+        # Each block is counted once and reused across turns until its text changes.
+        packed = self.context_packer.pack([block for group in groups for block in group], self._context_budget(tier))
+        packed_segments = iter(packed.segments)
+        segments = self.prompt_segments.prompt()
+        for index, group in enumerate(groups):
+            for _ in group:
+                segment = next(packed_segments)
+                if segment is not None:
+                    segments.add_segment(segment)
+            if index < len(groups) - 1:
+                segments.cache_breakpoint()
+        return segments
+
+    async def _prepare_prompt(self, prompt: str, context: Optional[Dict[str, Any]],
+                              tier: str = 'balanced') -> Tuple[Optional[List[Dict[str, Any]]], str]:
+        """Split a query into cacheable system blocks and the per-turn prompt.
+
+        Without a context there is nothing stable to cache: the system blocks are None and the
+        prompt goes through the token optimizer. Otherwise the blocks are packed into the
+        tier's context budget, the stable ones are sent as a cache_control prefix, and the
+        history and prompt follow as the user message.
         """
-        self.logger.debug(f"Enhanced prompt generated: {enhanced_prompt[:100]}...")
-        return enhanced_prompt
+        if context is None:
+            return None, await self.token_optimizer.optimize_prompt(prompt)
+        segments = self._segment_prompt(prompt, context, tier)
+        read_tokens = self.prefix_tracker.observe(segments.prefix_hashes(), segments.prefix_tokens())
+        self.logger.debug(f"Prompt prefix: {segments.prefix_tokens()[-1]} tokens, {read_tokens} expected from cache")
+        return segments.system_blocks(), segments.render_suffix()
+
+    @staticmethod
+    def _system_kwargs(system: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+        # Requests without a context carry no system blocks and keep the plain call signature.
+        return {} if system is None else {'system': system}
+
+    def _priority_kwargs(self, priority: Optional[str]) -> Dict[str, Any]:
+        # The scheduler class carries on as the model's concurrency-limiter priority, so
+        # requests past the scheduler keep their class order in the per-model queue.
+        rank = self.scheduler.rank(priority)
+        return {} if rank == 0 else {'priority': rank}
+
+    async def _count_request_tokens(self, system: Optional[List[Dict[str, Any]]], prompt: str) -> int:
+        system_tokens = sum([await self.claude_manager.count_tokens(block['text']) for block in system or []])
+        return system_tokens + await self.claude_manager.count_tokens(prompt)
 
     async def _generate_cache_key(self, prompt: str, context: Optional[Dict[str, Any]] = None, tier: str = 'balanced') -> str:
-        if context is None:
-            context = {}
-        context_str = ','.join(f"{k}:{v}" for k, v in sorted(context.items()))
-        return f"{prompt}|{context_str}|{tier}"
+        """Hash the prompt, a canonical serialization of the context and the tier into a fixed-size key.
+
+        The key is used by the response caches and as the TokenTracker task id; use
+        _cache_key_label() for a human-readable description of the same query.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(prompt.encode('utf-8'))
+        digest.update(b'\x1f')
+        digest.update(self._canonical_context(context).encode('utf-8'))
+        digest.update(b'\x1f')
+        digest.update(str(tier).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _canonical_context(context: Optional[Dict[str, Any]]) -> str:
+        def default(value: Any) -> Any:
+            # Sets have no stable iteration order across processes, so sort them.
+            if isinstance(value, (set, frozenset)):
+                return sorted(value, key=repr)
+            return str(value)
+        return json.dumps(context or {}, sort_keys=True, separators=(',', ':'), default=default, ensure_ascii=False)
+
+    @staticmethod
+    def _cache_key_label(prompt: str, tier: str) -> str:
+        return f"{tier}: {prompt[:60]}"
 
     async def _add_unique_id(self, response: Dict[str, Any]) -> Dict[str, Any]:
         if not isinstance(response, dict):
@@ -363,7 +922,7 @@ class LLMManager:
                 'workflow_history': project_state.get('workflow_history', [])
             }
             prompt = await self.generate_prompt('sufficiency_evaluation', context)
-            response = await self.query(prompt, context=context, tier='balanced')
+            response = await self.query(prompt, context=context, tier='balanced', priority='sufficiency')
             self.logger.debug(f"Sufficiency evaluation response: {response}")
             evaluation = await self._parse_sufficiency_evaluation(response)
             return evaluation
@@ -375,11 +934,14 @@ class LLMManager:
         result = {'is_sufficient': False, 'reasoning': "No reasoning provided"}
         content = response.get('response', '')
         if isinstance(content, str):
-            if '<evaluation>' in content and '</evaluation>' in content:
-                evaluation = content.split('<evaluation>')[1].split('</evaluation>')[0].strip()
-                result['is_sufficient'] = evaluation.upper() == 'SUFFICIENT'
-            if '<reasoning>' in content and '</reasoning>' in content:
-                result['reasoning'] = content.split('<reasoning>')[1].split('</reasoning>')[0].strip()
+            # Only closed sections count, and the first of each tag wins.
+            sections: Dict[str, str] = {}
+            for section in SectionParser(('evaluation', 'reasoning')).feed(content):
+                sections.setdefault(section.name, section.value.strip())
+            if 'evaluation' in sections:
+                result['is_sufficient'] = sections['evaluation'].upper() == 'SUFFICIENT'
+            if 'reasoning' in sections:
+                result['reasoning'] = sections['reasoning']
         elif isinstance(content, dict):
             result['is_sufficient'] = content.get('is_sufficient', False)
             result['reasoning'] = content.get('reasoning', "No reasoning provided")
@@ -396,21 +958,8 @@ class LLMManager:
                 "suggestions": [],
                 "response": ""
             }
-            current_tag = None
-            current_content = []
-
-            for line in response.split('\n'):
-                line = line.strip()
-                if line.startswith('<') and line.endswith('>'):
-                    if current_tag:
-                        structured_response[current_tag] = await self._process_value(current_tag, current_content)
-                        current_content = []
-                    current_tag = line[1:-1]
-                elif current_tag:
-                    current_content.append(line)
-
-            if current_tag:
-                structured_response[current_tag] = await self._process_value(current_tag, current_content)
+            for section in parse_structured_response(response):
+                structured_response[section.name] = await self._process_section(section)
 
             return structured_response
         except Exception as e:
@@ -424,6 +973,9 @@ class LLMManager:
                 "suggestions": []
             }
 
+    async def _process_section(self, section: ResponseSection) -> Any:
+        return await self._process_value(section.name, [line.strip() for line in section.value.split('\n')])
+
     async def _process_value(self, key: str, value: List[str]) -> Any:
         joined_value = ' '.join(value).strip()
         try:
@@ -442,9 +994,11 @@ class LLMManager:
     async def generate_prompt(self, template_name: str, context: Dict[str, Any]) -> str:
         self.logger.debug(f"Generating prompt with template: {template_name}")
         try:
-            template = self.prompt_templates.get(template_name, self.prompt_templates['default'])
+            if template_name not in self.prompt_templates:
+                template_name = 'default'
+            template = self.prompt_templates[template_name]
             enhanced_context = await self._enhance_context(context)
-            prompt = template.format(**enhanced_context)
+            prompt = self._render_template(template_name, template, enhanced_context).render()
             self.logger.debug(f"Generated prompt: {prompt[:100]}...")
             return prompt
         except KeyError as e:
@@ -454,6 +1008,19 @@ class LLMManager:
             self.logger.error(f"Unexpected error generating prompt: {str(e)}", exc_info=True)
             return f"Unexpected error generating prompt: {str(e)}"
 
+    def _render_template(self, template_name: str, template: str, values: Dict[str, Any]) -> SegmentedPrompt:
+        """Format `template` like str.format, as one segment per literal chunk and field."""
+        formatter = string.Formatter()
+        segments = self.prompt_segments.prompt()
+        for index, (literal, field_name, format_spec, conversion) in enumerate(formatter.parse(template)):
+            if literal:
+                segments.add(f"{template_name}:{index}", literal)
+            if field_name is not None:
+                value, _ = formatter.get_field(field_name, (), values)
+                value = formatter.format_field(formatter.convert_field(value, conversion), format_spec or '')
+                segments.add(f"{template_name}:{field_name}", value)
+        return segments
+
     async def _enhance_context(self, context: Dict[str, Any]) -> Dict[str, Any]:
         enhanced_context = context.copy()
         workflow_config = enhanced_context.get('workflow_config', {})
@@ -483,6 +1050,8 @@ class LLMManager:
 
     async def clear_cache(self):
         self.cache.clear()
+        if self.persistent_cache is not None:
+            await asyncio.to_thread(self.persistent_cache.clear)
         self.logger.info("LLM response cache cleared.")
 
     async def _get_time(self) -> float:
@@ -1,79 +1,296 @@
-import requests
+import asyncio
+import importlib.util
+import json
 import logging
-from typing import Dict, Any, Optional
+import threading
+from typing import Dict, Any, List, Optional, Sequence, Tuple, Union
+import httpx
 
-class LLMMicroserviceClient:
-    def __init__(self, base_url: str = "http://localhost:5000"):
+# HTTP/2 is negotiated when the optional h2 package is installed; otherwise HTTP/1.1 keep-alive is used.
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Batch endpoints take one JSON payload per line, each tagged with an "id", and stream back one
+# result line per payload as it completes: the usual response fields, or an "error".
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+DEFAULT_BATCH_SIZE = 100
+
+# A query for the *_many methods: a prompt, or keyword arguments of query() without timeout.
+QueryItem = Union[str, Dict[str, Any]]
+# A sufficiency evaluation for the *_many methods: (stage_name, stage_data, project_state).
+SufficiencyItem = Tuple[str, Dict[str, Any], Dict[str, Any]]
+
+class AsyncLLMMicroserviceClient:
+    """Async client for the LLM microservice.
+
+    Requests share one httpx.AsyncClient, so connections are kept alive and reused across
+    calls instead of opening a TCP connection per request, and calls made from async code
+    never block the event loop. At most `max_connections` requests are on the wire at once;
+    further requests wait on a semaphore rather than in httpx's pool, whose wait queue is
+    rescanned on every connection release and slows down under a large backlog. Each call
+    may override `timeout`, which does not include the time spent waiting for a slot.
+    """
+
+    def __init__(self, base_url: str = "http://localhost:5000", max_connections: int = 20,
+                 max_keepalive_connections: int = 10, timeout: float = 10.0, http2: Optional[bool] = None):
         self.base_url = base_url
         self.logger = logging.getLogger(__name__)
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.http2 = HTTP2_AVAILABLE if http2 is None else http2
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots = asyncio.Semaphore(max_connections)
 
-    def query(self, prompt: str, context: Optional[Dict[str, Any]] = None, model: str = 'gpt-3.5-turbo', max_tokens: int = 500) -> str:
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, limits=self.limits,
+                                             timeout=self.timeout, http2=self.http2)
+        return self._client
+
+    async def query(self, prompt: str, context: Optional[Dict[str, Any]] = None, model: str = 'gpt-3.5-turbo',
+                    max_tokens: int = 500, timeout: Optional[float] = None) -> str:
         self.logger.info(f"Querying LLM microservice with model: {model}, max_tokens: {max_tokens}")
-        endpoint = f"{self.base_url}/query"
-        payload = {
-            "prompt": prompt,
-            "context": context or {},
-            "model": model,
-            "max_tokens": max_tokens
-        }
+        payload = _query_payload(prompt, context, model, max_tokens)
         try:
-            response = requests.post(endpoint, json=payload, timeout=10)
-            response.raise_for_status()
-            result = response.json()
+            result = await self._post("/query", payload, timeout)
             self.logger.debug(f"LLM microservice response: {result}")
             return result["response"]
-        except requests.RequestException as e:
+        except (httpx.HTTPError, ValueError, KeyError) as e:
             self.logger.error(f"Error querying LLM microservice: {str(e)}")
-            return self._fallback_response(prompt, context, model, max_tokens)
+            return _fallback_response(self.logger, prompt, model, max_tokens)
 
-    def _fallback_response(self, prompt: str, context: Optional[Dict[str, Any]], model: str, max_tokens: int) -> str:
-        self.logger.warning("Using fallback response due to LLM microservice unavailability")
-        return f"LLM microservice is currently unavailable. Unable to process the query with model {model} and max_tokens {max_tokens}: {prompt[:100]}..."
+    async def evaluate_sufficiency(self, stage_name: str, stage_data: Dict[str, Any], project_state: Dict[str, Any],
+                                   timeout: Optional[float] = None) -> Dict[str, Any]:
+        self.logger.info(f"Evaluating sufficiency for stage: {stage_name}")
+        payload = _sufficiency_payload(stage_name, stage_data, project_state)
+        try:
+            result = await self._post("/evaluate_sufficiency", payload, timeout)
+            self.logger.debug(f"Sufficiency evaluation response: {result}")
+            return result
+        except (httpx.HTTPError, ValueError) as e:
+            self.logger.error(f"Error evaluating sufficiency: {str(e)}")
+            return _fallback_sufficiency_evaluation(self.logger)
 
-    def query(self, prompt: str, context: Optional[Dict[str, Any]] = None, model: str = 'gpt-3.5-turbo', max_tokens: int = 500) -> str:
+    async def query_many(self, queries: Sequence[QueryItem], timeout: Optional[float] = None,
+                         batch_size: int = DEFAULT_BATCH_SIZE) -> List[str]:
+        """Responses to many queries, in order, sent as NDJSON batches of up to `batch_size`.
+
+        Entries the batch could not answer are retried individually, concurrently over the
+        pool, and fall back like query(); so does every entry if the service has no batch
+        endpoint.
+        """
+        queries = [_query_kwargs(query) for query in queries]
+        self.logger.info(f"Querying LLM microservice with {len(queries)} prompts in batches of {batch_size}")
+        results = await self._post_many("/query_batch", [_query_payload(**query) for query in queries], timeout, batch_size)
+        retry = [index for index, result in enumerate(results) if not _is_query_result(result)]
+        retried = await asyncio.gather(*(self.query(**queries[index], timeout=timeout) for index in retry))
+        responses = [result["response"] if _is_query_result(result) else None for result in results]
+        for index, response in zip(retry, retried):
+            responses[index] = response
+        return responses
+
+    async def evaluate_sufficiency_many(self, evaluations: Sequence[SufficiencyItem], timeout: Optional[float] = None,
+                                        batch_size: int = DEFAULT_BATCH_SIZE) -> List[Dict[str, Any]]:
+        """Sufficiency evaluations of many stages, in order, batched and retried like query_many()."""
+        self.logger.info(f"Evaluating sufficiency for {len(evaluations)} stages in batches of {batch_size}")
+        results = await self._post_many("/evaluate_sufficiency_batch",
+                                        [_sufficiency_payload(*evaluation) for evaluation in evaluations], timeout, batch_size)
+        retry = [index for index, result in enumerate(results) if not _is_sufficiency_result(result)]
+        retried = await asyncio.gather(*(self.evaluate_sufficiency(*evaluations[index], timeout=timeout) for index in retry))
+        for index, result in zip(retry, retried):
+            results[index] = result
+        return results
+
+    async def _post(self, path: str, payload: Dict[str, Any], timeout: Optional[float]) -> Dict[str, Any]:
+        async with self._slots:
+            response = await self.client.post(path, json=payload, timeout=self.timeout if timeout is None else timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def _post_many(self, path: str, payloads: List[Dict[str, Any]], timeout: Optional[float],
+                         batch_size: int) -> List[Optional[Dict[str, Any]]]:
+        results: List[Optional[Dict[str, Any]]] = [None] * len(payloads)
+        await asyncio.gather(*(self._stream_batch(path, payloads, start, min(start + batch_size, len(payloads)), timeout, results)
+                               for start in range(0, len(payloads), batch_size)))
+        return results
+
+    async def _stream_batch(self, path: str, payloads: List[Dict[str, Any]], start: int, end: int,
+                            timeout: Optional[float], results: List[Optional[Dict[str, Any]]]) -> None:
+        """Send payloads[start:end] as one NDJSON request, filling `results` as result lines stream back."""
+        try:
+            async with self._slots:
+                async with self.client.stream("POST", path, content=_ndjson_body(payloads, start, end),
+                                              headers={'Content-Type': NDJSON_CONTENT_TYPE},
+                                              timeout=self.timeout if timeout is None else timeout) as response:
+                    if response.is_error:
+                        # Read the error body so the connection goes back to the pool.
+                        await response.aread()
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        _store_batch_result(line, start, end, results)
+        except (httpx.HTTPError, ValueError) as e:
+            self.logger.warning(f"Batch request to {path} failed, sending its unanswered entries individually: {str(e)}")
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self) -> 'AsyncLLMMicroserviceClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+class LLMMicroserviceClient:
+    """Blocking client for the LLM microservice, for callers outside the event loop.
+
+    Mirrors AsyncLLMMicroserviceClient with a pooled httpx.Client, so sequential calls reuse
+    a kept-alive connection. The client is safe to share between threads. Async code should
+    use AsyncLLMMicroserviceClient instead, since these calls block.
+    """
+
+    def __init__(self, base_url: str = "http://localhost:5000", max_connections: int = 20,
+                 max_keepalive_connections: int = 10, timeout: float = 10.0, http2: Optional[bool] = None):
+        self.base_url = base_url
+        self.logger = logging.getLogger(__name__)
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.http2 = HTTP2_AVAILABLE if http2 is None else http2
+        self._client: Optional[httpx.Client] = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = httpx.Client(base_url=self.base_url, limits=self.limits,
+                                                timeout=self.timeout, http2=self.http2)
+        return self._client
+
+    def query(self, prompt: str, context: Optional[Dict[str, Any]] = None, model: str = 'gpt-3.5-turbo',
+              max_tokens: int = 500, timeout: Optional[float] = None) -> str:
         self.logger.info(f"Querying LLM microservice with model: {model}, max_tokens: {max_tokens}")
-        endpoint = f"{self.base_url}/query"
-        payload = {
-            "prompt": prompt,
-            "context": context or {},
-            "model": model,
-            "max_tokens": max_tokens
-        }
+        payload = _query_payload(prompt, context, model, max_tokens)
         try:
-            response = requests.post(endpoint, json=payload, timeout=10)
-            response.raise_for_status()
-            result = response.json()
+            result = self._post("/query", payload, timeout)
             self.logger.debug(f"LLM microservice response: {result}")
             return result["response"]
-        except requests.RequestException as e:
+        except (httpx.HTTPError, ValueError, KeyError) as e:
             self.logger.error(f"Error querying LLM microservice: {str(e)}")
-            return self._fallback_response(prompt, context, model, max_tokens)
+            return _fallback_response(self.logger, prompt, model, max_tokens)
 
-    def evaluate_sufficiency(self, stage_name: str, stage_data: Dict[str, Any], project_state: Dict[str, Any]) -> Dict[str, Any]:
+    def evaluate_sufficiency(self, stage_name: str, stage_data: Dict[str, Any], project_state: Dict[str, Any],
+                             timeout: Optional[float] = None) -> Dict[str, Any]:
         self.logger.info(f"Evaluating sufficiency for stage: {stage_name}")
-        endpoint = f"{self.base_url}/evaluate_sufficiency"
-        payload = {
-            "stage_name": stage_name,
-            "stage_data": stage_data,
-            "project_state": project_state
-        }
+        payload = _sufficiency_payload(stage_name, stage_data, project_state)
         try:
-            response = requests.post(endpoint, json=payload, timeout=10)
-            response.raise_for_status()
-            result = response.json()
+            result = self._post("/evaluate_sufficiency", payload, timeout)
             self.logger.debug(f"Sufficiency evaluation response: {result}")
             return result
-        except requests.RequestException as e:
+        except (httpx.HTTPError, ValueError) as e:
             self.logger.error(f"Error evaluating sufficiency: {str(e)}")
-            return self._fallback_sufficiency_evaluation(stage_name, stage_data, project_state)
-
-    def _fallback_response(self, prompt: str, context: Optional[Dict[str, Any]], tier: str) -> str:
-        self.logger.warning("Using fallback response due to LLM microservice unavailability")
-        return f"LLM microservice is currently unavailable. Unable to process the query: {prompt[:100]}..."
-
-    def _fallback_sufficiency_evaluation(self, stage_name: str, stage_data: Dict[str, Any], project_state: Dict[str, Any]) -> Dict[str, Any]:
-        self.logger.warning("Using fallback sufficiency evaluation due to LLM microservice unavailability")
-        return {
-            "is_sufficient": True,
-            "reasoning": "LLM microservice is unavailable. Assuming stage is sufficient to proceed."
-        }
+            return _fallback_sufficiency_evaluation(self.logger)
+
+    def query_many(self, queries: Sequence[QueryItem], timeout: Optional[float] = None,
+                   batch_size: int = DEFAULT_BATCH_SIZE) -> List[str]:
+        """Blocking counterpart of AsyncLLMMicroserviceClient.query_many(); entries the
+        batches could not answer are retried one after another."""
+        queries = [_query_kwargs(query) for query in queries]
+        self.logger.info(f"Querying LLM microservice with {len(queries)} prompts in batches of {batch_size}")
+        results = self._post_many("/query_batch", [_query_payload(**query) for query in queries], timeout, batch_size)
+        return [result["response"] if _is_query_result(result) else self.query(**query, timeout=timeout)
+                for query, result in zip(queries, results)]
+
+    def evaluate_sufficiency_many(self, evaluations: Sequence[SufficiencyItem], timeout: Optional[float] = None,
+                                  batch_size: int = DEFAULT_BATCH_SIZE) -> List[Dict[str, Any]]:
+        """Blocking counterpart of AsyncLLMMicroserviceClient.evaluate_sufficiency_many()."""
+        self.logger.info(f"Evaluating sufficiency for {len(evaluations)} stages in batches of {batch_size}")
+        results = self._post_many("/evaluate_sufficiency_batch",
+                                  [_sufficiency_payload(*evaluation) for evaluation in evaluations], timeout, batch_size)
+        return [result if _is_sufficiency_result(result) else self.evaluate_sufficiency(*evaluation, timeout=timeout)
+                for evaluation, result in zip(evaluations, results)]
+
+    def _post(self, path: str, payload: Dict[str, Any], timeout: Optional[float]) -> Dict[str, Any]:
+        response = self.client.post(path, json=payload, timeout=self.timeout if timeout is None else timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def _post_many(self, path: str, payloads: List[Dict[str, Any]], timeout: Optional[float],
+                   batch_size: int) -> List[Optional[Dict[str, Any]]]:
+        results: List[Optional[Dict[str, Any]]] = [None] * len(payloads)
+        for start in range(0, len(payloads), batch_size):
+            end = min(start + batch_size, len(payloads))
+            try:
+                with self.client.stream("POST", path, content=_ndjson_body(payloads, start, end),
+                                        headers={'Content-Type': NDJSON_CONTENT_TYPE},
+                                        timeout=self.timeout if timeout is None else timeout) as response:
+                    if response.is_error:
+                        response.read()
+                    response.raise_for_status()
+                    for line in response.iter_lines():
+                        _store_batch_result(line, start, end, results)
+            except (httpx.HTTPError, ValueError) as e:
+                self.logger.warning(f"Batch request to {path} failed, sending its unanswered entries individually: {str(e)}")
+        return results
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def __enter__(self) -> 'LLMMicroserviceClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def _query_payload(prompt: str, context: Optional[Dict[str, Any]] = None, model: str = 'gpt-3.5-turbo',
+                   max_tokens: int = 500) -> Dict[str, Any]:
+    return {
+        "prompt": prompt,
+        "context": context or {},
+        "model": model,
+        "max_tokens": max_tokens
+    }
+
+def _sufficiency_payload(stage_name: str, stage_data: Dict[str, Any], project_state: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "stage_name": stage_name,
+        "stage_data": stage_data,
+        "project_state": project_state
+    }
+
+def _query_kwargs(query: QueryItem) -> Dict[str, Any]:
+    return {'prompt': query} if isinstance(query, str) else dict(query)
+
+def _ndjson_body(payloads: List[Dict[str, Any]], start: int, end: int) -> bytes:
+    return ''.join(json.dumps({'id': index - start, **payloads[index]}) + '\n' for index in range(start, end)).encode('utf-8')
+
+def _store_batch_result(line: str, start: int, end: int, results: List[Optional[Dict[str, Any]]]) -> None:
+    """Store one streamed result line of the batch covering results[start:end]; lines with an
+    unknown id are ignored and leave their entry to be retried."""
+    if not line.strip():
+        return
+    result = json.loads(line)
+    index = result.pop('id', None) if isinstance(result, dict) else None
+    if isinstance(index, int) and 0 <= index < end - start:
+        results[start + index] = result
+
+def _is_query_result(result: Optional[Dict[str, Any]]) -> bool:
+    return result is not None and 'error' not in result and isinstance(result.get('response'), str)
+
+def _is_sufficiency_result(result: Optional[Dict[str, Any]]) -> bool:
+    return result is not None and 'error' not in result and 'is_sufficient' in result
+
+def _fallback_response(logger: logging.Logger, prompt: str, model: str, max_tokens: int) -> str:
+    logger.warning("Using fallback response due to LLM microservice unavailability")
+    return f"LLM microservice is currently unavailable. Unable to process the query with model {model} and max_tokens {max_tokens}: {prompt[:100]}..."
+
+def _fallback_sufficiency_evaluation(logger: logging.Logger) -> Dict[str, Any]:
+    logger.warning("Using fallback sufficiency evaluation due to LLM microservice unavailability")
+    return {
+        "is_sufficient": True,
+        "reasoning": "LLM microservice is unavailable. Assuming stage is sufficient to proceed."
+    }
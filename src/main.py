@@ -1,3 +1,4 @@
+import asyncio
 import click
 import sys
 import os
@@ -40,7 +41,7 @@ def run(config):
 def report(config, format):
     """Generate a comprehensive project state report"""
     director = WorkflowDirector(config_path=config)
-    report = director.generate_project_report(format)
+    report = asyncio.run(director.generate_project_report(format))
     click.echo(report)
 
 @cli.command()
@@ -80,8 +81,6 @@ def transition(config, stage_name):
     else:
         click.echo(f"Failed to transition to stage: {stage_name}")
 
-import asyncio
-
 async def main():
     director = WorkflowDirector(config_path='src/workflow_config.yaml')
     await director.run()
@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import time
 import logging
 import uuid
@@ -7,6 +8,7 @@ from typing import Dict, Any, List, AsyncGenerator
 from unittest.mock import MagicMock
 from anthropic import APIStatusError
 from src.exceptions import CustomRateLimitError
+from src.tokenizer import get_token_counter
 from functools import lru_cache, wraps
 from datetime import datetime, timedelta
 
@@ -74,8 +76,7 @@ class MockClaudeClient:
 
     async def count_tokens(self, text: str) -> int:
         self.logger.debug(f"Counting tokens for text: {text[:50]}...")
-        # Simplified token counting for mock purposes
-        token_count = len(text.split())
+        token_count = get_token_counter().count(text)
         self.logger.debug(f"Token count: {token_count}")
         return token_count
 
@@ -465,8 +466,7 @@ class MockClaudeClient:
 
     @timed_lru_cache(seconds=300)
     async def count_tokens(self, text: str) -> int:
-        # Simplified token counting for mock purposes
-        token_count = len(text.split())
+        token_count = get_token_counter().count(text)
         self.logger.debug(f"Counted {token_count} tokens for text: {text[:50]}...")
         return token_count
 
@@ -877,8 +877,7 @@ class MockClaudeClient:
         self.logger.debug(f"Finished resetting MockClaudeClient {id(self)}")
 
     async def count_tokens(self, text: str) -> int:
-        # Simplified token counting for mock purposes
-        token_count = len(text.split())
+        token_count = get_token_counter().count(text)
         self.logger.debug(f"Token count for text: {token_count}")
         return token_count
 
@@ -1743,8 +1742,7 @@ class MockClaudeClient:
         self.logger.debug("MockClaudeClient reset complete")
 
     async def count_tokens(self, text: str) -> int:
-        # Simplified token counting for mock purposes
-        token_count = len(text.split())
+        token_count = get_token_counter().count(text)
         self.logger.debug(f"Token count for text: {token_count}")
         return token_count
 
@@ -1938,8 +1936,7 @@ class MockClaudeClient:
         self.logger.debug("MockClaudeClient reset complete")
 
     async def count_tokens(self, text: str) -> int:
-        # Simplified token counting for mock purposes
-        token_count = len(text.split())
+        token_count = get_token_counter().count(text)
         self.logger.debug(f"Token count for text: {token_count}")
         return token_count
 
@@ -1958,6 +1955,17 @@ import logging
 from typing import Dict, Any, List
 import uuid
 
+# Per-million-token prices in USD, keyed by model family. Writing a prompt prefix to the
+# cache costs 1.25x the input price and reading it back costs 0.1x.
+MODEL_PRICING = {
+    'haiku': {'input': 0.25, 'output': 1.25},
+    'sonnet': {'input': 3.0, 'output': 15.0},
+    'opus': {'input': 15.0, 'output': 75.0},
+}
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+PROMPT_CACHE_TTL = 300
+
 class MockClaudeClient:
     class Messages:
         def __init__(self, client):
@@ -1989,6 +1997,8 @@ class MockClaudeClient:
         self.context = []
         self.is_shakespearean = False
         self.cache = TTLCache(maxsize=cache_maxsize, ttl=cache_ttl)
+        self.prompt_cache = TTLCache(maxsize=cache_maxsize, ttl=PROMPT_CACHE_TTL)
+        self.error_count = 0
         self.logger.info(f"MockClaudeClient initialized with rate_limit_threshold: {self.rate_limit_threshold}, rate_limit_reset_time: {self.rate_limit_reset_time}, cache_ttl: {cache_ttl}, cache_maxsize: {cache_maxsize}")
         
         # Add a file handler for persistent logging
@@ -2157,11 +2167,13 @@ class MockClaudeClient:
             self.client = client
             self.client.logger.debug("Messages inner class initialized")
 
-        async def create(self, model: str, max_tokens: int, messages: List[Dict[str, str]], stream: bool = False) -> Dict[str, Any]:
+        async def create(self, model: str, max_tokens: int, messages: List[Dict[str, str]], stream: bool = False,
+                         system: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
             self.client.logger.debug(f"Creating message with model: {model}, max_tokens: {max_tokens}, stream: {stream}")
-            return await self.client.create_message(messages[-1]['content'], max_tokens, model, stream)
+            return await self.client.create_message(messages[-1]['content'], max_tokens, model, stream, system=system)
 
-    async def create_message(self, prompt: str, max_tokens: int = 1000, model: str = 'claude-3-opus-20240229', stream: bool = False) -> Dict[str, Any]:
+    async def create_message(self, prompt: str, max_tokens: int = 1000, model: str = 'claude-3-opus-20240229', stream: bool = False,
+                             system: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
         self.logger.info(f"Creating message with prompt: {prompt[:50]}..., stream: {stream}, model: {model}, max_tokens: {max_tokens}")
         async with self.lock:
             with self.thread_lock:
@@ -2202,8 +2214,8 @@ class MockClaudeClient:
                     'stop_reason': 'end_turn',
                     'stop_sequence': None,
                     'usage': {
-                        'input_tokens': len(prompt.split()),
-                        'output_tokens': len(response_text.split())
+                        **self._prompt_cache_usage(system, get_token_counter().count(prompt)),
+                        'output_tokens': get_token_counter().count(response_text)
                     }
                 }
                 self._messages.append(mock_response)
@@ -2214,6 +2226,7 @@ class MockClaudeClient:
                 
                 if stream:
                     async def response_generator():
+                        yield {'type': 'message_start', 'message': {**mock_response, 'content': []}}
                         for word in response_text.split():
                             yield {'type': 'content_block_delta', 'delta': {'type': 'text', 'text': word + ' '}}
                         yield {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}}
@@ -2223,8 +2236,44 @@ class MockClaudeClient:
                     self.logger.debug("Returning non-streaming response")
                     return mock_response
 
+    def _prompt_cache_usage(self, system: Optional[List[Dict[str, Any]]], prompt_tokens: int) -> Dict[str, int]:
+        """Input token usage of a request, split the way the API reports prompt caching.
+
+        Every system block carrying cache_control ends a cacheable prefix. The longest prefix
+        cached by an earlier request within PROMPT_CACHE_TTL is read from the cache, the rest
+        of the last marked prefix is written to it, and everything after is plain input.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        total = prompt_tokens
+        prefixes = []
+        for block in system or []:
+            digest.update(block.get('text', '').encode('utf-8') + b'\x1f')
+            total += get_token_counter().count(block.get('text', ''))
+            if block.get('cache_control'):
+                prefixes.append((digest.hexdigest(), total - prompt_tokens))
+        read = max((tokens for key, tokens in prefixes if key in self.prompt_cache), default=0)
+        written = prefixes[-1][1] - read if prefixes else 0
+        for key, tokens in prefixes:
+            self.prompt_cache[key] = tokens
+        return {
+            'input_tokens': total - read - written,
+            'cache_creation_input_tokens': written,
+            'cache_read_input_tokens': read
+        }
+
+    def calculate_cost(self, model: str, usage: Dict[str, int]) -> float:
+        """Price in USD of a response's usage, with cache writes and reads billed at their own rates."""
+        family = next((name for name in MODEL_PRICING if name in model), None)
+        if family is None:
+            raise ValueError(f"No pricing for model: {model}")
+        pricing = MODEL_PRICING[family]
+        input_cost = (usage.get('input_tokens', 0)
+                      + usage.get('cache_creation_input_tokens', 0) * CACHE_WRITE_MULTIPLIER
+                      + usage.get('cache_read_input_tokens', 0) * CACHE_READ_MULTIPLIER) * pricing['input']
+        return (input_cost + usage.get('output_tokens', 0) * pricing['output']) / 1_000_000
+
     async def count_tokens(self, text: str) -> int:
-        token_count = len(text.split())
+        token_count = get_token_counter().count(text)
         self.logger.debug(f"Counted {token_count} tokens for text: {text[:50]}...")
         return token_count
 
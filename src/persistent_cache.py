@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+class PersistentCache:
+    """SQLite-backed response cache shared by every process on the host.
+
+    Entries are keyed on a SHA-256 digest of the in-memory cache key, expire after a TTL
+    and are pruned least-recently-used first once the store exceeds its size limits. The
+    database runs in WAL mode with a busy timeout so concurrent CLI invocations and
+    director workers can read and write it at the same time.
+
+    Reads do not write: the access times of hits are kept in memory and written in one batch
+    with the next write, prune or close, before they are needed to order evictions.
+    """
+
+    def __init__(self, path: str = '.llm_cache/responses.sqlite3', default_ttl: int = 86400,
+                 max_bytes: Optional[int] = 100 * 1024 * 1024, max_entries: Optional[int] = None,
+                 prune_interval: int = 32):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self._writes_since_prune = 0
+        # Digest -> last access time of entries read since the last flush.
+        self._accessed: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_expires_at ON responses(expires_at)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self.logger.info(f"PersistentCache initialized at {path} with default_ttl={default_ttl}, max_bytes={max_bytes}, max_entries={max_entries}")
+
+    @staticmethod
+    def hash_key(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        digest = self.hash_key(key)
+        now = time.time()
+        try:
+            with self._lock:
+                row = self.connection.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (digest,)
+                ).fetchone()
+                if row is None:
+                    return None
+                value, expires_at = row
+                if expires_at <= now:
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (digest,))
+                    self.logger.debug(f"Persistent cache entry {digest[:12]} expired")
+                    return None
+                self._accessed[digest] = now
+            return json.loads(value)
+        except (sqlite3.Error, ValueError) as e:
+            self.logger.error(f"Error reading persistent cache: {str(e)}")
+            return None
+
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[int] = None) -> None:
+        digest = self.hash_key(key)
+        now = time.time()
+        try:
+            payload = json.dumps(value, default=str)
+            with self._lock:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, created_at, expires_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (digest, payload, len(payload), now, now + (ttl or self.default_ttl), now)
+                )
+                self._accessed.pop(digest, None)
+                self._flush_accesses()
+                self._writes_since_prune += 1
+                if self._writes_since_prune >= self.prune_interval:
+                    self._prune(now)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self.logger.error(f"Error writing persistent cache: {str(e)}")
+
+    def prune(self) -> None:
+        try:
+            with self._lock:
+                self._prune(time.time())
+        except sqlite3.Error as e:
+            self.logger.error(f"Error pruning persistent cache: {str(e)}")
+
+    def _flush_accesses(self) -> None:
+        if not self._accessed:
+            return
+        accessed = [(last_access, digest) for digest, last_access in self._accessed.items()]
+        self._accessed.clear()
+        self.connection.executemany("UPDATE responses SET last_access = ? WHERE key = ?", accessed)
+
+    def _prune(self, now: float) -> None:
+        self._writes_since_prune = 0
+        self._flush_accesses()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            expired = self.connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+            count, total_bytes = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            excess_entries = count - self.max_entries if self.max_entries else 0
+            excess_bytes = total_bytes - self.max_bytes if self.max_bytes else 0
+            evicted = 0
+            if excess_entries > 0 or excess_bytes > 0:
+                victims = []
+                cursor = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access")
+                for digest, size in cursor:
+                    if excess_entries <= 0 and excess_bytes <= 0:
+                        break
+                    victims.append((digest,))
+                    excess_entries -= 1
+                    excess_bytes -= size
+                cursor.close()
+                self.connection.executemany("DELETE FROM responses WHERE key = ?", victims)
+                evicted = len(victims)
+            self.connection.execute("COMMIT")
+        except sqlite3.Error:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.logger.debug(f"Pruned persistent cache: {expired} expired, {evicted} evicted over size limits")
+
+    def size(self) -> int:
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self) -> None:
+        try:
+            with self._lock:
+                self._accessed.clear()
+                self.connection.execute("DELETE FROM responses")
+            self.logger.info("Persistent cache cleared")
+        except sqlite3.Error as e:
+            self.logger.error(f"Error clearing persistent cache: {str(e)}")
+
+    def close(self) -> None:
+        try:
+            with self._lock:
+                self._flush_accesses()
+        except sqlite3.Error as e:
+            self.logger.error(f"Error recording persistent cache accesses: {str(e)}")
+        self.connection.close()
@@ -1,16 +1,24 @@
+import asyncio
 import logging
 from typing import List, Tuple, Dict, Any
 from .documentation_health_checker import DocumentationHealthChecker
 
 class ProjectStateReporter:
-    def __init__(self, workflow_director):
+    def __init__(self, workflow_director, section_timeout: float = 60.0):
         self.workflow_director = workflow_director
         self.logger = logging.getLogger(__name__)
         self.doc_health_checker = DocumentationHealthChecker()
+        self.section_timeout = section_timeout
 
-    def generate_report(self, format: str = 'plain') -> str:
+    async def generate_report(self, format: str = 'plain') -> str:
         """
         Generate a comprehensive project state report.
+
+        The sections written by the LLM are independent of each other, so they are queried
+        concurrently (paced by the LLM manager's shared rate limiter, as background work
+        behind interactive queries) while the local sections are computed in a worker thread.
+        A section that fails or takes longer than `section_timeout` seconds is replaced by a
+        short notice instead of failing the whole report.
         
         Args:
             format (str): The output format of the report. Options: 'plain', 'markdown', 'html'
@@ -19,18 +27,36 @@ class ProjectStateReporter:
             str: The formatted project state report
         """
         self.logger.info(f"Generating project state report in {format} format")
-        
-        report_sections = [
+        if format not in ('plain', 'markdown', 'html'):
+            raise ValueError(f"Unsupported format: {format}")
+
+        llm_sections = asyncio.gather(
             self._generate_project_summary(),
-            self._generate_current_stage_info(),
-            self._generate_completed_stages_info(),
             self._generate_requirements_summary(),
             self._generate_domain_model_summary(),
-            self._generate_documentation_health(),
-            self._generate_quantitative_metrics(),
             self._generate_next_steps(),
-            self._generate_risk_assessment(),
-            self._generate_workflow_visualization()
+            self._generate_risk_assessment()
+        )
+        try:
+            (current_stage_info, completed_stages_info, documentation_health, quantitative_metrics,
+             workflow_visualization) = await asyncio.to_thread(self._generate_local_sections)
+        except BaseException:
+            llm_sections.cancel()
+            await asyncio.gather(llm_sections, return_exceptions=True)
+            raise
+        project_summary, requirements_summary, domain_model_summary, next_steps, risk_assessment = await llm_sections
+
+        report_sections = [
+            project_summary,
+            current_stage_info,
+            completed_stages_info,
+            requirements_summary,
+            domain_model_summary,
+            documentation_health,
+            quantitative_metrics,
+            next_steps,
+            risk_assessment,
+            workflow_visualization
         ]
         
         if format == 'plain':
@@ -42,6 +68,15 @@ class ProjectStateReporter:
         else:
             raise ValueError(f"Unsupported format: {format}")
 
+    def _generate_local_sections(self) -> Tuple[Tuple[str, str], ...]:
+        return (
+            self._generate_current_stage_info(),
+            self._generate_completed_stages_info(),
+            self._generate_documentation_health(),
+            self._generate_quantitative_metrics(),
+            self._generate_workflow_visualization()
+        )
+
     def _generate_workflow_visualization(self) -> Tuple[str, str]:
         self.logger.info("Generating workflow visualization")
         stages = self.workflow_director.stages
@@ -63,7 +98,21 @@ class ProjectStateReporter:
 
         return ("Workflow Visualization", visualization)
 
-    def _generate_project_summary(self) -> Tuple[str, str]:
+    async def _generate_llm_section(self, title: str, prompt: str, context: Dict[str, Any]) -> Tuple[str, str]:
+        try:
+            query = self.workflow_director.llm_manager.query(prompt, context, priority='background', deadline=self.section_timeout)
+            result = await asyncio.wait_for(query, self.section_timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Report section '{title}' timed out after {self.section_timeout:g} seconds")
+            return (title, f"Unavailable: no response from the LLM within {self.section_timeout:g} seconds.")
+        except Exception as e:
+            self.logger.error(f"Error generating report section '{title}': {str(e)}")
+            return (title, f"Unavailable: {str(e)}")
+        if isinstance(result, dict):
+            result = result.get('response', '')
+        return (title, str(result))
+
+    async def _generate_project_summary(self) -> Tuple[str, str]:
         project_state = self.workflow_director.state_manager.get_all()
         context = {
             "project_name": project_state.get("project_name", "Unnamed Project"),
@@ -72,8 +121,7 @@ class ProjectStateReporter:
             "total_stages": len(self.workflow_director.stages)
         }
         summary_prompt = "Generate a brief summary of the project based on the provided context. Include the project name, current stage, and overall progress."
-        summary = self.workflow_director.llm_manager.query(summary_prompt, context)
-        return ("Project Summary", summary)
+        return await self._generate_llm_section("Project Summary", summary_prompt, context)
 
     def _generate_current_stage_info(self) -> Tuple[str, str]:
         current_stage = self.workflow_director.get_current_stage()
@@ -86,19 +134,17 @@ class ProjectStateReporter:
         completed_stages = list(self.workflow_director.completed_stages)
         return ("Completed Stages", ", ".join(completed_stages))
 
-    def _generate_requirements_summary(self) -> Tuple[str, str]:
+    async def _generate_requirements_summary(self) -> Tuple[str, str]:
         requirements = self.workflow_director.state_manager.get('requirements', 'No requirements defined')
         context = {"requirements": requirements}
         summary_prompt = "Summarize the project requirements, highlighting key functional and non-functional requirements. If no requirements are defined, suggest next steps for requirements gathering."
-        summary = self.workflow_director.llm_manager.query(summary_prompt, context)
-        return ("Requirements Summary", summary)
+        return await self._generate_llm_section("Requirements Summary", summary_prompt, context)
 
-    def _generate_domain_model_summary(self) -> Tuple[str, str]:
+    async def _generate_domain_model_summary(self) -> Tuple[str, str]:
         domain_model = self.workflow_director.state_manager.get('domain_model', 'No domain model defined')
         context = {"domain_model": domain_model}
         summary_prompt = "Provide a brief overview of the domain model, including key entities and their relationships. If no domain model is defined, suggest steps to start creating one."
-        summary = self.workflow_director.llm_manager.query(summary_prompt, context)
-        return ("Domain Model Overview", summary)
+        return await self._generate_llm_section("Domain Model Overview", summary_prompt, context)
 
     def _generate_documentation_health(self) -> Tuple[str, str]:
         doc_health = self.doc_health_checker.assess_documentation_health(self.workflow_director.state_manager)
@@ -116,21 +162,19 @@ class ProjectStateReporter:
         ]
         return ("Quantitative Metrics", "\n".join(metrics))
 
-    def _generate_next_steps(self) -> Tuple[str, str]:
+    async def _generate_next_steps(self) -> Tuple[str, str]:
         context = {
             "current_stage": self.workflow_director.current_stage,
             "completed_stages": list(self.workflow_director.completed_stages),
             "remaining_stages": [stage for stage in self.workflow_director.stages if stage not in self.workflow_director.completed_stages]
         }
         next_steps_prompt = "Based on the current project state, suggest the next 3-5 steps to move the project forward. Consider the current stage, completed stages, and remaining stages."
-        next_steps = self.workflow_director.llm_manager.query(next_steps_prompt, context)
-        return ("Next Steps", next_steps)
+        return await self._generate_llm_section("Next Steps", next_steps_prompt, context)
 
-    def _generate_risk_assessment(self) -> Tuple[str, str]:
+    async def _generate_risk_assessment(self) -> Tuple[str, str]:
         context = self.workflow_director.state_manager.get_all()
         risk_prompt = "Based on the current project state, identify potential risks and challenges. Suggest mitigation strategies for each identified risk."
-        risk_assessment = self.workflow_director.llm_manager.query(risk_prompt, context)
-        return ("Risk Assessment", risk_assessment)
+        return await self._generate_llm_section("Risk Assessment", risk_prompt, context)
 
     def _format_plain(self, sections: List[Tuple[str, str]]) -> str:
         report = ["LLM-Workflow Director Project Report", "======================================"]
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+from src.tokenizer import TokenCounter, get_token_counter
+
+@dataclass(frozen=True)
+class PromptSegment:
+    name: str
+    text: str
+    tokens: int
+
+class PromptSegmentCache:
+    """Remembers the last text and token count of every named prompt segment.
+
+    Prompts are rebuilt every turn from mostly unchanged blocks (conventions, project
+    structure, stage info, history entries). Looking a block up by name and comparing its
+    text skips tokenization entirely when the block is unchanged, so the counting cost of a
+    turn scales with the blocks that changed rather than with the size of the context.
+    """
+
+    def __init__(self, counter: Optional[TokenCounter] = None, max_entries: int = 512):
+        self.logger = logging.getLogger(__name__)
+        self.counter = counter or get_token_counter()
+        self.max_entries = max_entries
+        self._segments: 'OrderedDict[str, PromptSegment]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def segment(self, name: str, text: str) -> PromptSegment:
+        cached = self._segments.get(name)
+        if cached is not None and (cached.text is text or cached.text == text):
+            self._segments.move_to_end(name)
+            self.hits += 1
+            return cached
+        self.misses += 1
+        segment = PromptSegment(name, text, self.counter.count(text))
+        self._segments[name] = segment
+        self._segments.move_to_end(name)
+        if len(self._segments) > self.max_entries:
+            self._segments.popitem(last=False)
+        return segment
+
+    def prompt(self) -> 'SegmentedPrompt':
+        return SegmentedPrompt(self)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'segments': len(self._segments), 'hits': self.hits, 'misses': self.misses}
+
+class SegmentedPrompt:
+    """A prompt assembled from named segments, each carrying its cached token count.
+
+    The token count of the prompt is the sum of its segments. Segments are tokenized on
+    their own, so the sum can differ from counting the joined text by a token where
+    whitespace runs meet at a segment boundary.
+    """
+
+    def __init__(self, cache: PromptSegmentCache):
+        self.cache = cache
+        self.segments: List[PromptSegment] = []
+        self.breakpoints: List[int] = []
+
+    def add(self, name: str, text: str) -> 'SegmentedPrompt':
+        self.segments.append(self.cache.segment(name, text))
+        return self
+
+    def add_segment(self, segment: PromptSegment) -> 'SegmentedPrompt':
+        """Append a segment already counted by this prompt's cache."""
+        self.segments.append(segment)
+        return self
+
+    def __iter__(self) -> Iterator[PromptSegment]:
+        return iter(self.segments)
+
+    @property
+    def token_count(self) -> int:
+        return sum(segment.tokens for segment in self.segments)
+
+    def render(self) -> str:
+        """Join the segments and record the summed count for the joined text, so counting
+        the rendered prompt later is a digest lookup instead of a full tokenization."""
+        return self._join(self.segments)
+
+    def _join(self, segments: Sequence[PromptSegment]) -> str:
+        text = ''.join(segment.text for segment in segments)
+        self.cache.counter.remember(text, sum(segment.tokens for segment in segments))
+        return text
+
+    def cache_breakpoint(self) -> 'SegmentedPrompt':
+        """Mark the segments added so far as a prefix that stays the same across requests."""
+        if self.segments and (not self.breakpoints or self.breakpoints[-1] != len(self.segments)):
+            self.breakpoints.append(len(self.segments))
+        return self
+
+    def system_blocks(self) -> List[Dict[str, Any]]:
+        """The segments up to the last breakpoint as Messages API system blocks, one block per
+        breakpoint, each marked with cache_control so the provider caches the prefix ending there."""
+        blocks = []
+        start = 0
+        for end in self.breakpoints:
+            blocks.append({'type': 'text', 'text': self._join(self.segments[start:end]),
+                           'cache_control': {'type': 'ephemeral'}})
+            start = end
+        return blocks
+
+    def render_suffix(self) -> str:
+        """The segments after the last breakpoint, i.e. the part that changes every request."""
+        return self._join(self.segments[self.breakpoints[-1] if self.breakpoints else 0:])
+
+    def prefix_hashes(self) -> List[str]:
+        """A digest of the whole prefix ending at each breakpoint. Two requests whose digests
+        match send the same prefix, so the second can be served from the provider's cache."""
+        digest = hashlib.blake2b(digest_size=16)
+        hashes = []
+        start = 0
+        for end in self.breakpoints:
+            for segment in self.segments[start:end]:
+                digest.update(segment.text.encode('utf-8'))
+            digest.update(b'\x1f')
+            hashes.append(digest.hexdigest())
+            start = end
+        return hashes
+
+    def prefix_tokens(self) -> List[int]:
+        """Token count of the whole prefix ending at each breakpoint."""
+        return [sum(segment.tokens for segment in self.segments[:end]) for end in self.breakpoints]
+
+class PromptPrefixTracker:
+    """Tracks which cacheable prompt prefixes were sent recently, and so are likely cached.
+
+    Providers keep a cache_control prefix for a short time-to-live (five minutes for
+    'ephemeral'), refreshed whenever it is read. A prefix sent again within the TTL is
+    expected to be read from the cache; anything past the longest such prefix is written.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._last_used: 'OrderedDict[str, float]' = OrderedDict()
+        self.reads = 0
+        self.writes = 0
+        self.read_tokens = 0
+        self.write_tokens = 0
+
+    def is_warm(self, prefix_hash: str, now: Optional[float] = None) -> bool:
+        last_used = self._last_used.get(prefix_hash)
+        return last_used is not None and (time.time() if now is None else now) - last_used < self.ttl
+
+    def observe(self, hashes: Sequence[str], tokens: Sequence[int], now: Optional[float] = None) -> int:
+        """Record a request sending the prefixes `hashes` (with cumulative token counts
+        `tokens`), returning how many of its prefix tokens should be read from the cache."""
+        now = time.time() if now is None else now
+        read_tokens = 0
+        for prefix_hash, prefix_tokens in zip(hashes, tokens):
+            if self.is_warm(prefix_hash, now):
+                read_tokens = prefix_tokens
+        write_tokens = (tokens[-1] if tokens else 0) - read_tokens
+        if read_tokens:
+            self.reads += 1
+            self.read_tokens += read_tokens
+        if write_tokens:
+            self.writes += 1
+            self.write_tokens += write_tokens
+        for prefix_hash in hashes:
+            self._last_used[prefix_hash] = now
+            self._last_used.move_to_end(prefix_hash)
+        while len(self._last_used) > self.max_entries:
+            self._last_used.popitem(last=False)
+        return read_tokens
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'prefixes': len(self._last_used), 'reads': self.reads, 'writes': self.writes,
+                'read_tokens': self.read_tokens, 'write_tokens': self.write_tokens}
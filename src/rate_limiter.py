@@ -1,61 +1,519 @@
 import asyncio
+import os
+import sqlite3
+import struct
+import threading
 import time
 import logging
-from typing import Dict
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
 from src.domain_models import RateLimit, RateLimitPolicy
-from src.exceptions import CustomRateLimitError
+from src.exceptions import CustomRateLimitError, RateLimitError
+
+class GCRALimit:
+    """Generic cell rate algorithm enforcing `limit` permits per `period` seconds.
+
+    The state is a single theoretical arrival time, so the exact moment the next permit
+    becomes available can be computed instead of polled for.
+    """
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.emission_interval = period / limit
+        self.theoretical_arrival = 0.0
+
+    def delay(self, weight: int, now: float) -> float:
+        """Seconds until `weight` permits can be consumed (0 if they can be consumed now)."""
+        tat = max(self.theoretical_arrival, now)
+        return max(0.0, tat + weight * self.emission_interval - self.period - now)
+
+    def consume(self, weight: int, now: float) -> None:
+        self.theoretical_arrival = max(self.theoretical_arrival, now) + weight * self.emission_interval
+
+    def usage(self, now: float) -> float:
+        """Permits currently counted against the limit."""
+        return max(0.0, self.theoretical_arrival - now) / self.emission_interval
+
+    def get_state(self) -> bytes:
+        return struct.pack('d', self.theoretical_arrival)
+
+    def set_state(self, state: bytes) -> None:
+        self.theoretical_arrival = struct.unpack('d', state)[0]
+
+class SlidingWindowLimit:
+    """Exact sliding-log limit of `limit` permits in any window of `period` seconds.
+
+    The timestamps of the permits granted within the window live in a ring buffer with
+    one slot per permit, so memory is fixed at `limit` floats no matter how long the
+    process runs, and unlike fixed windows no burst can straddle a window boundary.
+    """
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._timestamps = array('d', [0.0]) * limit
+        self._head = 0  # Index of the oldest granted permit still in the window.
+        self._count = 0
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - self.period
+        while self._count and self._timestamps[self._head] <= cutoff:
+            self._head = (self._head + 1) % self.limit
+            self._count -= 1
+
+    def delay(self, weight: int, now: float) -> float:
+        """Seconds until `weight` permits can be consumed (0 if they can be consumed now)."""
+        self._expire(now)
+        excess = self._count + weight - self.limit
+        if excess <= 0:
+            return 0.0
+        # The permits can be granted once the `excess` oldest timestamps leave the window.
+        release_at = self._timestamps[(self._head + excess - 1) % self.limit] + self.period
+        return max(0.0, release_at - now)
+
+    def consume(self, weight: int, now: float) -> None:
+        self._expire(now)
+        for _ in range(weight):
+            self._timestamps[(self._head + self._count) % self.limit] = now
+            self._count += 1
+
+    def usage(self, now: float) -> float:
+        """Permits currently counted against the limit."""
+        self._expire(now)
+        return self._count
+
+    def get_state(self) -> bytes:
+        """The timestamps still in the window, oldest first."""
+        end = self._head + self._count
+        if end <= self.limit:
+            return self._timestamps[self._head:end].tobytes()
+        return (self._timestamps[self._head:] + self._timestamps[:end - self.limit]).tobytes()
+
+    def set_state(self, state: bytes) -> None:
+        timestamps = array('d')
+        timestamps.frombytes(state)
+        timestamps = timestamps[-self.limit:]
+        self._timestamps[:len(timestamps)] = timestamps
+        self._head = 0
+        self._count = len(timestamps)
+
+RATE_LIMIT_ALGORITHMS = {
+    'sliding_window': SlidingWindowLimit,
+    'gcra': GCRALimit
+}
+
+class SQLiteRateLimitBackend:
+    """Rate limit state shared by every process on the host through a SQLite file.
+
+    Each limit's state is stored as a blob under `name`, so all workers that use the same
+    file and name draw from one quota. Checking and consuming permits happens inside a
+    single `BEGIN IMMEDIATE` transaction, which serializes workers on the database's write
+    lock; state is keyed on the algorithm and limit, so changing the configuration starts
+    from a clean slate instead of misreading old state. Waiting on that lock can block for
+    up to the connection timeout, so RateLimiter runs try_consume in a worker thread.
+    """
+
+    def __init__(self, path: str = '.llm_cache/rate_limits.sqlite3', name: str = 'anthropic', timeout: float = 5.0):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.name = name
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, state BLOB NOT NULL)"
+        )
+        self.logger.info(f"SQLiteRateLimitBackend initialized at {path} for {name}")
+
+    def _key(self, limit: Union['SlidingWindowLimit', GCRALimit]) -> str:
+        return f"{self.name}:{type(limit).__name__}:{limit.limit}/{limit.period:g}"
+
+    def _load(self, limits: List[Union['SlidingWindowLimit', GCRALimit]]) -> None:
+        for limit in limits:
+            row = self.connection.execute(
+                "SELECT state FROM rate_limits WHERE key = ?", (self._key(limit),)
+            ).fetchone()
+            if row is not None:
+                limit.set_state(row[0])
+
+    def refresh(self, limits: List[Union['SlidingWindowLimit', GCRALimit]]) -> None:
+        """Load the shared state into `limits`.
+
+        Keeps the local state if a consume is in progress (it loads the shared state itself)
+        or the database cannot be read, so callers on the event loop never wait on the file.
+        """
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._load(limits)
+        except sqlite3.Error as e:
+            self.logger.warning(f"Could not read shared rate limit state, using local state: {str(e)}")
+        finally:
+            self._lock.release()
+
+    def try_consume(self, limits: List[Union['SlidingWindowLimit', GCRALimit]], weight: int, now: float) -> bool:
+        """Atomically consume `weight` permits from every limit if all of them allow it.
+
+        Raises:
+            RateLimitError: If the shared state could not be read or written, e.g. because
+                another process held the database lock for longer than the timeout.
+        """
+        with self._lock:
+            try:
+                self.connection.execute("BEGIN IMMEDIATE")
+                self._load(limits)
+                allowed = all(limit.delay(weight, now) <= 0 for limit in limits)
+                if allowed:
+                    for limit in limits:
+                        limit.consume(weight, now)
+                        self.connection.execute(
+                            "INSERT OR REPLACE INTO rate_limits (key, state) VALUES (?, ?)",
+                            (self._key(limit), limit.get_state())
+                        )
+                self.connection.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self.connection.in_transaction:
+                    self.connection.execute("ROLLBACK")
+                raise RateLimitError(f"Shared rate limit state at {self.path} unavailable: {str(e)}") from e
+        return allowed
+
+    def clear(self) -> None:
+        with self._lock:
+            self.connection.execute("DELETE FROM rate_limits WHERE key LIKE ?", (f"{self.name}:%",))
+
+    def close(self) -> None:
+        self.connection.close()
+
+RATE_LIMIT_BACKENDS = ('memory', 'sqlite')
 
 class RateLimiter(RateLimitPolicy):
-    def __init__(self, requests_per_minute: int, requests_per_hour: int):
+    def __init__(self, requests_per_minute: int, requests_per_hour: int, algorithm: str = 'sliding_window',
+                 backend: Optional[SQLiteRateLimitBackend] = None):
+        if algorithm not in RATE_LIMIT_ALGORITHMS:
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
         self.requests_per_minute = requests_per_minute
         self.requests_per_hour = requests_per_hour
-        self.minute_bucket: Dict[int, int] = {}
-        self.hour_bucket: Dict[int, int] = {}
-        self.last_reset_time = time.time()
-        self.lock = asyncio.Lock()
+        self.algorithm = algorithm
+        limit_class = RATE_LIMIT_ALGORITHMS[algorithm]
+        self.limits: List[Union[SlidingWindowLimit, GCRALimit]] = [
+            limit_class(requests_per_minute, 60),
+            limit_class(requests_per_hour, 3600)
+        ]
+        # FIFO queue of (weight, future) for callers waiting on permits, and the timer that
+        # fires when the permits for the head of the queue become available.
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._granting: Optional[asyncio.Task] = None
+        # Without a backend the limits live in this process only; with one, every process
+        # sharing the backend draws from the same quota.
+        self.backend = backend
         self.logger = logging.getLogger(__name__)
         self.logger.debug(f"RateLimiter initialized with {requests_per_minute} requests/minute and {requests_per_hour} requests/hour")
 
-    async def is_allowed(self) -> bool:
-        async with self.lock:
-            current_time = time.time()
-            await self._reset_if_needed(current_time)
-            current_minute = int(current_time / 60)
-            current_hour = int(current_time / 3600)
-        
-            minute_requests = self.minute_bucket.get(current_minute, 0)
-            hour_requests = self.hour_bucket.get(current_hour, 0)
-        
-            self.logger.debug(f"Current requests: minute={minute_requests}, hour={hour_requests}")
-        
-            if minute_requests >= self.requests_per_minute:
-                self.logger.warning("Rate limit reached (per minute)")
-                return False
-            if hour_requests >= self.requests_per_hour:
-                self.logger.warning("Rate limit reached (per hour)")
-                return False
-        
-            self.minute_bucket[current_minute] = minute_requests + 1
-            self.hour_bucket[current_hour] = hour_requests + 1
-            self.logger.debug(f"Request allowed. New counts: minute={self.minute_bucket[current_minute]}, hour={self.hour_bucket[current_hour]}")
+    async def is_allowed(self, weight: int = 1) -> bool:
+        """Consume `weight` permits if they are available right now and nobody is queued ahead."""
+        if self._waiters:
+            self.logger.debug(f"Request denied, {len(self._waiters)} waiters queued ahead")
+            return False
+        now = time.time()
+        if await self._consume(weight, now):
+            usage = ', '.join(f"{limit.usage(now):.1f}/{limit.limit} per {limit.period:g}s" for limit in self.limits)
+            self.logger.debug(f"Request allowed. Usage: {usage}")
             return True
+        self.logger.warning("Rate limit reached")
+        return False
+
+    def _refresh(self) -> None:
+        if self.backend is not None:
+            self.backend.refresh(self.limits)
+
+    def time_until_allowed(self, weight: int = 1) -> float:
+        self._refresh()
+        now = time.time()
+        return max(limit.delay(weight, now) for limit in self.limits)
 
-    async def _reset_if_needed(self, current_time):
-        if current_time - self.last_reset_time >= 60:
-            self.minute_bucket.clear()
-            self.last_reset_time = current_time
-            self.logger.debug("Minute bucket reset")
+    def get_usage(self) -> Dict[str, Any]:
+        """Current usage per limit and time to the next permit, for scheduling decisions."""
+        self._refresh()
+        now = time.time()
+        return {
+            'requests_this_minute': self.limits[0].usage(now),
+            'requests_this_hour': self.limits[1].usage(now),
+            'requests_per_minute': self.requests_per_minute,
+            'requests_per_hour': self.requests_per_hour,
+            'time_until_next_permit': max(limit.delay(1, now) for limit in self.limits),
+            'queued_waiters': len(self._waiters)
+        }
+
+    async def _consume(self, weight: int, now: float) -> bool:
+        if self.backend is not None:
+            return await asyncio.to_thread(self.backend.try_consume, self.limits, weight, now)
+        return self._try_consume(weight, now)
+
+    def _try_consume(self, weight: int, now: float) -> bool:
+        if any(limit.delay(weight, now) > 0 for limit in self.limits):
+            return False
+        for limit in self.limits:
+            limit.consume(weight, now)
+        return True
+
+    @classmethod
+    def from_limits(cls, requests_per_minute: int, requests_per_hour: int, algorithm: str = 'sliding_window'):
+        return cls(requests_per_minute, requests_per_hour, algorithm)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'RateLimiter':
+        """Build a limiter from the `rate_limits` section of llm_config.yaml."""
+        backend_name = config.get('backend', 'memory')
+        if backend_name not in RATE_LIMIT_BACKENDS:
+            raise ValueError(f"Unknown rate limit backend: {backend_name}")
+        backend = None
+        if backend_name == 'sqlite':
+            backend = SQLiteRateLimitBackend(
+                config.get('path', '.llm_cache/rate_limits.sqlite3'),
+                config.get('name', 'anthropic'),
+                config.get('timeout', 5.0)
+            )
+        return cls(
+            config.get('requests_per_minute', 1000),
+            config.get('requests_per_hour', 10000),
+            config.get('algorithm', 'sliding_window'),
+            backend
+        )
+
+    async def acquire(self, weight: int = 1, timeout: Optional[float] = 60) -> float:
+        """Wait until `weight` permits are granted, in FIFO order with other waiters.
+
+        Returns:
+            float: Seconds spent waiting.
+
+        Raises:
+            ValueError: If `weight` can never fit within the configured limits.
+            TimeoutError: If the permits were not granted within `timeout` seconds.
+            RateLimitError: If the shared backend could not be reached.
+        """
+        if weight < 1 or weight > min(limit.limit for limit in self.limits):
+            raise ValueError(f"Invalid permit weight {weight} for limits {self.requests_per_minute}/minute, {self.requests_per_hour}/hour")
+        if not self._waiters and await self._consume(weight, time.time()):
+            return 0.0
+
+        start_time = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((weight, future))
+        self._schedule_wakeup()
+        self.logger.debug(f"Queued for {weight} permits, {len(self._waiters)} waiters")
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Waited too long for the next available slot")
+        finally:
+            if not future.done() or future.cancelled():
+                self._schedule_wakeup()
+        return time.monotonic() - start_time
+
+    async def wait_for_next_slot(self, weight: int = 1, timeout: Optional[float] = 60) -> None:
+        await self.acquire(weight, timeout)
+
+    def _schedule_wakeup(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        while self._waiters and self._waiters[0][1].done():
+            self._waiters.popleft()
+        if self._waiters:
+            delay = self.time_until_allowed(self._waiters[0][0])
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._grant_waiters)
+
+    def _grant_waiters(self) -> None:
+        self._wakeup = None
+        if self.backend is not None:
+            if self._granting is None or self._granting.done():
+                self._granting = asyncio.get_running_loop().create_task(self._grant_shared_waiters())
+            return
+        now = time.time()
+        while self._waiters:
+            weight, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if not self._try_consume(weight, now):
+                break
+            self._waiters.popleft()
+            future.set_result(None)
+        self._schedule_wakeup()
+
+    async def _grant_shared_waiters(self) -> None:
+        """_grant_waiters for a shared backend, consuming in a worker thread."""
+        while self._waiters:
+            weight, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            try:
+                granted = await self._consume(weight, time.time())
+            except RateLimitError as e:
+                self._waiters.popleft()
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not granted:
+                break
+            self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+        self._schedule_wakeup()
+
+class TokenWindow:
+    """Sliding-window sum of the tokens charged in the last `period` seconds."""
+
+    def __init__(self, limit: int, period: float = 60):
+        self.limit = limit
+        self.period = period
+        # Entries are mutable [timestamp, tokens, active] lists so that a reservation can
+        # be settled in place; `active` turns False once the entry leaves the window.
+        self._entries: Deque[List[Any]] = deque()
+        self.total = 0
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - self.period
+        while self._entries and self._entries[0][0] <= cutoff:
+            entry = self._entries.popleft()
+            entry[2] = False
+            self.total -= entry[1]
+
+    def delay(self, tokens: int, now: float) -> float:
+        """Seconds until `tokens` fit within the window (0 if they fit now)."""
+        self._expire(now)
+        excess = self.total + tokens - self.limit
+        if excess <= 0:
+            return 0.0
+        freed = 0
+        for timestamp, amount, _ in self._entries:
+            freed += amount
+            if freed >= excess:
+                return max(0.0, timestamp + self.period - now)
+        return self.period
+
+    def charge(self, tokens: int, now: float) -> List[Any]:
+        self._expire(now)
+        entry = [now, tokens, True]
+        self._entries.append(entry)
+        self.total += tokens
+        return entry
+
+    def adjust(self, entry: List[Any], tokens: int) -> None:
+        if entry[2]:
+            self.total += tokens - entry[1]
+            entry[1] = tokens
+
+    def usage(self, now: float) -> int:
+        self._expire(now)
+        return self.total
+
+@dataclass
+class TokenReservation:
+    model: str
+    input_tokens: int
+    output_tokens: int
+    input_entry: Optional[List[Any]] = None
+    output_entry: Optional[List[Any]] = None
+    settled: bool = False
+
+class TokenBudgetLimiter:
+    """Per-model input/output tokens-per-minute budgets.
+
+    Callers reserve their estimated input tokens plus the maximum output tokens before a
+    request leaves the process, and settle the reservation with the actual usage once the
+    response arrives. Requests that would overrun a budget wait (FIFO per model) until
+    enough earlier usage leaves the window; requests that can never fit are rejected.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, Dict[str, int]]] = None):
+        self.logger = logging.getLogger(__name__)
+        self.input_windows: Dict[str, TokenWindow] = {}
+        self.output_windows: Dict[str, TokenWindow] = {}
+        self.max_output_tokens: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        for model, budget in (budgets or {}).items():
+            if budget.get('max_tokens'):
+                self.max_output_tokens[model] = budget['max_tokens']
+            if budget.get('input_tokens_per_minute'):
+                self.input_windows[model] = TokenWindow(budget['input_tokens_per_minute'])
+            if budget.get('output_tokens_per_minute'):
+                self.output_windows[model] = TokenWindow(budget['output_tokens_per_minute'])
+        self.logger.debug(f"TokenBudgetLimiter initialized for models: {sorted(set(self.input_windows) | set(self.output_windows))}")
 
     @classmethod
-    def from_limits(cls, requests_per_minute: int, requests_per_hour: int):
-        return cls(requests_per_minute, requests_per_hour)
-
-    async def wait_for_next_slot(self) -> None:
-        start_time = time.time()
-        while True:
-            if await self.is_allowed():
-                return
-            if time.time() - start_time > 60:  # Timeout after 60 seconds
-                raise TimeoutError("Waited too long for the next available slot")
-            self.logger.debug("Waiting for next available slot")
-            await asyncio.sleep(0.1)  # Sleep for 0.1 second before checking again
+    def from_tiers(cls, tiers: Dict[str, Dict[str, Any]]) -> 'TokenBudgetLimiter':
+        """Build budgets from the `tiers` section of llm_config.yaml, keyed by model."""
+        return cls({tier['model']: tier for tier in tiers.values() if 'model' in tier})
+
+    async def reserve(self, model: str, input_tokens: int, output_tokens: Optional[int] = None,
+                      timeout: Optional[float] = 60) -> TokenReservation:
+        """Reserve tokens against the model's budgets, waiting until they fit.
+
+        Raises:
+            RateLimitError: If the request can never fit in the budget or the wait times out.
+        """
+        if output_tokens is None:
+            output_tokens = self.max_output_tokens.get(model, 0)
+        reservation = TokenReservation(model, input_tokens, output_tokens)
+        input_window = self.input_windows.get(model)
+        output_window = self.output_windows.get(model)
+        if input_window is None and output_window is None:
+            return reservation
+        if (input_window and input_tokens > input_window.limit) or (output_window and output_tokens > output_window.limit):
+            raise RateLimitError(f"Request for {input_tokens} input / {output_tokens} output tokens exceeds the per-minute token budget of {model}")
+
+        try:
+            await asyncio.wait_for(self._reserve(reservation, input_window, output_window), timeout)
+        except asyncio.TimeoutError:
+            raise RateLimitError(f"Timed out waiting for token budget of {model}")
+        return reservation
+
+    async def _reserve(self, reservation: TokenReservation, input_window: Optional[TokenWindow],
+                       output_window: Optional[TokenWindow]) -> None:
+        # asyncio.Lock wakes waiters in FIFO order, so one model's callers are served in turn.
+        lock = self._locks.setdefault(reservation.model, asyncio.Lock())
+        async with lock:
+            while True:
+                now = time.time()
+                delay = max(
+                    input_window.delay(reservation.input_tokens, now) if input_window else 0.0,
+                    output_window.delay(reservation.output_tokens, now) if output_window else 0.0
+                )
+                if delay <= 0:
+                    break
+                self.logger.warning(f"Token budget for {reservation.model} exhausted, waiting {delay:.2f} seconds")
+                await asyncio.sleep(delay)
+            if input_window:
+                reservation.input_entry = input_window.charge(reservation.input_tokens, now)
+            if output_window:
+                reservation.output_entry = output_window.charge(reservation.output_tokens, now)
+
+    def settle(self, reservation: TokenReservation, input_tokens: int, output_tokens: int) -> None:
+        """Replace the reserved estimates with the actual token usage."""
+        if reservation.settled:
+            return
+        reservation.settled = True
+        if reservation.input_entry is not None:
+            self.input_windows[reservation.model].adjust(reservation.input_entry, input_tokens)
+        if reservation.output_entry is not None:
+            self.output_windows[reservation.model].adjust(reservation.output_entry, output_tokens)
+
+    def get_usage(self, model: str) -> Dict[str, Any]:
+        now = time.time()
+        input_window = self.input_windows.get(model)
+        output_window = self.output_windows.get(model)
+        return {
+            'input_tokens_this_minute': input_window.usage(now) if input_window else 0,
+            'input_tokens_per_minute': input_window.limit if input_window else None,
+            'output_tokens_this_minute': output_window.usage(now) if output_window else 0,
+            'output_tokens_per_minute': output_window.limit if output_window else None
+        }
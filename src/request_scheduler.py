@@ -0,0 +1,243 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+from src.exceptions import DeadlineExceededError
+
+@dataclass
+class PriorityClass:
+    name: str
+    # Share of the LLM slots while every class has requests waiting.
+    weight: float
+    # Seconds a request may wait before it is dispatched ahead of the fair-queuing order.
+    max_wait: float
+
+# Slots when neither max_concurrent nor a capacity function is given.
+DEFAULT_MAX_CONCURRENT = 8
+
+DEFAULT_PRIORITY_CLASSES = {
+    'interactive': PriorityClass('interactive', 8, 5.0),
+    'sufficiency': PriorityClass('sufficiency', 3, 30.0),
+    'background': PriorityClass('background', 1, 120.0)
+}
+
+@dataclass
+class ScheduledRequest:
+    priority_class: str
+    start_tag: float
+    finish_tag: float
+    sequence: int
+    enqueued: float
+    deadline: Optional[float]
+    future: asyncio.Future
+    dispatched: Optional[float] = None
+    released: bool = False
+
+@dataclass
+class ClassStats:
+    dispatched: int = 0
+    expired: int = 0
+    promoted: int = 0
+    deadline_dispatches: int = 0
+    waits: Deque[float] = field(default_factory=lambda: deque(maxlen=500))
+
+class RequestScheduler:
+    """Dispatches LLM requests from several priority classes onto `max_concurrent` slots.
+
+    While requests are waiting, the next one is chosen as follows:
+    1. A request that has waited longer than its class's `max_wait` (oldest first), so a
+       low-weight class is never starved.
+    2. A request whose deadline is closer than the recent average time a slot is held
+       (earliest deadline first).
+    3. Otherwise weighted fair queuing: every request gets a virtual finish tag of
+       cost / weight past its class's previous one, and the smallest tag goes next, so
+       classes share the slots in proportion to their weights and an idle class's unused
+       share goes to the others.
+    A request still waiting at its deadline is dropped with DeadlineExceededError.
+
+    With `max_concurrent` None the number of slots follows `capacity()`, e.g. the current
+    limits of the adaptive concurrency limiters, so the scheduler only decides the order in
+    which requests go out and never caps them below what the upstream is measured to take.
+    """
+
+    def __init__(self, classes: Optional[Dict[str, PriorityClass]] = None, max_concurrent: Optional[int] = DEFAULT_MAX_CONCURRENT,
+                 default_class: str = 'interactive', capacity: Optional[Callable[[], int]] = None):
+        self.logger = logging.getLogger(__name__)
+        self.classes = classes or dict(DEFAULT_PRIORITY_CLASSES)
+        if default_class not in self.classes:
+            raise ValueError(f"Unknown default priority class: {default_class}")
+        if max_concurrent is None and capacity is None:
+            raise ValueError("max_concurrent is required without a capacity function")
+        if max_concurrent is not None and max_concurrent < 1:
+            raise ValueError(f"max_concurrent must be at least 1, got {max_concurrent}")
+        self.capacity = capacity
+        self._max_concurrent = max_concurrent
+        self.default_class = default_class
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        # Recent average seconds a slot is held; deadlines closer than this are urgent.
+        self.service_time = 1.0
+        self._queues: Dict[str, Deque[ScheduledRequest]] = {name: deque() for name in self.classes}
+        self._finish_tags: Dict[str, float] = {name: 0.0 for name in self.classes}
+        # Heap of (deadline, sequence, request) for waiting requests that have a deadline.
+        self._deadlines: List[Tuple[float, int, ScheduledRequest]] = []
+        self._sequence = itertools.count()
+        self.stats: Dict[str, ClassStats] = {name: ClassStats() for name in self.classes}
+
+    @property
+    def max_concurrent(self) -> int:
+        if self._max_concurrent is not None:
+            return self._max_concurrent
+        return max(1, self.capacity())
+
+    @max_concurrent.setter
+    def max_concurrent(self, value: Optional[int]) -> None:
+        self._max_concurrent = value
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], capacity: Optional[Callable[[], int]] = None) -> 'RequestScheduler':
+        """Build from the `scheduler` section of llm_config.yaml. A null or missing
+        `max_concurrent` sizes the slots from `capacity`."""
+        classes = None
+        if config.get('classes'):
+            classes = {
+                name: PriorityClass(name, float(settings.get('weight', 1)), float(settings.get('max_wait', 60)))
+                for name, settings in config['classes'].items()
+            }
+            if any(priority_class.weight <= 0 for priority_class in classes.values()):
+                raise ValueError("Priority class weights must be positive")
+        max_concurrent = config.get('max_concurrent', None if capacity is not None else DEFAULT_MAX_CONCURRENT)
+        return cls(classes, max_concurrent, config.get('default_class', 'interactive'), capacity)
+
+    async def acquire(self, priority_class: Optional[str] = None, deadline: Optional[float] = None,
+                      cost: float = 1.0) -> ScheduledRequest:
+        """Wait for a slot for one request of `priority_class` (the default class if None).
+
+        Args:
+            deadline: Seconds from now by which the request must be dispatched, or None.
+            cost: Relative size of the request in the fair-queuing order.
+
+        Raises:
+            ValueError: If the priority class is unknown.
+            DeadlineExceededError: If the deadline passed before a slot was free.
+        """
+        name = priority_class or self.default_class
+        if name not in self.classes:
+            raise ValueError(f"Unknown priority class: {name}")
+        now = time.monotonic()
+        start_tag = max(self.virtual_time, self._finish_tags[name])
+        finish_tag = start_tag + cost / self.classes[name].weight
+        self._finish_tags[name] = finish_tag
+        request = ScheduledRequest(name, start_tag, finish_tag, next(self._sequence), now,
+                                   None if deadline is None else now + deadline,
+                                   asyncio.get_running_loop().create_future())
+        self._queues[name].append(request)
+        if request.deadline is not None:
+            heapq.heappush(self._deadlines, (request.deadline, request.sequence, request))
+        self._dispatch()
+        if request.future.done():
+            return request
+
+        try:
+            await asyncio.wait_for(request.future, deadline)
+        except asyncio.TimeoutError:
+            self.stats[name].expired += 1
+            self.logger.warning(f"Dropping {name} request after {deadline:g} seconds waiting for an LLM slot")
+            raise DeadlineExceededError(f"No LLM slot free within the {deadline:g} second deadline")
+        except BaseException:
+            # Dispatched just as the caller was cancelled: hand the slot on.
+            if request.future.done() and not request.future.cancelled():
+                self.release(request)
+            raise
+        return request
+
+    def release(self, request: ScheduledRequest) -> None:
+        if request.released or request.dispatched is None:
+            return
+        request.released = True
+        self.in_flight -= 1
+        self.service_time += (time.monotonic() - request.dispatched - self.service_time) * 0.1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority_class: Optional[str] = None, deadline: Optional[float] = None,
+                   cost: float = 1.0) -> AsyncIterator[ScheduledRequest]:
+        """Hold a slot, as from acquire(), for the duration of the block."""
+        request = await self.acquire(priority_class, deadline, cost)
+        try:
+            yield request
+        finally:
+            self.release(request)
+
+    def _head(self, name: str) -> Optional[ScheduledRequest]:
+        queue = self._queues[name]
+        while queue and queue[0].future.done():
+            queue.popleft()
+        return queue[0] if queue else None
+
+    def _next(self, now: float) -> Optional[ScheduledRequest]:
+        heads = [head for head in (self._head(name) for name in self.classes) if head is not None]
+        if not heads:
+            return None
+        starved = [head for head in heads if now - head.enqueued >= self.classes[head.priority_class].max_wait]
+        if starved:
+            request = min(starved, key=lambda head: head.enqueued)
+            self.stats[request.priority_class].promoted += 1
+            return request
+        while self._deadlines and self._deadlines[0][2].future.done():
+            heapq.heappop(self._deadlines)
+        if self._deadlines and self._deadlines[0][0] - now <= self.service_time:
+            request = self._deadlines[0][2]
+            self.stats[request.priority_class].deadline_dispatches += 1
+            return request
+        return min(heads, key=lambda head: (head.finish_tag, head.sequence))
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        max_concurrent = self.max_concurrent
+        while self.in_flight < max_concurrent:
+            request = self._next(now)
+            if request is None:
+                return
+            request.dispatched = now
+            request.future.set_result(None)
+            self.in_flight += 1
+            self.virtual_time = max(self.virtual_time, request.start_tag)
+            stats = self.stats[request.priority_class]
+            stats.dispatched += 1
+            stats.waits.append(now - request.enqueued)
+
+    def rank(self, priority_class: Optional[str]) -> int:
+        """Position of the class by descending weight (0 for the heaviest), for queues that
+        order by a plain priority number."""
+        weight = self.classes[priority_class or self.default_class].weight
+        return sum(1 for other in self.classes.values() if other.weight > weight)
+
+    def queue_depth(self, priority_class: str) -> int:
+        return sum(1 for request in self._queues[priority_class] if not request.future.done())
+
+    def get_stats(self) -> Dict[str, Any]:
+        classes = {}
+        for name, stats in self.stats.items():
+            waits = sorted(stats.waits)
+            classes[name] = {
+                'queue_depth': self.queue_depth(name),
+                'dispatched': stats.dispatched,
+                'expired': stats.expired,
+                'promoted': stats.promoted,
+                'deadline_dispatches': stats.deadline_dispatches,
+                'average_wait': sum(waits) / len(waits) if waits else 0.0,
+                'p95_wait': waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0,
+                'max_wait': waits[-1] if waits else 0.0
+            }
+        return {
+            'in_flight': self.in_flight,
+            'max_concurrent': self.max_concurrent,
+            'service_time': self.service_time,
+            'classes': classes
+        }
@@ -0,0 +1,120 @@
+import re
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, List, Optional
+
+# Sections of the structured response format, in the order RESPONSE_FORMAT_INSTRUCTIONS asks for them.
+STRUCTURED_SECTIONS = ('task_progress', 'state_updates', 'actions', 'suggestions', 'response')
+
+# Name of the last event of a response stream, whose value is the complete structured response.
+RESULT_SECTION = 'result'
+
+OPEN_TAG_PATTERN = re.compile(r'<([A-Za-z_]\w*)>')
+PARTIAL_OPEN_TAG_PATTERN = re.compile(r'<[A-Za-z_]?\w*\Z')
+MAX_TAG_NAME_LENGTH = 64
+
+@dataclass
+class ResponseSection:
+    name: str
+    value: Any
+
+class SectionParser:
+    """Single-pass incremental parser for the `<tag>...</tag>` sections of a response.
+
+    Chunks are fed in as they arrive and each call to feed() returns the sections its chunk
+    completed. Tags may sit inline or be split across chunk boundaries. Only the section
+    being read and a partial tag at the end of the previous chunk are held, never the whole
+    response. Inside a section, any tag other than its own closing tag is plain content, so
+    responses may quote markup. A section still open when close() is called runs to the end
+    of the response.
+
+    With `names`, only those tags open a section; others are treated as text.
+    """
+
+    def __init__(self, names: Optional[Iterable[str]] = None):
+        self.names = frozenset(names) if names is not None else None
+        self._section: Optional[str] = None
+        self._closing_tag = ''
+        self._parts: List[str] = []
+        self._carry = ''
+
+    def feed(self, chunk: str) -> List[ResponseSection]:
+        data = self._carry + chunk if self._carry else chunk
+        self._carry = ''
+        sections = []
+        position = 0
+        while position < len(data):
+            if self._section is None:
+                position = self._find_open_tag(data, position)
+            else:
+                end = data.find(self._closing_tag, position)
+                if end < 0:
+                    keep = self._partial_suffix(data, position, self._closing_tag)
+                    self._parts.append(data[position:len(data) - keep])
+                    self._carry = data[len(data) - keep:] if keep else ''
+                    break
+                self._parts.append(data[position:end])
+                sections.append(ResponseSection(self._section, ''.join(self._parts)))
+                position = end + len(self._closing_tag)
+                self._section = None
+                self._parts = []
+        return sections
+
+    def _find_open_tag(self, data: str, position: int) -> int:
+        while True:
+            match = OPEN_TAG_PATTERN.search(data, position)
+            if match is None:
+                start = data.rfind('<', max(position, len(data) - MAX_TAG_NAME_LENGTH - 1))
+                if start >= 0 and PARTIAL_OPEN_TAG_PATTERN.match(data, start):
+                    self._carry = data[start:]
+                return len(data)
+            name = match.group(1)
+            if self.names is None or name in self.names:
+                self._section = name
+                self._closing_tag = f"</{name}>"
+                return match.end()
+            position = match.end()
+
+    @staticmethod
+    def _partial_suffix(data: str, position: int, tag: str) -> int:
+        """Length of the longest suffix of data[position:] that is a proper prefix of `tag`."""
+        for length in range(min(len(tag) - 1, len(data) - position), 0, -1):
+            if data.endswith(tag[:length]):
+                return length
+        return 0
+
+    def close(self) -> List[ResponseSection]:
+        """End the response, returning a section left open by a missing closing tag."""
+        sections = []
+        if self._section is not None:
+            sections.append(ResponseSection(self._section, ''.join(self._parts) + self._carry))
+        self._section = None
+        self._parts = []
+        self._carry = ''
+        return sections
+
+def parse_sections(text: str, names: Optional[Iterable[str]] = None) -> List[ResponseSection]:
+    """All sections of a complete response, in order."""
+    parser = SectionParser(names)
+    return parser.feed(text) + parser.close()
+
+async def stream_sections(chunks: AsyncIterable[str], names: Optional[Iterable[str]] = None) -> AsyncIterator[ResponseSection]:
+    """Yield each section of a streamed response as soon as its closing tag arrives,
+    with the raw section text as the value."""
+    parser = SectionParser(names)
+    async for chunk in chunks:
+        for section in parser.feed(chunk):
+            yield section
+    for section in parser.close():
+        yield section
+
+def parse_structured_response(text: str) -> List[ResponseSection]:
+    """Sections of a complete response, unwrapping a reply that ClaudeManager.parse_response
+    wrapped whole in `<response>` so the structured sections nested inside it are found."""
+    sections = parse_sections(text)
+    if sections and sections[0].name == 'response':
+        # The wrapped reply's own closing </response> ends the outer section early, so
+        # sections after it come back at the top level.
+        nested = parse_sections(sections[0].value, STRUCTURED_SECTIONS)
+        if nested:
+            return nested + sections[1:]
+    return sections
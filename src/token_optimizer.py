@@ -1,3 +1,5 @@
+from src.tokenizer import get_token_counter
+
 class TokenOptimizer:
     def __init__(self, token_tracker):
         self.token_tracker = token_tracker
@@ -24,19 +26,13 @@ class TokenOptimizer:
         
         sorted_tasks = sorted(self.token_tracker.token_usage.items(), key=lambda x: x[1], reverse=True)[:5]
         for task_id, tokens in sorted_tasks:
-            report += f"- Task {task_id}: {tokens} tokens\n"
+            report += f"- Task {self.token_tracker.get_label(task_id)}: {tokens} tokens\n"
         
         return report
 
     async def optimize_prompt(self, prompt: str) -> str:
         # Implement more sophisticated optimization logic here
-        words = prompt.split()
-        if len(words) > 100:
-            return ' '.join(words[:100])
-        return prompt
+        return get_token_counter().truncate(prompt, 100)
 
     async def truncate_response(self, response: str, max_tokens: int) -> str:
-        tokens = response.split()
-        if len(tokens) <= max_tokens:
-            return response
-        return ' '.join(tokens[:max_tokens])
+        return get_token_counter().truncate(response, max_tokens)
@@ -1,18 +1,16 @@
 from typing import Dict
 from src.domain_models import TokenUsage, TokenUsagePolicy, TokenOptimizationPolicy
+from src.tokenizer import get_token_counter
 
 class TokenTracker(TokenUsagePolicy):
     def __init__(self):
         self.token_usage = TokenUsage(total_tokens=0, tokens_per_task={})
 
     def count_tokens(self, text: str) -> int:
-        # This is a simplified token counting method.
-        # In a real implementation, you'd use a proper tokenizer.
-        return len(text.split())
+        return get_token_counter().count(text)
 
     def add_tokens(self, task_id: str, input_text: str, output_text: str) -> None:
-        input_tokens = self.count_tokens(input_text)
-        output_tokens = self.count_tokens(output_text)
+        input_tokens, output_tokens = get_token_counter().count_many([input_text, output_text])
         total_tokens = input_tokens + output_tokens
 
         self.token_usage.total_tokens += total_tokens
@@ -31,58 +29,139 @@ class TokenOptimizer(TokenOptimizationPolicy):
         return prompt.strip()
 
     def truncate_response(self, response: str, max_tokens: int) -> str:
-        tokens = response.split()
-        if len(tokens) <= max_tokens:
-            return response
-        return ' '.join(tokens[:max_tokens])
+        return get_token_counter().truncate(response, max_tokens)
 import logging
-import asyncio
-from typing import Dict
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+@dataclass
+class TokenUsageRecord:
+    key: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    calls: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
 
 class TokenTracker:
-    def __init__(self):
-        self.logger = logging.getLogger(__name__)
-        self.token_usage: Dict[str, int] = {}
-        self.total_tokens = 0
-        self.lock = asyncio.Lock()
-
-    async def add_tokens(self, task_id: str, input_tokens: int, output_tokens: int):
-        async with self.lock:
-            total_tokens = input_tokens + output_tokens
-            self.token_usage[task_id] = self.token_usage.get(task_id, 0) + total_tokens
-            self.total_tokens += total_tokens
-            self.logger.info(f"Added {total_tokens} tokens for task {task_id}. Total tokens: {self.total_tokens}")
-        
-        # Log the current state of token usage
-        self.logger.debug(f"Current token usage: {self.token_usage}")
-        self.logger.debug(f"Total tokens: {self.total_tokens}")
-        
-        # Ensure the token usage is immediately available
-        usage = await self.get_token_usage(task_id)
-        self.logger.debug(f"Verified token usage for task {task_id}: {usage}")
+    """Per-key token counters that need no lock on the write path.
 
-    async def get_token_usage(self, task_id: str) -> int:
-        async with self.lock:
-            usage = self.token_usage.get(task_id, 0)
-            self.logger.debug(f"Token usage for task {task_id}: {usage}")
-            return usage
+    Each thread writes to its own shard of `key -> [input, output, calls]` counters. Within
+    one event loop the read-modify-write of a counter never spans an `await`, so concurrent
+    tasks cannot interleave it; threads never share a shard, so no two writers touch the same
+    counter. Reads merge the shards, which keeps the write path O(1) and contention-free.
+    reset() starts a new generation of shards rather than clearing the ones writers hold.
 
-    async def get_total_token_usage(self) -> int:
-        async with self.lock:
-            self.logger.debug(f"Total token usage: {self.total_tokens}")
-            return self.total_tokens
+    At most `max_labels` labels are kept; the oldest are dropped first, after which their
+    keys are reported as is.
+    """
+
+    def __init__(self, max_labels: int = 10000):
+        self.logger = logging.getLogger(__name__)
+        self.max_labels = max_labels
+        self.labels: Dict[str, str] = {}
+        self._local = threading.local()
+        self._shards: List[Dict[str, List[int]]] = []
+        self._generation = 0
+        self._shards_lock = threading.Lock()  # Guards shard registration and reset.
+
+    def _shard(self) -> Dict[str, List[int]]:
+        local = self._local
+        shard = getattr(local, 'shard', None)
+        if shard is None or local.generation != self._generation:
+            shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+                local.generation = self._generation
+            local.shard = shard
+        return shard
+
+    def record(self, key: str, input_tokens: int, output_tokens: int, label: Optional[str] = None) -> None:
+        """Synchronous, thread-safe form of add_tokens."""
+        shard = self._shard()
+        counters = shard.get(key)
+        if counters is None:
+            counters = shard[key] = [0, 0, 0]
+        counters[0] += input_tokens
+        counters[1] += output_tokens
+        counters[2] += 1
+        if label is not None:
+            labels = self.labels
+            if labels.get(key) != label:
+                labels[key] = label
+                if len(labels) > self.max_labels:
+                    labels.pop(next(iter(labels)), None)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Recorded token usage", extra={
+                'action': 'token_usage', 'key': key, 'input_tokens': input_tokens, 'output_tokens': output_tokens
+            })
+
+    async def add_tokens(self, key: str, input_tokens: int, output_tokens: int, label: Optional[str] = None) -> None:
+        self.record(key, input_tokens, output_tokens, label)
+
+    def get_label(self, key: str) -> str:
+        return self.labels.get(key, key)
+
+    def _snapshots(self) -> List[Dict[str, List[int]]]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        # dict.copy() is atomic under the GIL, so a shard can be snapshotted while its
+        # owning thread keeps writing.
+        return [shard.copy() for shard in shards]
+
+    def get_record(self, key: str) -> TokenUsageRecord:
+        record = TokenUsageRecord(key)
+        for shard in self._snapshots():
+            counters = shard.get(key)
+            if counters is not None:
+                record.input_tokens += counters[0]
+                record.output_tokens += counters[1]
+                record.calls += counters[2]
+        return record
+
+    def get_records(self) -> Dict[str, TokenUsageRecord]:
+        records: Dict[str, TokenUsageRecord] = {}
+        for shard in self._snapshots():
+            for key, (input_tokens, output_tokens, calls) in shard.items():
+                record = records.get(key)
+                if record is None:
+                    record = records[key] = TokenUsageRecord(key)
+                record.input_tokens += input_tokens
+                record.output_tokens += output_tokens
+                record.calls += calls
+        return records
+
+    @property
+    def token_usage(self) -> Dict[str, int]:
+        return {key: record.total_tokens for key, record in self.get_records().items()}
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(counters[0] + counters[1] for shard in self._snapshots() for counters in shard.values())
+
+    async def get_token_usage(self, key: str) -> int:
+        return self.get_record(key).total_tokens
+
+    async def get_total_tokens(self) -> int:
+        return self.total_tokens
 
-    async def reset(self):
-        async with self.lock:
-            self.token_usage.clear()
-            self.total_tokens = 0
-            self.logger.info("Token usage reset")
+    async def get_total_token_usage(self) -> int:
+        return self.total_tokens
 
     async def count_tokens(self, text: str) -> int:
-        # This is a simple approximation. For more accurate results, use a proper tokenizer.
-        token_count = len(text.split())
-        self.logger.debug(f"Counted {token_count} tokens for text: {text[:50]}...")
-        return token_count
+        return get_token_counter().count(text)
+
+    async def reset(self) -> None:
+        with self._shards_lock:
+            # Writers move to a fresh shard on their next record; a record racing the reset
+            # lands in a retired shard and is dropped with it.
+            self._generation += 1
+            self._shards = []
+            self.labels = {}
+        self.logger.info("Token usage reset")
 
 class TokenOptimizer:
     def __init__(self, token_tracker: TokenTracker):
@@ -122,41 +201,7 @@ class TokenOptimizer:
 
     async def optimize_prompt(self, prompt: str) -> str:
         # Implement more sophisticated optimization logic here
-        words = prompt.split()
-        if len(words) > 100:
-            return ' '.join(words[:100])
-        return prompt
+        return get_token_counter().truncate(prompt, 100)
 
     async def truncate_response(self, response: str, max_tokens: int) -> str:
-        tokens = response.split()
-        if len(tokens) <= max_tokens:
-            return response
-        return ' '.join(tokens[:max_tokens])
-class TokenTracker:
-    def __init__(self):
-        self.token_usage = {}
-        self.total_tokens = 0
-        self.lock = asyncio.Lock()
-
-    async def add_tokens(self, key, input_tokens, output_tokens):
-        async with self.lock:
-            total_tokens = input_tokens + output_tokens
-            self.token_usage[key] = self.token_usage.get(key, 0) + total_tokens
-            self.total_tokens += total_tokens
-
-    async def get_token_usage(self, key):
-        async with self.lock:
-            return self.token_usage.get(key, 0)
-
-    async def get_total_tokens(self):
-        async with self.lock:
-            return self.total_tokens
-
-    async def count_tokens(self, text: str) -> int:
-        # This is a simple approximation. For more accurate results, use a proper tokenizer.
-        return len(text.split())
-
-    async def reset(self):
-        async with self.lock:
-            self.token_usage.clear()
-            self.total_tokens = 0
+        return get_token_counter().truncate(response, max_tokens)
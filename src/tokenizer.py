@@ -0,0 +1,277 @@
+import hashlib
+import heapq
+import logging
+import os
+import re
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+MERGES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'bpe_merges.txt')
+
+# Splits text into words, numbers, punctuation runs and whitespace before BPE is applied,
+# so merges never cross word boundaries (GPT-2 style, without unicode property classes).
+PRETOKENIZE_PATTERN = re.compile(r"""'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+def _bytes_to_unicode() -> Dict[int, str]:
+    """Map every byte to a printable character so merges can be stored as plain text."""
+    printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    characters = printable[:]
+    offset = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            characters.append(256 + offset)
+            offset += 1
+    return dict(zip(printable, map(chr, characters)))
+
+BYTE_ENCODER = _bytes_to_unicode()
+BYTE_DECODER = {character: byte for byte, character in BYTE_ENCODER.items()}
+
+def _encode_bytes(piece: str) -> str:
+    return ''.join(BYTE_ENCODER[byte] for byte in piece.encode('utf-8'))
+
+def train_bpe(texts: Iterable[str], num_merges: int, min_frequency: int = 2) -> List[Tuple[str, str]]:
+    """Learn up to `num_merges` byte-level BPE merges from `texts`.
+
+    Pair counts are updated incrementally for the words touched by each merge, and the most
+    frequent pair is taken from a lazily invalidated max-heap (ties broken lexicographically).
+    """
+    word_freqs: Counter = Counter()
+    for text in texts:
+        word_freqs.update(_encode_bytes(piece) for piece in PRETOKENIZE_PATTERN.findall(text))
+    words = [list(word) for word in word_freqs]
+    freqs = list(word_freqs.values())
+
+    pair_counts: Counter = Counter()
+    pair_words: Dict[Tuple[str, str], set] = defaultdict(set)
+    for index, word in enumerate(words):
+        for pair in zip(word, word[1:]):
+            pair_counts[pair] += freqs[index]
+            pair_words[pair].add(index)
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges: List[Tuple[str, str]] = []
+    while heap and len(merges) < num_merges:
+        negative_count, pair = heapq.heappop(heap)
+        if pair_counts.get(pair, 0) != -negative_count:
+            continue
+        if -negative_count < min_frequency:
+            break
+        merges.append(pair)
+        merged = pair[0] + pair[1]
+        changed = set()
+        for index in pair_words.pop(pair, ()):
+            word = words[index]
+            for old in zip(word, word[1:]):
+                pair_counts[old] -= freqs[index]
+                changed.add(old)
+            new_word = []
+            position = 0
+            while position < len(word):
+                if position < len(word) - 1 and (word[position], word[position + 1]) == pair:
+                    new_word.append(merged)
+                    position += 2
+                else:
+                    new_word.append(word[position])
+                    position += 1
+            words[index] = new_word
+            for new in zip(new_word, new_word[1:]):
+                pair_counts[new] += freqs[index]
+                pair_words[new].add(index)
+                changed.add(new)
+        pair_counts.pop(pair, None)
+        for changed_pair in changed:
+            count = pair_counts.get(changed_pair, 0)
+            if count > 0:
+                heapq.heappush(heap, (-count, changed_pair))
+            else:
+                pair_counts.pop(changed_pair, None)
+    return merges
+
+class BPETokenizer:
+    """Offline byte-level BPE tokenizer using the merges bundled in `src/data`.
+
+    The bundled merges were trained on this repository's own text, not taken from the Claude
+    tokenizer, so counts are an offline estimate for budgets, context-limit checks and cost
+    estimates; the `usage` reported by the API is authoritative. Encodings of individual
+    words are memoized, since prompts repeat the same words constantly.
+    """
+
+    def __init__(self, merges: Optional[Sequence[Tuple[str, str]]] = None, merges_path: str = MERGES_PATH,
+                 word_cache_size: int = 65536):
+        self.logger = logging.getLogger(__name__)
+        if merges is None:
+            merges = self.load_merges(merges_path)
+        self.ranks: Dict[Tuple[str, str], int] = {tuple(pair): rank for rank, pair in enumerate(merges)}
+        self.word_cache_size = word_cache_size
+        self._word_cache: Dict[str, int] = {}
+        self.logger.debug(f"BPETokenizer initialized with {len(self.ranks)} merges")
+
+    @staticmethod
+    def load_merges(path: str) -> List[Tuple[str, str]]:
+        merges = []
+        with open(path, encoding='utf-8') as merges_file:
+            for line in merges_file:
+                line = line.rstrip('\n')
+                if line and not line.startswith('#version'):
+                    left, right = line.split(' ')
+                    merges.append((left, right))
+        return merges
+
+    def _bpe(self, piece: str) -> List[str]:
+        parts = list(_encode_bytes(piece))
+        while len(parts) > 1:
+            pair = min(zip(parts, parts[1:]), key=lambda candidate: self.ranks.get(candidate, float('inf')))
+            if pair not in self.ranks:
+                break
+            merged = []
+            position = 0
+            while position < len(parts):
+                if position < len(parts) - 1 and (parts[position], parts[position + 1]) == pair:
+                    merged.append(pair[0] + pair[1])
+                    position += 2
+                else:
+                    merged.append(parts[position])
+                    position += 1
+            parts = merged
+        return parts
+
+    def _count_piece(self, piece: str) -> int:
+        count = self._word_cache.get(piece)
+        if count is None:
+            count = len(self._bpe(piece))
+            if len(self._word_cache) >= self.word_cache_size:
+                self._word_cache.clear()
+            self._word_cache[piece] = count
+        return count
+
+    def pieces(self, text: str) -> List[str]:
+        return PRETOKENIZE_PATTERN.findall(text)
+
+    def encode(self, text: str) -> List[str]:
+        """The BPE tokens of `text`, in the byte-to-unicode alphabet of the merges file."""
+        return [token for piece in self.pieces(text) for token in self._bpe(piece)]
+
+    def decode(self, tokens: Sequence[str]) -> str:
+        return bytes(BYTE_DECODER[character] for character in ''.join(tokens)).decode('utf-8', errors='replace')
+
+    def count(self, text: str) -> int:
+        return sum(self._count_piece(piece) for piece in self.pieces(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """The longest prefix of `text`, cut at a word boundary, that fits in `max_tokens`."""
+        total = 0
+        end = 0
+        for match in PRETOKENIZE_PATTERN.finditer(text):
+            total += self._count_piece(match.group())
+            if total > max_tokens:
+                return text[:end].rstrip()
+            end = match.end()
+        return text
+
+class TokenCounter:
+    """Memoizing token counter keyed on a content hash of the text.
+
+    Each distinct text is tokenized once; later counts of the same prompt, response or
+    history block are served from a bounded LRU map of digests to counts.
+    """
+
+    def __init__(self, tokenizer: Optional[BPETokenizer] = None, max_entries: int = 4096):
+        self.logger = logging.getLogger(__name__)
+        self.tokenizer = tokenizer or BPETokenizer()
+        self.max_entries = max_entries
+        self._counts: 'OrderedDict[bytes, int]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        digest = self._digest(text)
+        with self._lock:
+            count = self._counts.get(digest)
+            if count is not None:
+                self._counts.move_to_end(digest)
+                self.hits += 1
+                return count
+            self.misses += 1
+        count = self.tokenizer.count(text)
+        with self._lock:
+            self._counts[digest] = count
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+    def remember(self, text: str, count: int) -> None:
+        """Record a count computed elsewhere, e.g. summed from the segments of a prompt."""
+        if not text:
+            return
+        digest = self._digest(text)
+        with self._lock:
+            self._counts[digest] = count
+            self._counts.move_to_end(digest)
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def count_many(self, texts: Sequence[str]) -> List[int]:
+        """Count a batch of texts, tokenizing each distinct text at most once."""
+        counts: Dict[str, int] = {}
+        for text in texts:
+            if text not in counts:
+                counts[text] = self.count(text)
+        return [counts[text] for text in texts]
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return self.tokenizer.truncate(text, max_tokens)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counts.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'entries': len(self._counts), 'hits': self.hits, 'misses': self.misses}
+
+_default_counter: Optional[TokenCounter] = None
+_default_counter_lock = threading.Lock()
+
+def get_token_counter() -> TokenCounter:
+    """The process-wide counter shared by the managers, trackers and mock client."""
+    global _default_counter
+    if _default_counter is None:
+        with _default_counter_lock:
+            if _default_counter is None:
+                _default_counter = TokenCounter()
+    return _default_counter
+
+def count_tokens(text: str) -> int:
+    return get_token_counter().count(text)
+
+def count_tokens_many(texts: Sequence[str]) -> List[int]:
+    return get_token_counter().count_many(texts)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Train the bundled BPE merges from text files")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--merges', type=int, default=8000)
+    parser.add_argument('--output', default=MERGES_PATH)
+    args = parser.parse_args()
+    corpus = []
+    for path in args.paths:
+        with open(path, encoding='utf-8', errors='ignore') as corpus_file:
+            corpus.append(corpus_file.read())
+    learned = train_bpe(corpus, args.merges)
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        output_file.write('#version: 1\n')
+        output_file.writelines(f"{left} {right}\n" for left, right in learned)
+    print(f"Wrote {len(learned)} merges to {args.output}")
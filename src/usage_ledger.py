@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+# Rollup resolutions in seconds and how long buckets at each resolution are retained.
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+DEFAULT_RETENTION = {'1m': 86400, '1h': 30 * 86400, '1d': 366 * 86400}
+
+# Column name -> array type code of the raw record columns.
+COLUMNS = {
+    'timestamp': 'd',
+    'model': 'I',
+    'tier': 'I',
+    'input_tokens': 'q',
+    'output_tokens': 'q',
+    'latency': 'f',
+    'flags': 'B'
+}
+CACHE_HIT = 1
+ERROR = 2
+
+# Indexes into the aggregate counter lists kept per bucket and group.
+REQUESTS, INPUT_TOKENS, OUTPUT_TOKENS, LATENCY, CACHE_HITS, ERRORS = range(6)
+
+@dataclass
+class UsageRecord:
+    timestamp: float
+    model: str
+    tier: str
+    input_tokens: int
+    output_tokens: int
+    latency: float
+    cache_hit: bool
+    success: bool
+
+@dataclass
+class UsageTotals:
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    latency: float = 0.0
+    cache_hits: int = 0
+    errors: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    @property
+    def avg_latency(self) -> float:
+        return self.latency / self.requests if self.requests else 0.0
+
+    @classmethod
+    def from_counters(cls, counters: List[float]) -> 'UsageTotals':
+        return cls(int(counters[REQUESTS]), int(counters[INPUT_TOKENS]), int(counters[OUTPUT_TOKENS]),
+                   counters[LATENCY], int(counters[CACHE_HITS]), int(counters[ERRORS]))
+
+class UsageLedger:
+    """Time-series ledger of LLM requests with pre-aggregated rollups.
+
+    Every request is appended as one row of compact typed columns (timestamp, model, tier,
+    input/output tokens, latency, cache-hit and error flags) and added to 1m, 1h and 1d
+    rollup buckets keyed by (model, tier), plus all-time totals. Reports read the rollups,
+    so a query costs O(buckets in range) no matter how many requests were made.
+
+    At most `max_records` raw rows are held in memory. When the buffer fills, the rows are
+    appended column by column to `spill_dir` if one is configured, and dropped otherwise;
+    the rollups are unaffected either way.
+    """
+
+    def __init__(self, spill_dir: Optional[str] = None, max_records: int = 65536,
+                 retention: Optional[Dict[str, float]] = None):
+        self.logger = logging.getLogger(__name__)
+        self.spill_dir = spill_dir
+        self.max_records = max_records
+        self.retention = dict(DEFAULT_RETENTION, **(retention or {}))
+        self._columns = {name: array(code) for name, code in COLUMNS.items()}
+        self._names: List[str] = []
+        self._name_ids: Dict[str, int] = {}
+        self._rollups: Dict[str, Dict[float, Dict[Tuple[str, str], List[float]]]] = {name: {} for name in RESOLUTIONS}
+        self._oldest_bucket: Dict[str, float] = {}
+        self._totals: Dict[Tuple[str, str], List[float]] = {}
+        self.spilled_records = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._load_spilled_names()
+        self.logger.debug(f"UsageLedger initialized with max_records={max_records}, spill_dir={spill_dir}")
+
+    def _load_spilled_names(self) -> None:
+        """Pick up the name table and row count of rows spilled by an earlier ledger, so
+        their ids keep resolving and new names are interned after them."""
+        names_path = os.path.join(self.spill_dir, 'names.json')
+        if os.path.exists(names_path):
+            with open(names_path) as names_file:
+                for name in json.load(names_file):
+                    self._intern(name)
+        timestamp_path = os.path.join(self.spill_dir, 'timestamp.bin')
+        if os.path.exists(timestamp_path):
+            self.spilled_records = os.path.getsize(timestamp_path) // array(COLUMNS['timestamp']).itemsize
+
+    def _intern(self, name: str) -> int:
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+        return name_id
+
+    def record(self, model: Optional[str], tier: Optional[str], input_tokens: int = 0, output_tokens: int = 0,
+               latency: float = 0.0, cache_hit: bool = False, success: bool = True,
+               timestamp: Optional[float] = None) -> None:
+        timestamp = time.time() if timestamp is None else timestamp
+        model = model or ''
+        tier = tier or ''
+        flags = (CACHE_HIT if cache_hit else 0) | (0 if success else ERROR)
+        columns = self._columns
+        columns['timestamp'].append(timestamp)
+        columns['model'].append(self._intern(model))
+        columns['tier'].append(self._intern(tier))
+        columns['input_tokens'].append(input_tokens)
+        columns['output_tokens'].append(output_tokens)
+        columns['latency'].append(latency)
+        columns['flags'].append(flags)
+
+        group = (model, tier)
+        self._add(self._totals, group, input_tokens, output_tokens, latency, cache_hit, success)
+        for resolution, width in RESOLUTIONS.items():
+            buckets = self._rollups[resolution]
+            bucket_start = timestamp - timestamp % width
+            bucket = buckets.get(bucket_start)
+            if bucket is None:
+                bucket = buckets[bucket_start] = {}
+                self._expire(resolution, bucket_start)
+            self._add(bucket, group, input_tokens, output_tokens, latency, cache_hit, success)
+
+        if len(columns['timestamp']) >= self.max_records:
+            self.spill()
+
+    @staticmethod
+    def _add(groups: Dict[Tuple[str, str], List[float]], group: Tuple[str, str], input_tokens: int,
+             output_tokens: int, latency: float, cache_hit: bool, success: bool) -> None:
+        counters = groups.get(group)
+        if counters is None:
+            counters = groups[group] = [0, 0, 0, 0.0, 0, 0]
+        counters[REQUESTS] += 1
+        counters[INPUT_TOKENS] += input_tokens
+        counters[OUTPUT_TOKENS] += output_tokens
+        counters[LATENCY] += latency
+        if cache_hit:
+            counters[CACHE_HITS] += 1
+        if not success:
+            counters[ERRORS] += 1
+
+    def _expire(self, resolution: str, newest_bucket: float) -> None:
+        cutoff = newest_bucket - self.retention[resolution]
+        oldest = self._oldest_bucket.get(resolution, newest_bucket)
+        if oldest > cutoff:
+            self._oldest_bucket[resolution] = min(oldest, newest_bucket)
+            return
+        buckets = self._rollups[resolution]
+        for bucket_start in [start for start in buckets if start <= cutoff]:
+            del buckets[bucket_start]
+        self._oldest_bucket[resolution] = min(buckets)
+
+    def spill(self) -> None:
+        """Move the in-memory raw rows to the column files in `spill_dir`, or drop them."""
+        count = len(self._columns['timestamp'])
+        if not count:
+            return
+        if self.spill_dir:
+            for name, column in self._columns.items():
+                with open(os.path.join(self.spill_dir, f"{name}.bin"), 'ab') as column_file:
+                    column.tofile(column_file)
+            with open(os.path.join(self.spill_dir, 'names.json'), 'w') as names_file:
+                json.dump(self._names, names_file)
+            self.spilled_records += count
+            self.logger.debug(f"Spilled {count} usage records to {self.spill_dir}")
+        else:
+            self.logger.debug(f"Discarded {count} raw usage records; rollups retain their totals")
+        self._columns = {name: array(code) for name, code in COLUMNS.items()}
+
+    def _spilled_columns(self) -> Optional[Dict[str, array]]:
+        if not self.spill_dir or not os.path.exists(os.path.join(self.spill_dir, 'timestamp.bin')):
+            return None
+        columns = {}
+        for name, code in COLUMNS.items():
+            column = array(code)
+            path = os.path.join(self.spill_dir, f"{name}.bin")
+            with open(path, 'rb') as column_file:
+                column.fromfile(column_file, os.path.getsize(path) // column.itemsize)
+            columns[name] = column
+        return columns
+
+    def records(self) -> Iterator[UsageRecord]:
+        """Raw records in insertion order: spilled rows first, then the in-memory buffer."""
+        for columns in (self._spilled_columns(), self._columns):
+            if columns is None:
+                continue
+            for index in range(len(columns['timestamp'])):
+                flags = columns['flags'][index]
+                yield UsageRecord(
+                    columns['timestamp'][index], self._names[columns['model'][index]],
+                    self._names[columns['tier'][index]], columns['input_tokens'][index],
+                    columns['output_tokens'][index], columns['latency'][index],
+                    bool(flags & CACHE_HIT), not flags & ERROR
+                )
+
+    @staticmethod
+    def _group_key(group: Tuple[str, str], group_by: str) -> Union[str, Tuple[str, str]]:
+        if group_by == 'model':
+            return group[0]
+        if group_by == 'tier':
+            return group[1]
+        return group
+
+    def query(self, resolution: str = '1m', since: Optional[float] = None, until: Optional[float] = None,
+              model: Optional[str] = None, tier: Optional[str] = None, group_by: str = 'model') -> List[Dict[str, Any]]:
+        """Rollup buckets in [since, until), oldest first, one row per bucket and group.
+
+        For example, tokens per model per minute over the last day is
+        query('1m', since=time.time() - 86400).
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution: {resolution}. Expected one of {sorted(RESOLUTIONS)}")
+        rows = []
+        for bucket_start in sorted(self._rollups[resolution]):
+            if (since is not None and bucket_start + RESOLUTIONS[resolution] <= since) or (until is not None and bucket_start >= until):
+                continue
+            merged: Dict[Any, List[float]] = {}
+            for group, counters in self._rollups[resolution][bucket_start].items():
+                if (model is not None and group[0] != model) or (tier is not None and group[1] != tier):
+                    continue
+                key = self._group_key(group, group_by)
+                target = merged.setdefault(key, [0, 0, 0, 0.0, 0, 0])
+                for index, value in enumerate(counters):
+                    target[index] += value
+            for key, counters in merged.items():
+                totals = UsageTotals.from_counters(counters)
+                rows.append({'bucket_start': bucket_start, group_by: key, 'requests': totals.requests,
+                             'input_tokens': totals.input_tokens, 'output_tokens': totals.output_tokens,
+                             'total_tokens': totals.total_tokens, 'avg_latency': totals.avg_latency,
+                             'cache_hits': totals.cache_hits, 'errors': totals.errors})
+        return rows
+
+    def totals(self, group_by: str = 'model', since: Optional[float] = None, until: Optional[float] = None,
+               resolution: str = '1m') -> Dict[Any, UsageTotals]:
+        """Usage per model, tier or (model, tier) pair; all-time unless a time range is given."""
+        merged: Dict[Any, List[float]] = {}
+        if since is None and until is None:
+            sources = [self._totals]
+        else:
+            if resolution not in RESOLUTIONS:
+                raise ValueError(f"Unknown resolution: {resolution}. Expected one of {sorted(RESOLUTIONS)}")
+            width = RESOLUTIONS[resolution]
+            sources = [groups for bucket_start, groups in self._rollups[resolution].items()
+                       if not ((since is not None and bucket_start + width <= since) or (until is not None and bucket_start >= until))]
+        for groups in sources:
+            for group, counters in groups.items():
+                target = merged.setdefault(self._group_key(group, group_by), [0, 0, 0, 0.0, 0, 0])
+                for index, value in enumerate(counters):
+                    target[index] += value
+        return {key: UsageTotals.from_counters(counters) for key, counters in merged.items()}
+
+    def clear(self) -> None:
+        self._columns = {name: array(code) for name, code in COLUMNS.items()}
+        self._rollups = {name: {} for name in RESOLUTIONS}
+        self._oldest_bucket.clear()
+        self._totals.clear()
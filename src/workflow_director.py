@@ -1,3 +1,4 @@
+import inspect
 import logging
 from pythonjsonlogger import jsonlogger
 import yaml
@@ -27,6 +28,8 @@ from src.priority_manager import PriorityManager
 from src.user_interaction_handler import UserInteractionHandler
 from src.claude_manager import ClaudeManager
 from src.cost_analyzer import CostAnalyzer
+from src.prompt_segments import PromptSegmentCache
+from src.structured_response import RESULT_SECTION
 
 
 class WorkflowDirector:
@@ -51,6 +54,7 @@ class WorkflowDirector:
         self.claude_manager = claude_manager or ClaudeManager()
         self.user_interaction_handler = user_interaction_handler or UserInteractionHandler()
         self.llm_manager = llm_manager or LLMManager()
+        self.prompt_segments = PromptSegmentCache()
         self.test_mode = test_mode
         self._test_mode = test_mode
         self.current_stage = self.config['stages'][0]['name'] if self.config['stages'] else "Default Stage"
@@ -109,7 +113,7 @@ class WorkflowDirector:
         self.convention_manager = ConventionManager()
         self.sufficiency_evaluator = SufficiencyEvaluator(self.llm_manager)
         self.priority_manager = PriorityManager()
-        self.cost_analyzer = CostAnalyzer()
+        self.cost_analyzer = CostAnalyzer(self.llm_manager.usage_ledger if isinstance(self.llm_manager, LLMManager) else None)
         
         self.initialize_constraints()
         self.initialize_priorities()
@@ -368,7 +372,7 @@ class WorkflowDirector:
                 # Process all commands using LLM
                 tier = self.determine_query_tier(user_input)
                 context = self._prepare_llm_context()
-                prompt = self.llm_manager.generate_prompt('default', {
+                prompt = await self.llm_manager.generate_prompt('default', {
                     "command": user_input,
                     "workflow_stage": self.current_stage,
                     "stage_description": self.stages[self.current_stage].get('description', ''),
@@ -378,7 +382,7 @@ class WorkflowDirector:
                     "coding_conventions": self.convention_manager.get_aider_conventions(),
                     "available_transitions": ', '.join([t['to'] for t in self.get_available_transitions()]),
                     "project_progress": sum(self.stage_progress.values()) / len(self.stages),
-                    "workflow_history": '\n'.join([f"{entry['action']}: {entry['details']}" for entry in self._get_workflow_history()]),
+                    "workflow_history": self._format_workflow_history(),
                     "context": str(context)
                 })
                 
@@ -387,10 +391,14 @@ class WorkflowDirector:
                 if self.llm_manager:
                     try:
                         self.logger.debug(f"Querying LLM with prompt: {prompt[:100]}...")
-                        structured_response = await self.llm_manager.query(prompt, context=context, tier=tier)
-                        self.logger.debug(f"LLM response received: {structured_response}")
-                        self.user_interaction_handler.display_message(f"LLM response: {structured_response}")
-                        self._process_llm_response(structured_response)
+                        if inspect.isasyncgenfunction(getattr(self.llm_manager, 'query_stream', None)):
+                            structured_response = await self._stream_llm_response(prompt, context, tier)
+                            self.logger.debug(f"LLM response received: {structured_response}")
+                        else:
+                            structured_response = await self.llm_manager.query(prompt, context=context, tier=tier)
+                            self.logger.debug(f"LLM response received: {structured_response}")
+                            self.user_interaction_handler.display_message(f"LLM response: {structured_response}")
+                            self._process_llm_response(structured_response)
                     except Exception as e:
                         self.logger.error(f"Error querying LLM: {str(e)}")
                         self.user_interaction_handler.display_message(f"An error occurred while processing your command: {str(e)}")
@@ -430,6 +438,14 @@ class WorkflowDirector:
     def _get_workflow_history(self) -> List[Dict[str, Any]]:
         return self.state_manager.get('workflow_history', [])
 
+    def _format_workflow_history(self) -> str:
+        # One segment per entry, so only entries added since the last turn are tokenized.
+        history = self.prompt_segments.prompt()
+        for index, entry in enumerate(self._get_workflow_history()):
+            separator = '\n' if index else ''
+            history.add(f"history:{entry.get('timestamp', index)}:{index == 0}", f"{separator}{entry['action']}: {entry['details']}")
+        return history.render()
+
     def _update_workflow_history(self, action: str, details: Dict[str, Any]):
         history = self._get_workflow_history()
         history.append({
@@ -457,45 +473,9 @@ class WorkflowDirector:
                 return
 
             if isinstance(structured_response, dict):
-                if 'task_progress' in structured_response:
-                    progress = float(structured_response['task_progress'])
-                    self.update_stage_progress(progress)
-                    self.logger.info(f"Updated stage progress to {progress:.2f}")
-                
-                if 'state_updates' in structured_response:
-                    state_updates = structured_response['state_updates']
-                    for key, value in state_updates.items():
-                        self.state_manager.set(key, value)
-                        self.logger.info(f"Updated project state: {key} = {value}")
-                
-                if 'actions' in structured_response:
-                    actions = structured_response['actions']
-                    for action in actions:
-                        self._handle_llm_action(action)
-                
-                if 'suggestions' in structured_response:
-                    suggestions = structured_response['suggestions']
-                    self.user_interaction_handler.display_message("LLM Suggestions:")
-                    for suggestion in suggestions:
-                        self.user_interaction_handler.display_message(f"- {suggestion}")
-                
-                if 'response' in structured_response:
-                    self.user_interaction_handler.display_message(f"LLM Response: {structured_response['response']}")
-                
-                # Check modularity of any new or updated files
-                if 'file_updates' in structured_response:
-                    for file_path in structured_response['file_updates']:
-                        modularity_check = self.project_structure_manager.check_file_modularity(file_path)
-                        if not modularity_check['is_modular']:
-                            self.user_interaction_handler.display_message(f"Modularity issues detected in {file_path}:")
-                            for issue in modularity_check['issues']:
-                                self.user_interaction_handler.display_message(f"- {issue}")
-                            if len(modularity_check['issues']) > 1:
-                                split_suggestions = self.project_structure_manager.suggest_file_split(file_path)
-                                if split_suggestions:
-                                    self.user_interaction_handler.display_message("Suggested file splits:")
-                                    for suggestion in split_suggestions:
-                                        self.user_interaction_handler.display_message(f"- {suggestion}")
+                for section in self.LLM_RESPONSE_SECTIONS:
+                    if section in structured_response:
+                        self._apply_llm_section(section, structured_response[section])
                 
                 self.logger.info("LLM response processed successfully")
             else:
@@ -505,6 +485,63 @@ class WorkflowDirector:
             self.logger.error(f"Error processing LLM response: {str(e)}")
             self.error_handler.handle_error(e)
 
+    # Sections of a structured LLM response acted on by the director, in the order they are applied.
+    LLM_RESPONSE_SECTIONS = ('task_progress', 'state_updates', 'actions', 'suggestions', 'response', 'file_updates')
+
+    def _apply_llm_section(self, section: str, value: Any):
+        if section == 'task_progress':
+            progress = float(value)
+            self.update_stage_progress(progress)
+            self.logger.info(f"Updated stage progress to {progress:.2f}")
+        elif section == 'state_updates':
+            for key, state_value in value.items():
+                self.state_manager.set(key, state_value)
+                self.logger.info(f"Updated project state: {key} = {state_value}")
+        elif section == 'actions':
+            for action in value:
+                self._handle_llm_action(action)
+        elif section == 'suggestions':
+            self.user_interaction_handler.display_message("LLM Suggestions:")
+            for suggestion in value:
+                self.user_interaction_handler.display_message(f"- {suggestion}")
+        elif section == 'response':
+            self.user_interaction_handler.display_message(f"LLM Response: {value}")
+        elif section == 'file_updates':
+            # Check modularity of any new or updated files
+            for file_path in value:
+                modularity_check = self.project_structure_manager.check_file_modularity(file_path)
+                if not modularity_check['is_modular']:
+                    self.user_interaction_handler.display_message(f"Modularity issues detected in {file_path}:")
+                    for issue in modularity_check['issues']:
+                        self.user_interaction_handler.display_message(f"- {issue}")
+                    if len(modularity_check['issues']) > 1:
+                        split_suggestions = self.project_structure_manager.suggest_file_split(file_path)
+                        if split_suggestions:
+                            self.user_interaction_handler.display_message("Suggested file splits:")
+                            for suggestion in split_suggestions:
+                                self.user_interaction_handler.display_message(f"- {suggestion}")
+
+    async def _stream_llm_response(self, prompt: str, context: Dict[str, Any], tier: str) -> Dict[str, Any]:
+        """Query the LLM with streaming, showing output and applying state updates as each
+        section of the response completes rather than after the whole response."""
+        result: Dict[str, Any] = {}
+        async for section in self.llm_manager.query_stream(prompt, context=context, tier=tier):
+            if section.name == RESULT_SECTION:
+                result = section.value
+                continue
+            if section.name not in self.LLM_RESPONSE_SECTIONS:
+                continue
+            self.logger.debug(f"LLM response section received: {section.name}")
+            try:
+                self._apply_llm_section(section.name, section.value)
+            except Exception as e:
+                self.logger.error(f"Error processing LLM response section '{section.name}': {str(e)}")
+                self.error_handler.handle_error(e)
+        if 'error' in result:
+            self.logger.warning(f"LLM microservice error: {result['error']}")
+            self.user_interaction_handler.display_message(f"LLM service error: {result['error']}. Some features may be limited.")
+        return result
+
     def _parse_llm_response(self, response: str) -> dict:
         parsed = {}
         current_key = None
@@ -975,7 +1012,7 @@ class WorkflowDirector:
             return eval(constraint['condition'], {'state': state}), None
         return True, None
 
-    def generate_project_report(self, format='plain'):
+    async def generate_project_report(self, format='plain'):
         """
         Generate a comprehensive project state report.
         
@@ -986,7 +1023,7 @@ class WorkflowDirector:
             str: The formatted project state report
         """
         self.logger.info("Generating project state report")
-        report = self.project_state_reporter.generate_report(format)
+        report = await self.project_state_reporter.generate_report(format)
         self.logger.info("Project state report generated successfully")
         self.logger.debug(f"Report preview: {report[:200]}...")  # Log a preview of the report
         return report
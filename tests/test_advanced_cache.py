@@ -1,6 +1,8 @@
 import pytest
+import asyncio
 import time
-from src.advanced_cache import AdvancedCache
+import random
+from src.advanced_cache import AdvancedCache, estimate_regeneration_cost, estimate_size
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -114,3 +116,176 @@ def test_cache_state_dump(cache):
     assert "key2" in state['cache_contents']
     assert state['size'] == 2
     assert state['similarity_threshold'] == 0.8
+
+def _build_keys(count, seed=42):
+    rng = random.Random(seed)
+    words = ["summarize", "requirements", "design", "domain", "model", "risk", "stage",
+             "project", "report", "next", "steps", "evaluate", "implementation", "testing"]
+    return [f"{' '.join(rng.sample(words, 4))} #{i}" for i in range(count)]
+
+def _mutate(key, rng):
+    chars = list(key)
+    for _ in range(2):
+        chars[rng.randrange(len(chars))] = rng.choice("abcdefghij")
+    return "".join(chars)
+
+@pytest.mark.parametrize("prefix, threshold", [("", 0.8), ("Based on the current project state, ", 0.6)])
+def test_indexed_partial_match_agrees_with_linear_scan(prefix, threshold):
+    keys = [prefix + key for key in _build_keys(600)]
+    indexed = AdvancedCache(similarity_threshold=threshold)
+    scanned = AdvancedCache(similarity_threshold=threshold, use_index=False)
+    for i, key in enumerate(keys):
+        indexed.set(key, i)
+        scanned.set(key, i)
+    rng = random.Random(7)
+    # Near copies of cached keys, and new word combinations close to many of them at once.
+    queries = [_mutate(key, rng) for key in rng.sample(keys, 50)] + [prefix + key for key in _build_keys(50, seed=7)]
+    for query in queries:
+        assert indexed._indexed_best_match(query) == scanned._scan_best_match(query)
+
+def test_index_tracks_eviction_and_expiry():
+    cache = AdvancedCache(max_size=2)
+    cache.set("hello_world", "value1", expiration=1)
+    cache.set("hello_there", "value2")
+    cache.set("goodbye_world", "value3")
+    assert "hello_world" not in cache.index.key_lengths
+    assert set(cache.index.key_lengths) == {"hello_there", "goodbye_world"}
+
+    cache.set("hello_again", "value4", expiration=1)
+    time.sleep(1.1)
+    cache.remove_expired()
+    assert set(cache.index.key_lengths) == {"goodbye_world"}
+    assert cache.get("hello_again!", partial_match=True) is None
+
+    cache.clear()
+    assert not cache.index.key_lengths
+    assert not cache.index.postings
+
+def test_index_ties_resolve_in_cache_order():
+    cache = AdvancedCache(similarity_threshold=0.5)
+    cache.set("abcx", "first")
+    cache.set("abcy", "second")
+    assert cache.get("abcz", partial_match=True) == ("first", 0.75)
+
+def test_evict_expired_uses_expiration_order():
+    cache = AdvancedCache()
+    cache.set("key1", "value1", expiration=2)
+    cache.set("key2", "value2", expiration=1)
+    cache.set("key3", "value3")
+    time.sleep(1.1)
+    assert cache.evict_expired() == 1
+    assert set(cache.cache) == {"key1", "key3"}
+
+def test_evict_expired_respects_max_items():
+    cache = AdvancedCache()
+    for i in range(5):
+        cache.set(f"key{i}", i, expiration=1)
+    time.sleep(1.1)
+    assert cache.evict_expired(max_items=2) == 2
+    assert cache.size() == 3
+
+def test_overwritten_key_is_not_evicted_by_stale_heap_entry():
+    cache = AdvancedCache()
+    cache.set("key1", "old", expiration=1)
+    cache.set("key1", "new", expiration=10)
+    time.sleep(1.1)
+    cache.remove_expired()
+    assert cache.get("key1") == ("new", 1.0)
+
+def test_full_cache_reclaims_expired_slot_first():
+    cache = AdvancedCache(max_size=2)
+    cache.set("key1", "value1")
+    cache.set("key2", "value2", expiration=1)
+    time.sleep(1.1)
+    cache.set("key3", "value3")
+    assert set(cache.cache) == {"key1", "key3"}
+
+@pytest.mark.asyncio
+async def test_background_eviction():
+    cache = AdvancedCache()
+    cache.set("key1", "value1", expiration=1)
+    cache.set("key2", "value2")
+    cache.start_background_eviction(interval=0.05, batch_size=10)
+    try:
+        await asyncio.sleep(1.3)
+        assert set(cache.cache) == {"key2"}
+    finally:
+        await cache.stop_background_eviction()
+    assert cache._eviction_task is None
+
+def _query_result(text, tier, total_tokens):
+    return {"response": text, "tier": tier, "raw_response": text,
+            "token_usage": {"input": total_tokens // 2, "output": total_tokens - total_tokens // 2, "total": total_tokens}}
+
+def test_estimate_regeneration_cost_uses_tier_and_tokens():
+    assert estimate_regeneration_cost(_query_result("x", "powerful", 1000)) == pytest.approx(1.0)
+    assert estimate_regeneration_cost(_query_result("x", "fast", 1000)) == pytest.approx(0.1)
+    assert estimate_regeneration_cost("plain value") == 1.0
+
+def test_invalid_eviction_policy():
+    with pytest.raises(ValueError):
+        AdvancedCache(eviction_policy="random")
+
+def test_max_bytes_bounds_memory():
+    cache = AdvancedCache(max_bytes=20_000)
+    for i in range(50):
+        cache.set(f"key{i}", "x" * 1000)
+    assert cache.current_bytes <= 20_000
+    assert 0 < cache.size() < 50
+    assert "key49" in cache.cache
+    cache.clear()
+    assert cache.current_bytes == 0
+
+def test_value_larger_than_max_bytes_is_not_cached():
+    cache = AdvancedCache(max_bytes=1000)
+    cache.set("huge", "x" * 5000)
+    assert cache.get("huge") is None
+    assert cache.current_bytes == 0
+
+def test_overwrite_updates_byte_accounting():
+    cache = AdvancedCache(max_bytes=100_000)
+    cache.set("key1", "x" * 5000)
+    cache.set("key1", "x" * 10)
+    assert cache.current_bytes == estimate_size("x" * 10)
+
+def test_gdsf_keeps_expensive_entries_over_cheap_ones():
+    expensive = _query_result("x" * 2000, "powerful", 150_000)
+    cheap = _query_result("y" * 2000, "fast", 50)
+    budget = estimate_size(expensive) + estimate_size(cheap) + 100
+    cache = AdvancedCache(max_bytes=budget, eviction_policy="gdsf")
+    cache.set("expensive", expensive)
+    cache.set("cheap", cheap)
+    cache.set("newcomer", _query_result("z" * 2000, "balanced", 500))
+    assert "expensive" in cache.cache
+    assert "cheap" not in cache.cache
+    assert cache.current_bytes <= budget
+
+def test_gdsf_prefers_frequently_used_entries():
+    cache = AdvancedCache(max_size=2, eviction_policy="gdsf")
+    cache.set("key1", "value1")
+    cache.set("key2", "value2")
+    for _ in range(3):
+        cache.get("key1")
+    cache.set("key3", "value3")
+    assert set(cache.cache) == {"key1", "key3"}
+
+@pytest.fixture(scope="module", params=[
+    1_000,
+    10_000,
+    pytest.param(100_000, marks=pytest.mark.slow),
+])
+def populated_cache(request):
+    cache = AdvancedCache(similarity_threshold=0.8)
+    for i, key in enumerate(_build_keys(request.param)):
+        cache.set(key, i)
+    return cache
+
+@pytest.mark.benchmark(group="advanced_cache_partial_match")
+def test_partial_match_benchmark_indexed(benchmark, populated_cache):
+    benchmark.pedantic(populated_cache._indexed_best_match, args=("design risk next model #12345x",),
+                       rounds=5, iterations=1)
+
+@pytest.mark.benchmark(group="advanced_cache_partial_match")
+def test_partial_match_benchmark_linear_scan(benchmark, populated_cache):
+    benchmark.pedantic(populated_cache._scan_best_match, args=("design risk next model #12345x",),
+                       rounds=1, iterations=1)
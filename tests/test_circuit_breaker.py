@@ -0,0 +1,180 @@
+import asyncio
+import pytest
+from src.circuit_breaker import CircuitBreaker, CircuitBreakers, LatencyTracker
+from src.claude_manager import ClaudeManager
+from src.exceptions import CircuitOpenError
+from src.llm_manager import LLMManager
+
+TIERS = {
+    'fast': {'model': 'fast-model'},
+    'balanced': {'model': 'balanced-model'},
+    'powerful': {'model': 'powerful-model'}
+}
+
+class StubClient:
+    """Answers per model after a configurable delay, or fails when the delay is None."""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.calls = []
+        self.cancelled = []
+
+    async def select_model(self, task):
+        return 'powerful-model'
+
+    async def generate_response(self, prompt, model):
+        self.calls.append(model)
+        delay = self.delays[model]
+        if delay is None:
+            raise RuntimeError(f"{model} is down")
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        return f"{model} answer"
+
+    async def reset(self):
+        pass
+
+def test_breaker_opens_on_error_rate_within_window():
+    breaker = CircuitBreaker(window=10, min_requests=4, error_rate=0.5, open_duration=5)
+    breaker.record_success(now=0)
+    breaker.record_failure(now=1)
+    breaker.record_success(now=2)
+    assert breaker.state(now=2) == 'closed'
+    breaker.record_failure(now=3)
+    assert breaker.state(now=3) == 'open'
+    assert not breaker.allow(now=4)
+    assert breaker.get_stats(now=4)['rejected'] == 1
+
+def test_breaker_forgets_outcomes_outside_window():
+    breaker = CircuitBreaker(window=10, min_requests=3, error_rate=0.5)
+    breaker.record_failure(now=0)
+    breaker.record_failure(now=1)
+    breaker.record_success(now=12)
+    assert breaker.state(now=12) == 'closed'
+    assert breaker.get_stats(now=12)['requests'] == 1
+
+def test_half_open_probe_closes_or_reopens():
+    breaker = CircuitBreaker(window=10, min_requests=1, error_rate=0.5, open_duration=5)
+    breaker.record_failure(now=0)
+    assert breaker.state(now=4) == 'open'
+    assert breaker.allow(now=5) and breaker.state(now=5) == 'half_open'
+    assert not breaker.allow(now=5)
+    breaker.record_failure(now=6)
+    assert breaker.state(now=7) == 'open'
+
+    assert breaker.allow(now=11)
+    breaker.release()
+    assert breaker.allow(now=11)
+    breaker.record_success(now=12)
+    assert breaker.state(now=12) == 'closed'
+    assert breaker.get_stats(now=12)['times_opened'] == 2
+
+def test_breakers_from_config_are_per_model():
+    breakers = CircuitBreakers.from_config({'min_requests': 1, 'open_duration': 60, 'unknown': True})
+    breakers.get('a').record_failure()
+    assert breakers.get('a').state() == 'open' and breakers.get('b').state() == 'closed'
+    assert set(breakers.get_stats()) == {'a', 'b'}
+
+def test_latency_percentile_needs_min_samples():
+    tracker = LatencyTracker(max_samples=100, min_samples=10)
+    for index in range(9):
+        tracker.record('m', index / 100)
+    assert tracker.percentile('m', 0.95) is None
+    for index in range(9, 100):
+        tracker.record('m', index / 100)
+    assert tracker.percentile('m', 0.95) == 0.95
+    assert tracker.percentile('other', 0.5) is None
+
+@pytest.mark.asyncio
+async def test_open_circuit_fails_fast():
+    client = StubClient({'powerful-model': None})
+    manager = ClaudeManager(client=client, tiers=TIERS,
+                            circuit_breakers=CircuitBreakers(min_requests=1, open_duration=60))
+
+    with pytest.raises(CircuitOpenError, match="Circuit open for model powerful-model"):
+        await manager.generate_response("Hello", 'powerful-model')
+    with pytest.raises(CircuitOpenError):
+        await manager.generate_response("Hello", 'powerful-model')
+
+    assert client.calls == ['powerful-model']
+    assert manager.get_resilience_stats()['circuits']['powerful-model']['state'] == 'open'
+
+@pytest.mark.asyncio
+async def test_slow_request_is_hedged_to_cheaper_tier():
+    client = StubClient({'powerful-model': 0.01, 'balanced-model': 0.01})
+    manager = ClaudeManager(client=client, tiers=TIERS, hedging={'enabled': True, 'min_samples': 5})
+    for _ in range(5):
+        assert await manager.generate_response("Hello", 'powerful-model') == "<response>powerful-model answer</response>"
+    assert manager.hedge_stats['sent'] == 0
+
+    client.delays['powerful-model'] = 1.0
+    response = await manager.generate_response("Hello", 'powerful-model')
+
+    assert response == "<response>balanced-model answer</response>"
+    assert manager.hedge_stats == {'sent': 1, 'won': 1}
+    assert client.cancelled == ['powerful-model']
+    assert manager.circuit_breakers.get('powerful-model').state() == 'closed'
+
+@pytest.mark.asyncio
+async def test_hedging_is_off_by_default():
+    client = StubClient({'powerful-model': 0.01})
+    manager = ClaudeManager(client=client, tiers=TIERS)
+    for _ in range(25):
+        await manager.generate_response("Hello", 'powerful-model')
+    assert set(client.calls) == {'powerful-model'} and manager.hedge_stats['sent'] == 0
+
+@pytest.mark.asyncio
+async def test_circuit_opened_while_reserving_budget_fails_fast():
+    client = StubClient({'powerful-model': 0.01})
+    manager = ClaudeManager(client=client, tiers=TIERS,
+                            circuit_breakers=CircuitBreakers(min_requests=1, open_duration=60))
+    reserve = manager.token_budget.reserve
+
+    async def reserve_while_another_request_fails(*args, **kwargs):
+        manager.circuit_breakers.get('powerful-model').record_failure()
+        return await reserve(*args, **kwargs)
+
+    manager.token_budget.reserve = reserve_while_another_request_fails
+    with pytest.raises(CircuitOpenError, match="Circuit open for model powerful-model"):
+        await manager.generate_response("Hello", 'powerful-model')
+
+    assert client.calls == []
+
+class TimingOutRateLimiter:
+    requests_per_minute = requests_per_hour = 1
+
+    def __init__(self):
+        self.calls = 0
+
+    async def acquire(self):
+        self.calls += 1
+        raise TimeoutError("Waited too long for the next available slot")
+
+@pytest.mark.asyncio
+async def test_timeouts_are_not_retried():
+    rate_limiter = TimingOutRateLimiter()
+    manager = ClaudeManager(client=StubClient({}), tiers=TIERS, rate_limiter=rate_limiter)
+    with pytest.raises(TimeoutError):
+        await manager.generate_response("Hello", 'powerful-model')
+    assert rate_limiter.calls == 1
+
+@pytest.mark.asyncio
+async def test_llm_manager_falls_back_by_tier_without_caching_an_open_circuit():
+    client = StubClient({'powerful-model': None, 'balanced-model': 0})
+    breakers = CircuitBreakers(min_requests=1, open_duration=0.2)
+    manager = LLMManager(claude_manager=ClaudeManager(client=client, tiers=TIERS, circuit_breakers=breakers))
+    manager.tiers = TIERS
+
+    result = await manager.query("Hello", tier='powerful')
+    assert result['response'] == "balanced-model answer"
+    fallback = await manager.query("Status", tier='powerful', model='powerful-model')
+    assert 'error' in fallback and manager.cache.size() == 1
+
+    client.delays['powerful-model'] = 0
+    await asyncio.sleep(0.25)
+    recovered = await manager.query("Status", tier='powerful', model='powerful-model')
+    assert recovered['response'] == "powerful-model answer"
+    assert client.calls == ['powerful-model', 'balanced-model', 'powerful-model']
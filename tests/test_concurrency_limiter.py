@@ -0,0 +1,158 @@
+import asyncio
+import pytest
+from src.claude_manager import ClaudeManager
+from src.concurrency_limiter import (IGNORE, OVERLOAD, SUCCESS, AdaptiveConcurrencyLimiter, AIMDLimit,
+                                     ConcurrencyLimiters, GradientLimit)
+
+class Upstream:
+    """Serves `capacity` requests at once; beyond that latency grows with the queue, and
+    beyond `overload_at` requests it answers with an overload error."""
+
+    def __init__(self, capacity=8, latency=0.02, overload_at=24):
+        self.capacity = capacity
+        self.latency = latency
+        self.overload_at = overload_at
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.overloads = 0
+
+    async def call(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.in_flight > self.overload_at:
+                self.overloads += 1
+                await asyncio.sleep(self.latency / 10)
+                return False
+            await asyncio.sleep(self.latency * max(1.0, self.in_flight / self.capacity))
+            return True
+        finally:
+            self.in_flight -= 1
+
+class CountingClient:
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.order = []
+
+    async def select_model(self, task):
+        return 'model'
+
+    async def generate_response(self, prompt, model):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.order.append(prompt)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return f"answer to {prompt}"
+
+    async def reset(self):
+        pass
+
+@pytest.mark.asyncio
+async def test_waiters_are_served_by_priority_then_fifo():
+    limiter = AdaptiveConcurrencyLimiter('aimd', initial_limit=1, max_limit=1)
+    held = await limiter.acquire()
+    served = []
+
+    async def wait(name, priority):
+        permit = await limiter.acquire(priority)
+        served.append(name)
+        limiter.release(permit, IGNORE)
+
+    tasks = [asyncio.create_task(wait(name, priority)) for name, priority in
+             [('batch-1', 2), ('interactive-1', 0), ('batch-2', 2), ('interactive-2', 0)]]
+    await asyncio.sleep(0)
+    assert limiter.get_stats()['queue_depth'] == 4
+    limiter.release(held, IGNORE)
+    await asyncio.gather(*tasks)
+
+    assert served == ['interactive-1', 'interactive-2', 'batch-1', 'batch-2']
+    assert limiter.in_flight == 0 and limiter.get_stats()['max_queue_depth'] == 4
+
+@pytest.mark.asyncio
+async def test_timed_out_and_cancelled_waiters_do_not_hold_slots():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+    held = await limiter.acquire()
+    with pytest.raises(TimeoutError):
+        await limiter.acquire(timeout=0.01)
+    cancelled = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    limiter.release(held, IGNORE)
+
+    permit = await asyncio.wait_for(limiter.acquire(), 1)
+    assert limiter.in_flight == 1 and limiter.get_stats()['timed_out'] == 1
+    limiter.release(permit)
+
+def test_aimd_grows_only_when_used_and_backs_off_on_overload():
+    limit = AIMDLimit(10, 1, 100, backoff=0.5)
+    limit.update(0.1, in_flight=1, overload=False)
+    assert limit.limit == 10
+    for _ in range(10):
+        limit.update(0.1, in_flight=10, overload=False)
+    assert 10.9 < limit.limit < 11
+    limit.update(0.1, in_flight=10, overload=True)
+    assert 5.4 < limit.limit < 5.5
+
+def test_gradient_grows_at_steady_latency_and_shrinks_as_it_rises():
+    limit = GradientLimit(10, 1, 100, long_window=100)
+    for _ in range(20):
+        limit.update(0.1, in_flight=int(limit.limit), overload=False)
+    grown = limit.limit
+    assert grown > 20
+    for _ in range(10):
+        limit.update(0.5, in_flight=int(limit.limit), overload=False)
+    assert limit.limit < grown * 0.75
+
+def test_limiters_from_config():
+    limiters = ConcurrencyLimiters.from_config({'algorithm': 'aimd', 'initial_limit': 4, 'tolerance': 2.0})
+    assert limiters.get('a').limit == 4 and limiters.get('a') is not limiters.get('b')
+    assert isinstance(limiters.get('a').limit_algorithm, AIMDLimit)
+    with pytest.raises(ValueError):
+        ConcurrencyLimiters.from_config({'algorithm': 'vegas'})
+
+async def _drive(upstream, limiter, requests):
+    async def request():
+        permit = await limiter.acquire() if limiter else None
+        ok = await upstream.call()
+        if limiter:
+            limiter.release(permit, SUCCESS if ok else OVERLOAD)
+        return ok
+    return await asyncio.gather(*(request() for _ in range(requests)))
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("algorithm", ['aimd', 'gradient'])
+async def test_limit_settles_near_upstream_capacity(algorithm):
+    unlimited = Upstream()
+    await _drive(unlimited, None, 300)
+
+    upstream = Upstream()
+    limiter = AdaptiveConcurrencyLimiter(algorithm, initial_limit=40, max_limit=100)
+    results = await _drive(upstream, limiter, 300)
+
+    assert unlimited.overloads > 250
+    assert upstream.overloads < unlimited.overloads / 3 and results.count(True) > 200
+    assert limiter.limit >= upstream.capacity / 2
+
+@pytest.mark.asyncio
+async def test_claude_manager_caps_requests_in_flight_per_model():
+    client = CountingClient()
+    manager = ClaudeManager(client=client, concurrency=ConcurrencyLimiters(initial_limit=3, max_limit=3))
+    responses = await asyncio.gather(*(manager.generate_response(f"prompt {index}", 'model') for index in range(20)))
+
+    assert responses[5] == "<response>answer to prompt 5</response>"
+    assert client.max_in_flight == 3
+    stats = manager.get_resilience_stats()['concurrency']['model']
+    assert stats['granted'] == 20 and stats['in_flight'] == 0 and stats['queued'] == 17
+
+@pytest.mark.asyncio
+async def test_claude_manager_sends_higher_priority_first():
+    client = CountingClient()
+    manager = ClaudeManager(client=client, concurrency=ConcurrencyLimiters(initial_limit=1, max_limit=1))
+    first = asyncio.create_task(manager.generate_response("first"))
+    await asyncio.sleep(0)
+    background = asyncio.create_task(manager.generate_response("background", priority=5))
+    interactive = asyncio.create_task(manager.generate_response("interactive", priority=0))
+    await asyncio.gather(first, background, interactive)
+    assert client.order == ["first", "interactive", "background"]
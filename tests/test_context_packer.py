@@ -0,0 +1,96 @@
+import pytest
+from unittest.mock import MagicMock
+from src.claude_manager import ClaudeManager
+from src.context_packer import ContextBlock, ContextPacker, ContextReduction
+from src.llm_manager import LLMManager
+from src.prompt_segments import PromptSegmentCache
+from src.tokenizer import BPETokenizer, TokenCounter, get_token_counter
+
+@pytest.fixture
+def segment_cache():
+    return PromptSegmentCache(TokenCounter(BPETokenizer()))
+
+@pytest.fixture
+def packer(segment_cache):
+    return ContextPacker(segment_cache, min_block_tokens=8)
+
+def _blocks():
+    return [
+        ContextBlock('rules', "Always answer in the structured format. " * 5, 100, truncatable=False, required=True),
+        ContextBlock('config', "stage config entry, " * 60, 10, summary="Stages: design, build"),
+        ContextBlock('history', "older history entry, " * 60, 5),
+        ContextBlock('prompt', "What should happen next in this stage?", 90, required=True)
+    ]
+
+def _tokens(packer, name, text):
+    return packer.segment_cache.segment(name, text).tokens
+
+def test_blocks_within_budget_are_untouched(packer):
+    blocks = _blocks()
+    packed = packer.pack(blocks, 10000)
+    assert packed.fits and packed.reductions == []
+    assert [segment.text for segment in packed.segments] == [block.text for block in blocks]
+    assert packer.get_stats()['reduced_packs'] == 0
+
+def test_lowest_priority_blocks_are_reduced_first(packer):
+    blocks = _blocks()
+    required = _tokens(packer, 'rules', blocks[0].text) + _tokens(packer, 'prompt', blocks[3].text)
+    summary = _tokens(packer, 'config:summary', blocks[1].summary)
+    packed = packer.pack(blocks, required + summary + 40)
+
+    assert packed.fits
+    assert [(r.name, r.action) for r in packed.reductions] == [('config', 'summarized'), ('history', 'truncated')]
+    assert packed.segments[1].text == "Stages: design, build"
+    assert packed.segments[2].text.startswith("older history entry")
+    assert packed.segments[0].text == blocks[0].text and packed.segments[3].text == blocks[3].text
+
+def test_blocks_too_small_to_truncate_usefully_are_dropped(packer):
+    blocks = _blocks()
+    required = _tokens(packer, 'rules', blocks[0].text) + _tokens(packer, 'prompt', blocks[3].text)
+    packed = packer.pack(blocks, required + 2)
+
+    assert packed.fits
+    assert packed.dropped == ['history', 'config']
+    assert packed.segments[1] is None and packed.segments[2] is None
+    stats = packer.get_stats()
+    assert stats['dropped_blocks'] == {'config': 1, 'history': 1}
+    assert stats['tokens_saved'] == sum(r.tokens_before - r.tokens_after for r in packed.reductions)
+
+def test_required_blocks_are_truncated_but_never_dropped(packer):
+    blocks = _blocks()
+    blocks[3] = ContextBlock('prompt', "Explain the design in detail. " * 50, 90, required=True)
+    rules = _tokens(packer, 'rules', blocks[0].text)
+    packed = packer.pack(blocks, rules + 20)
+
+    assert packed.fits
+    assert packed.reductions[-1] == ContextReduction('prompt', 'truncated', _tokens(packer, 'prompt', blocks[3].text),
+                                                     packed.segments[3].tokens)
+    assert packed.segments[0].text == blocks[0].text
+
+def test_unreducible_context_is_reported_over_budget(packer):
+    packed = packer.pack(_blocks()[:1], 5)
+    assert not packed.fits
+    assert packer.get_stats()['over_budget'] == 1
+
+@pytest.mark.asyncio
+async def test_llm_manager_packs_context_into_tier_budget():
+    manager = LLMManager(claude_manager=MagicMock(spec=ClaudeManager))
+    history = [{'action': f'step {index}', 'details': {'note': 'x' * 200}} for index in range(10)]
+    context = {
+        'workflow_stage': 'Design',
+        'coding_conventions': 'Follow PEP 8',
+        'workflow_config': {'stages': [{'name': 'Design'}, {'name': 'Build'}],
+                            'transitions': [{'from': 'Design', 'to': 'Build'}] * 40},
+        'workflow_history': history
+    }
+    full_system, full_prompt = await manager._prepare_prompt("What next?", context, 'balanced')
+    counter = get_token_counter()
+    full_tokens = sum(counter.count(block['text']) for block in full_system) + counter.count(full_prompt)
+    manager.tiers['fast']['context_budget'] = full_tokens - 300
+    system, prompt = await manager._prepare_prompt("What next?", context, 'fast')
+
+    assert "Transitions:" in full_system[0]['text'] and "Transitions:" not in system[0]['text']
+    assert "Workflow Stages: Design, Build" in system[0]['text']
+    assert "(7 earlier entries omitted)" in prompt and "step 9" in prompt and "step 0:" not in prompt
+    assert prompt.rstrip().endswith("What next?")
+    assert manager.context_packer.get_stats()['summarized'] >= 1
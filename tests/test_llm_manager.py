@@ -1,9 +1,11 @@
 import pytest
 import asyncio
+import threading
 from unittest.mock import AsyncMock, patch, MagicMock, ANY
 from asyncio import Future
 from src.exceptions import RateLimitError
 from src.claude_manager import ClaudeManager
+from src.advanced_cache import AdvancedCache
 from src.llm_manager import LLMManager, LLMCostOptimizer
 import logging
 
@@ -40,7 +42,8 @@ async def llm_manager(mock_claude_manager):
 @pytest.mark.asyncio
 async def test_llm_manager_initialization(llm_manager):
     assert isinstance(llm_manager.claude_manager, (ClaudeManager, AsyncMock))
-    assert isinstance(llm_manager.cache, dict)
+    assert isinstance(llm_manager.cache, AdvancedCache)
+    assert llm_manager.cache.eviction_policy == 'gdsf' and llm_manager.cache.max_bytes == 64 * 1024 * 1024
     assert isinstance(llm_manager.cost_optimizer, LLMCostOptimizer)
     assert 'default' in llm_manager.prompt_templates
     assert 'sufficiency_evaluation' in llm_manager.prompt_templates
@@ -335,6 +338,436 @@ async def test_calculate_cost(llm_manager):
 
 @pytest.mark.asyncio
 async def test_clear_cache(llm_manager):
-    llm_manager.cache = {"test": "data"}
+    llm_manager.cache.set("test", "data")
     await llm_manager.clear_cache()
-    assert llm_manager.cache == {}
+    assert llm_manager.cache.size() == 0
+
+@pytest.mark.asyncio
+async def test_query_uses_persistent_cache(tmp_path, mock_claude_manager):
+    from src.persistent_cache import PersistentCache
+    mock_claude_manager.generate_response.return_value = "Test response"
+    mock_claude_manager.count_tokens.return_value = 10
+    path = str(tmp_path / "responses.sqlite3")
+
+    first = LLMManager(claude_manager=mock_claude_manager, persistent_cache=PersistentCache(path=path))
+    response = await first.query("Test query", tier='fast')
+    assert response['response'] == "Test response"
+
+    second = LLMManager(claude_manager=mock_claude_manager, persistent_cache=PersistentCache(path=path))
+    cached = await second.query("Test query", tier='fast')
+    assert cached['response'] == "Test response"
+    assert cached['token_usage']['total'] == 20
+    assert mock_claude_manager.generate_response.call_count == 1
+
+@pytest.mark.asyncio
+async def test_persistent_cache_is_used_off_the_event_loop(tmp_path, mock_claude_manager):
+    from src.persistent_cache import PersistentCache
+    mock_claude_manager.generate_response.return_value = "Test response"
+    mock_claude_manager.count_tokens.return_value = 10
+    persistent_cache = PersistentCache(path=str(tmp_path / "responses.sqlite3"))
+    threads = []
+    for name in ('get', 'set'):
+        method = getattr(persistent_cache, name)
+
+        def record(*args, method=method, **kwargs):
+            threads.append(threading.get_ident())
+            return method(*args, **kwargs)
+        setattr(persistent_cache, name, record)
+
+    manager = LLMManager(claude_manager=mock_claude_manager, persistent_cache=persistent_cache)
+    await manager.query("Test query", tier='fast')
+    assert len(threads) == 2 and threading.get_ident() not in threads
+
+@pytest.mark.asyncio
+async def test_query_cache_stays_within_its_byte_budget(mock_claude_manager):
+    mock_claude_manager.generate_response.return_value = "Test response " * 50
+    mock_claude_manager.count_tokens.return_value = 10
+    manager = LLMManager(claude_manager=mock_claude_manager)
+    manager.cache = AdvancedCache(max_bytes=20000, eviction_policy='gdsf', use_index=False)
+
+    for index in range(40):
+        await manager.query(f"Test query {index}", tier='fast')
+    assert 0 < manager.cache.size() < 40
+    assert manager.cache.current_bytes <= 20000
+
+@pytest.mark.asyncio
+async def test_generate_cache_key_is_compact_and_order_stable(llm_manager):
+    workflow_config = {'stages': [{'name': f'stage{i}', 'tasks': ['task'] * 50} for i in range(20)]}
+    context_a = {'workflow_stage': 'Design', 'workflow_config': workflow_config, 'tags': {'b', 'a'}}
+    context_b = {'tags': {'a', 'b'}, 'workflow_config': workflow_config, 'workflow_stage': 'Design'}
+
+    key_a = await llm_manager._generate_cache_key("Test prompt", context_a, 'balanced')
+    key_b = await llm_manager._generate_cache_key("Test prompt", context_b, 'balanced')
+    assert key_a == key_b
+    assert len(key_a) == 32
+    assert key_a != await llm_manager._generate_cache_key("Test prompt", context_a, 'fast')
+    assert key_a != await llm_manager._generate_cache_key("Other prompt", context_a, 'balanced')
+
+@pytest.mark.asyncio
+async def test_query_tracks_tokens_under_cache_key(llm_manager, mock_claude_manager):
+    mock_claude_manager.generate_response.return_value = "Test response"
+    mock_claude_manager.count_tokens.return_value = 10
+
+    await llm_manager.query("Test query", tier='fast')
+
+    cache_key = await llm_manager._generate_cache_key("Test query", None, 'fast')
+    assert await llm_manager.token_tracker.get_token_usage(cache_key) == 20
+    assert await llm_manager.token_tracker.get_total_tokens() == 20
+    assert llm_manager.token_tracker.get_label(cache_key) == "fast: Test query"
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_queries_are_coalesced(llm_manager, mock_claude_manager):
+    release = asyncio.Event()
+
+    async def slow_response(prompt, model=None):
+        await release.wait()
+        return "Test response"
+
+    mock_claude_manager.generate_response.side_effect = slow_response
+    mock_claude_manager.count_tokens.return_value = 10
+
+    tasks = [asyncio.create_task(llm_manager.query("Test query", tier='fast')) for _ in range(5)]
+    await asyncio.sleep(0.01)
+    stats = llm_manager.get_inflight_stats()
+    assert stats['inflight_requests'] == 1
+    assert sum(stats['waiters'].values()) == 4
+
+    release.set()
+    results = await asyncio.gather(*tasks)
+
+    assert all(result['response'] == "Test response" for result in results)
+    assert mock_claude_manager.generate_response.call_count == 1
+    assert llm_manager.get_inflight_stats() == {"inflight_requests": 0, "waiters": {}, "coalesced_requests": 4}
+
+@pytest.mark.asyncio
+async def test_coalesced_waiters_receive_leader_error(llm_manager):
+    release = asyncio.Event()
+
+    async def failing_execute(*args, **kwargs):
+        await release.wait()
+        raise RuntimeError("boom")
+
+    with patch.object(llm_manager, '_execute_query', side_effect=failing_execute):
+        tasks = [asyncio.create_task(llm_manager.query("Test query", tier='fast')) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(*tasks)
+
+    assert all("error" in result for result in results)
+    assert llm_manager.get_inflight_stats()['inflight_requests'] == 0
+
+async def _wait_until(condition, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.001)
+
+@pytest.mark.asyncio
+async def test_coalesced_waiters_reissue_when_the_leader_is_cancelled(llm_manager, mock_claude_manager):
+    calls = []
+
+    async def response(prompt, model=None):
+        calls.append(prompt)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return "Test response"
+
+    mock_claude_manager.generate_response.side_effect = response
+    mock_claude_manager.count_tokens.return_value = 10
+    leader = asyncio.create_task(llm_manager.query("Test query", tier='fast'))
+    await _wait_until(lambda: calls)
+    follower = asyncio.create_task(llm_manager.query("Test query", tier='fast'))
+    await _wait_until(lambda: llm_manager.coalesced_requests)
+
+    leader.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+    result = await follower
+    assert result['response'] == "Test response"
+    assert len(calls) == 2 and llm_manager.coalesced_requests == 1
+
+@pytest.mark.asyncio
+async def test_coalesced_waiters_reissue_when_the_leader_deadline_expires(llm_manager, mock_claude_manager):
+    from src.exceptions import DeadlineExceededError
+    from src.request_scheduler import RequestScheduler
+    mock_claude_manager.generate_response.return_value = "Test response"
+    mock_claude_manager.count_tokens.return_value = 10
+    llm_manager.scheduler = RequestScheduler(max_concurrent=1)
+    held = await llm_manager.scheduler.acquire()
+    leader = asyncio.create_task(llm_manager.query("Test query", tier='fast', priority='background', deadline=0.5))
+    await _wait_until(lambda: llm_manager.get_inflight_stats()['inflight_requests'])
+    follower = asyncio.create_task(llm_manager.query("Test query", tier='fast', priority='background'))
+    await _wait_until(lambda: llm_manager.coalesced_requests)
+
+    with pytest.raises(DeadlineExceededError):
+        await leader
+    await asyncio.sleep(0.01)
+    assert not follower.done()
+    llm_manager.scheduler.release(held)
+    assert (await follower)['response'] == "Test response"
+    assert llm_manager.coalesced_requests == 1
+
+@pytest.mark.asyncio
+async def test_queries_of_different_priority_classes_are_not_coalesced(llm_manager, mock_claude_manager):
+    async def response(prompt, model=None, priority=0):
+        await asyncio.sleep(0.01)
+        return "Test response"
+
+    mock_claude_manager.generate_response.side_effect = response
+    mock_claude_manager.count_tokens.return_value = 10
+    await asyncio.gather(llm_manager.query("Test query", tier='fast', priority='background'),
+                         llm_manager.query("Test query", tier='fast'))
+    assert mock_claude_manager.generate_response.call_count == 2 and llm_manager.coalesced_requests == 0
+
+@pytest.mark.asyncio
+async def test_query_usage_is_recorded_in_ledger(llm_manager, mock_claude_manager):
+    mock_claude_manager.generate_response.return_value = "<response>Test response</response>"
+    mock_claude_manager.count_tokens.return_value = 10
+    await llm_manager.query("Ledger query", tier='fast')
+    await llm_manager.query("Ledger query", tier='fast')
+
+    totals = llm_manager.usage_ledger.totals('model')
+    model = llm_manager.tiers['fast']['model']
+    assert totals[model].requests == 2
+    assert totals[model].cache_hits == 1
+    assert totals[model].total_tokens == 20
+
+    report = await llm_manager.get_usage_report(resolution='1m')
+    assert report['usage_stats']['fast']['count'] == 1
+    assert report['usage_stats']['fast']['cache_hits'] == 1
+    assert report['timeline'][0]['model'] == model
+    assert report['timeline'][0]['requests'] == 2
+
+@pytest.mark.asyncio
+async def test_query_stream_yields_sections_as_they_complete(llm_manager, mock_claude_manager):
+    mock_claude_manager.count_tokens.return_value = 10
+    finish = asyncio.Event()
+
+    async def stream_response(prompt, model=None):
+        yield "<state_updates>{'phase': 'design'}</state_updates>\n<resp"
+        yield "onse>First part"
+        yield " of the answer</response>"
+        await finish.wait()
+        yield "<actions>review, test</actions>"
+
+    mock_claude_manager.stream_response = stream_response
+    events = []
+    async for section in llm_manager.query_stream("Stream query", tier='fast'):
+        events.append((section.name, section.value))
+        if section.name == 'response':
+            finish.set()
+
+    assert events[0] == ('state_updates', {'phase': 'design'})
+    assert events[1] == ('response', 'First part of the answer')
+    assert events[2] == ('actions', ['review', 'test'])
+    name, result = events[-1]
+    assert name == 'result'
+    assert result['response'] == 'First part of the answer'
+    assert result['state_updates'] == {'phase': 'design'}
+    assert result['actions'] == ['review', 'test']
+    assert result['token_usage'] == {"input": 10, "output": 10, "total": 20}
+    assert llm_manager.usage_ledger.totals('tier')['fast'].requests == 1
+
+@pytest.mark.asyncio
+async def test_query_stream_replays_cached_response(llm_manager, mock_claude_manager):
+    mock_claude_manager.generate_response.return_value = "<response>\nCached answer\n</response>"
+    mock_claude_manager.count_tokens.return_value = 10
+    expected = await llm_manager.query("Cached query", tier='fast')
+
+    events = [section async for section in llm_manager.query_stream("Cached query", tier='fast')]
+
+    assert [section.name for section in events] == ['task_progress', 'state_updates', 'actions', 'suggestions', 'response', 'result']
+    assert events[-1].value['response'] == expected['response'] == "Cached answer"
+    assert llm_manager.usage_ledger.totals('tier')['fast'].cache_hits == 1
+
+@pytest.mark.asyncio
+async def test_query_stream_falls_back_to_query_when_stream_fails(llm_manager, mock_claude_manager):
+    mock_claude_manager.generate_response.return_value = "<response>\nNon-streamed answer\n</response>"
+    mock_claude_manager.count_tokens.return_value = 10
+
+    async def stream_response(prompt, model=None):
+        raise ConnectionError("stream dropped")
+        yield
+
+    mock_claude_manager.stream_response = stream_response
+    events = [section async for section in llm_manager.query_stream("Failing stream", tier='fast')]
+
+    assert events[-1].name == 'result'
+    assert events[-1].value['response'] == "Non-streamed answer"
+    assert ('response', "Non-streamed answer") in [(section.name, section.value) for section in events]
+    assert mock_claude_manager.generate_response.call_count == 1
+
+class StreamingClient:
+    """Client stub whose messages.create streams the response word by word, like the Messages API."""
+
+    def __init__(self, text):
+        self.text = text
+        self.messages = self
+
+    async def create(self, model, max_tokens, messages, stream=False):
+        async def events():
+            yield {'type': 'message_start', 'message': {'model': model}}
+            for word in self.text.split(' '):
+                yield {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': word + ' '}}
+            yield {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}}
+        return events()
+
+@pytest.mark.asyncio
+async def test_claude_manager_stream_response():
+    manager = ClaudeManager(client=StreamingClient("<response>Streamed text</response>"))
+
+    chunks = [chunk async for chunk in manager.stream_response("Stream me", model="claude-3-haiku-20240307")]
+
+    assert chunks == ["<response>Streamed ", "text</response> "]
+    assert await manager.token_tracker.get_token_usage("stream_response") > 0
+
+@pytest.mark.asyncio
+async def test_parse_structured_response_inline_tags(llm_manager):
+    parsed = await llm_manager._parse_structured_response(
+        "Here you go: <task_progress>0.4</task_progress><actions>plan, build</actions>\n"
+        "<response>\nAnswer with <em>markup</em>\n</response>"
+    )
+    assert parsed == {
+        "task_progress": 0.4,
+        "state_updates": {},
+        "actions": ["plan", "build"],
+        "suggestions": [],
+        "response": "Answer with <em>markup</em>"
+    }
+
+@pytest.mark.asyncio
+async def test_parse_sufficiency_evaluation_requires_closed_tags(llm_manager):
+    result = await llm_manager._parse_sufficiency_evaluation(
+        {'response': "<reasoning>All tasks done</reasoning><evaluation>SUFFICIENT</evaluation><evaluation>INSUFFICIENT"}
+    )
+    assert result == {'is_sufficient': True, 'reasoning': "All tasks done"}
+    result = await llm_manager._parse_sufficiency_evaluation({'response': "<evaluation>SUFFICIENT"})
+    assert result['is_sufficient'] is False
+
+@pytest.mark.asyncio
+async def test_query_batch_dedupes_and_preserves_order(llm_manager, mock_claude_manager):
+    mock_claude_manager.count_tokens.return_value = 10
+
+    async def generate_response(prompt, model=None, priority=0):
+        return f"<response>answer {prompt}</response>"
+
+    mock_claude_manager.generate_response.side_effect = generate_response
+    await llm_manager.query("cached", tier='fast')
+
+    results = await llm_manager.query_batch(["one", ("two", None, 'powerful'), ("cached", None, 'fast'), "one", ("three",)])
+
+    assert [result['response'] for result in results] == ["answer one", "answer two", "answer cached", "answer one", "answer three"]
+    assert mock_claude_manager.generate_response.call_count == 4
+    assert llm_manager.usage_ledger.totals('tier')['fast'].cache_hits == 1
+
+@pytest.mark.asyncio
+async def test_query_batch_sends_each_model_in_bounded_waves(llm_manager, mock_claude_manager):
+    mock_claude_manager.count_tokens.return_value = 10
+    in_flight = {}
+    max_in_flight = {}
+
+    async def generate_response(prompt, model=None, priority=0):
+        in_flight[model] = in_flight.get(model, 0) + 1
+        max_in_flight[model] = max(max_in_flight.get(model, 0), in_flight[model])
+        await asyncio.sleep(0.01)
+        in_flight[model] -= 1
+        return f"<response>{prompt}</response>"
+
+    mock_claude_manager.generate_response.side_effect = generate_response
+    requests = [(f"fast {i}", None, 'fast') for i in range(7)] + [(f"powerful {i}", None, 'powerful') for i in range(5)]
+    results = await llm_manager.query_batch(requests, wave_size=3)
+
+    assert [result['response'] for result in results] == [prompt for prompt, _, _ in requests]
+    assert max_in_flight == {llm_manager.tiers['fast']['model']: 3, llm_manager.tiers['powerful']['model']: 3}
+
+@pytest.mark.asyncio
+async def test_query_batch_reports_errors_per_item(llm_manager, mock_claude_manager):
+    mock_claude_manager.count_tokens.return_value = 10
+
+    async def generate_response(prompt, model=None, priority=0):
+        if prompt == "bad":
+            raise RuntimeError("model overloaded")
+        return f"<response>{prompt}</response>"
+
+    mock_claude_manager.generate_response.side_effect = generate_response
+    results = await llm_manager.query_batch([("good", None, 'fast'), ("bad", None, 'fast')])
+
+    assert results[0]['response'] == "good" and 'error' not in results[0]
+    assert 'error' in results[1]
+
+@pytest.mark.asyncio
+async def test_query_batch_bulk_submission_polls_for_results(llm_manager, mock_claude_manager):
+    submitted = {}
+
+    async def submit_batch(requests):
+        submitted['requests'] = requests
+        return {'id': 'batch_1', 'processing_status': 'in_progress'}
+
+    async def batch_results(batch_id):
+        for request in submitted['requests']:
+            content = request['params']['messages'][0]['content']
+            if content == "bad":
+                yield {'custom_id': request['custom_id'], 'result': {'type': 'errored', 'error': {'type': 'overloaded_error'}}}
+            else:
+                yield {'custom_id': request['custom_id'], 'result': {'type': 'succeeded', 'message': {
+                    'content': [{'type': 'text', 'text': f"<response>bulk {content}</response>"}],
+                    'usage': {'input_tokens': 7, 'output_tokens': 3}}}}
+
+    mock_claude_manager.submit_batch.side_effect = submit_batch
+    mock_claude_manager.retrieve_batch.side_effect = [{'id': 'batch_1', 'processing_status': 'in_progress'},
+                                                      {'id': 'batch_1', 'processing_status': 'ended'}]
+    mock_claude_manager.batch_results = batch_results
+
+    results = await llm_manager.query_batch([("a", None, 'fast'), ("bad", None, 'fast'), ("a", None, 'fast')],
+                                            bulk=True, poll_interval=0)
+
+    assert len(submitted['requests']) == 2
+    assert mock_claude_manager.retrieve_batch.call_count == 2
+    assert results[0]['response'] == "bulk a" and results[2] is results[0]
+    assert results[0]['token_usage'] == {"input": 7, "output": 3, "total": 10}
+    assert "errored" in results[1]['error']
+    mock_claude_manager.generate_response.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_query_batch_bulk_falls_back_to_waves(llm_manager, mock_claude_manager):
+    mock_claude_manager.count_tokens.return_value = 10
+    mock_claude_manager.generate_response.return_value = "<response>wave answer</response>"
+    mock_claude_manager.submit_batch.side_effect = NotImplementedError("no batch support")
+
+    results = await llm_manager.query_batch(["x", "y"], bulk=True)
+
+    assert [result['response'] for result in results] == ["wave answer", "wave answer"]
+    assert mock_claude_manager.generate_response.call_count == 2
+
+@pytest.mark.asyncio
+async def test_query_with_context_reads_stable_prefix_from_prompt_cache():
+    from src.mock_claude_client import MockClaudeClient
+    claude_manager = ClaudeManager(client=MockClaudeClient())
+    manager = LLMManager(claude_manager=claude_manager)
+    context = {'workflow_stage': 'Design', 'coding_conventions': 'Follow PEP 8'}
+
+    await manager.query("What next?", context=context, tier='fast')
+    written = claude_manager.prompt_cache_usage['cache_creation_input_tokens']
+    assert written > 0 and claude_manager.prompt_cache_usage['cache_read_input_tokens'] == 0
+
+    await manager.query("And after that?", context=context, tier='fast')
+    assert claude_manager.prompt_cache_usage['cache_read_input_tokens'] == written
+    assert claude_manager.prompt_cache_usage['cache_creation_input_tokens'] == written
+    assert manager.prefix_tracker.get_stats()['read_tokens'] == written
+
+class StructuredReplyClient:
+    async def select_model(self, task):
+        return 'claude-3-haiku-20240307'
+
+    async def generate_response(self, prompt, model):
+        return ("<task_progress>0.5</task_progress>\n<state_updates>{'design': 'done'}</state_updates>\n"
+                "<actions>write tests</actions>\n<response>Main</response>")
+
+@pytest.mark.asyncio
+async def test_query_parses_structured_sections_of_claude_manager_replies():
+    manager = LLMManager(claude_manager=ClaudeManager(client=StructuredReplyClient()))
+    result = await manager.query("Test query", tier='fast')
+    assert result['task_progress'] == 0.5
+    assert result['state_updates'] == {'design': 'done'}
+    assert result['actions'] == ['write tests']
+    assert result['response'] == 'Main'
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import threading
+import time
+from collections import Counter
+import pytest
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.llm_microservice_client import AsyncLLMMicroserviceClient, LLMMicroserviceClient
+
+BENCHMARK_REQUESTS = 200
+# Simulated service time per request in the benchmarks, so concurrency has something to overlap.
+BENCHMARK_LATENCY = 0.005
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers the microservice endpoints over HTTP/1.1 keep-alive, recording each client connection."""
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY each kept-alive
+    # response would wait on the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests[self.path] += 1
+        time.sleep(self.server.latency)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.endswith('_batch') and self.server.batch_enabled:
+            return self._reply_stream([self._answer(self.path[:-len('_batch')], json.loads(line))
+                                       for line in body.decode().splitlines()])
+        if self.path in ('/query', '/evaluate_sufficiency'):
+            status, result = self._answer(self.path, json.loads(body))
+            return self._reply(status, result)
+        self._reply(404, {'error': 'not found'})
+
+    def _answer(self, path, payload):
+        result = {'id': payload['id']} if 'id' in payload else {}
+        if path == '/query':
+            if payload['prompt'].startswith('sleep'):
+                time.sleep(0.5)
+            if payload['prompt'] == 'fail':
+                return 500, {**result, 'error': 'internal'}
+            if payload['prompt'] == 'skip' and 'id' in payload:
+                return 200, None
+            return 200, {**result, 'response': f"echo: {payload['prompt']}"}
+        return 200, {**result, 'is_sufficient': False, 'reasoning': f"{payload['stage_name']} is incomplete"}
+
+    def _reply_stream(self, answers):
+        # One NDJSON line per answered payload, each sent as its own chunk.
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for _, result in answers:
+            if result is not None:
+                line = (json.dumps(result) + '\n').encode()
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.connections = set()
+    server.latency = 0.0
+    server.requests = Counter()
+    server.batch_enabled = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def base_url(stub_server):
+    stub_server.connections.clear()
+    stub_server.requests.clear()
+    stub_server.batch_enabled = True
+    return f"http://127.0.0.1:{stub_server.server_address[1]}"
+
+@pytest.fixture
+def benchmark_url(stub_server, base_url):
+    stub_server.latency = BENCHMARK_LATENCY
+    yield base_url
+    stub_server.latency = 0.0
+
+@pytest.mark.asyncio
+async def test_async_query_reuses_pooled_connections(stub_server, base_url):
+    async with AsyncLLMMicroserviceClient(base_url, max_connections=4) as client:
+        responses = await asyncio.gather(*(client.query(f"prompt {i}") for i in range(40)))
+    assert responses == [f"echo: prompt {i}" for i in range(40)]
+    assert len(stub_server.connections) <= 4
+
+@pytest.mark.asyncio
+async def test_async_evaluate_sufficiency(base_url):
+    async with AsyncLLMMicroserviceClient(base_url) as client:
+        result = await client.evaluate_sufficiency("Design", {}, {})
+    assert result == {'is_sufficient': False, 'reasoning': "Design is incomplete"}
+
+@pytest.mark.asyncio
+async def test_async_query_falls_back_on_error_and_timeout(base_url):
+    async with AsyncLLMMicroserviceClient(base_url) as client:
+        failed = await client.query("fail")
+        timed_out = await client.query("sleep please", timeout=0.1)
+    assert failed.startswith("LLM microservice is currently unavailable")
+    assert timed_out.startswith("LLM microservice is currently unavailable")
+
+def test_sync_facade_keeps_connection_alive(stub_server, base_url):
+    with LLMMicroserviceClient(base_url) as client:
+        assert [client.query(f"prompt {i}") for i in range(10)] == [f"echo: prompt {i}" for i in range(10)]
+        assert client.evaluate_sufficiency("Build", {}, {})['reasoning'] == "Build is incomplete"
+    assert len(stub_server.connections) == 1
+
+def test_sync_facade_falls_back_when_service_is_down():
+    client = LLMMicroserviceClient("http://127.0.0.1:9", timeout=1.0)
+    assert "model gpt-3.5-turbo and max_tokens 500" in client.query("hello")
+    assert client.evaluate_sufficiency("Design", {}, {})['is_sufficient'] is True
+    client.close()
+
+@pytest.mark.asyncio
+async def test_query_many_batches_and_falls_back_per_item(stub_server, base_url):
+    queries = ["a", "fail", {"prompt": "b", "model": "other"}, "skip", "c"]
+    async with AsyncLLMMicroserviceClient(base_url) as client:
+        responses = await client.query_many(queries, batch_size=3)
+
+    assert responses[0] == "echo: a" and responses[2] == "echo: b" and responses[4] == "echo: c"
+    assert responses[1].startswith("LLM microservice is currently unavailable")
+    assert responses[3] == "echo: skip"
+    assert stub_server.requests == {'/query_batch': 2, '/query': 2}
+
+@pytest.mark.asyncio
+async def test_evaluate_sufficiency_many_without_batch_endpoint(stub_server, base_url):
+    stub_server.batch_enabled = False
+    evaluations = [(f"Stage {i}", {}, {}) for i in range(6)]
+    async with AsyncLLMMicroserviceClient(base_url, max_connections=3) as client:
+        results = await client.evaluate_sufficiency_many(evaluations, batch_size=4)
+
+    assert [result['reasoning'] for result in results] == [f"Stage {i} is incomplete" for i in range(6)]
+    assert stub_server.requests == {'/evaluate_sufficiency_batch': 2, '/evaluate_sufficiency': 6}
+    assert len(stub_server.connections) <= 3
+
+def test_sync_many_uses_one_round_trip_per_batch(stub_server, base_url):
+    with LLMMicroserviceClient(base_url) as client:
+        results = client.evaluate_sufficiency_many([(f"Stage {i}", {}, {}) for i in range(10)])
+        responses = client.query_many(["x", "fail"])
+    assert [result['reasoning'] for result in results] == [f"Stage {i} is incomplete" for i in range(10)]
+    assert responses[0] == "echo: x" and responses[1].startswith("LLM microservice is currently unavailable")
+    assert stub_server.requests == {'/evaluate_sufficiency_batch': 1, '/query_batch': 1, '/query': 1}
+    assert len(stub_server.connections) == 1
+
+def _requests_per_call(base_url):
+    # The previous client: a blocking requests.post per call, each on a new connection.
+    for i in range(BENCHMARK_REQUESTS):
+        response = requests.post(f"{base_url}/query", json={'prompt': f"prompt {i}", 'context': {}}, timeout=10)
+        response.raise_for_status()
+        response.json()["response"]
+
+def _pooled_sync(base_url):
+    with LLMMicroserviceClient(base_url) as client:
+        for i in range(BENCHMARK_REQUESTS):
+            client.query(f"prompt {i}")
+
+def _pooled_async(base_url):
+    async def run():
+        async with AsyncLLMMicroserviceClient(base_url, max_connections=10) as client:
+            await asyncio.gather(*(client.query(f"prompt {i}") for i in range(BENCHMARK_REQUESTS)))
+    asyncio.run(run())
+
+def _record_throughput(benchmark):
+    if benchmark.stats is not None:
+        benchmark.extra_info['requests_per_second'] = BENCHMARK_REQUESTS / benchmark.stats.stats.mean
+
+@pytest.mark.benchmark(group="microservice_client_200_requests")
+def test_microservice_benchmark_requests_per_call(benchmark, benchmark_url):
+    benchmark.pedantic(_requests_per_call, args=(benchmark_url,), rounds=3, iterations=1)
+    _record_throughput(benchmark)
+
+@pytest.mark.benchmark(group="microservice_client_200_requests")
+def test_microservice_benchmark_pooled_sync(benchmark, benchmark_url):
+    benchmark.pedantic(_pooled_sync, args=(benchmark_url,), rounds=3, iterations=1)
+    _record_throughput(benchmark)
+
+@pytest.mark.benchmark(group="microservice_client_200_requests")
+def test_microservice_benchmark_pooled_async(benchmark, benchmark_url):
+    benchmark.pedantic(_pooled_async, args=(benchmark_url,), rounds=3, iterations=1)
+    _record_throughput(benchmark)
+
+SWEEP_STAGES = [(f"Stage {i}", {'tasks': ['a', 'b']}, {'progress': i}) for i in range(50)]
+
+def _sweep_individually(base_url):
+    with LLMMicroserviceClient(base_url) as client:
+        return [client.evaluate_sufficiency(*stage) for stage in SWEEP_STAGES]
+
+def _sweep_pipelined(base_url):
+    async def run():
+        async with AsyncLLMMicroserviceClient(base_url, max_connections=10) as client:
+            return await asyncio.gather(*(client.evaluate_sufficiency(*stage) for stage in SWEEP_STAGES))
+    return asyncio.run(run())
+
+def _sweep_batched(base_url):
+    async def run():
+        async with AsyncLLMMicroserviceClient(base_url) as client:
+            return await client.evaluate_sufficiency_many(SWEEP_STAGES)
+    return asyncio.run(run())
+
+@pytest.mark.benchmark(group="microservice_sufficiency_sweep_50")
+def test_sufficiency_sweep_benchmark_individual(benchmark, benchmark_url):
+    results = benchmark.pedantic(_sweep_individually, args=(benchmark_url,), rounds=3, iterations=1)
+    assert len(results) == len(SWEEP_STAGES)
+
+@pytest.mark.benchmark(group="microservice_sufficiency_sweep_50")
+def test_sufficiency_sweep_benchmark_pipelined(benchmark, benchmark_url):
+    results = benchmark.pedantic(_sweep_pipelined, args=(benchmark_url,), rounds=3, iterations=1)
+    assert len(results) == len(SWEEP_STAGES)
+
+@pytest.mark.benchmark(group="microservice_sufficiency_sweep_50")
+def test_sufficiency_sweep_benchmark_batched(benchmark, benchmark_url, stub_server):
+    results = benchmark.pedantic(_sweep_batched, args=(benchmark_url,), rounds=3, iterations=1)
+    assert [result['reasoning'] for result in results] == [f"{stage[0]} is incomplete" for stage in SWEEP_STAGES]
+    assert set(stub_server.requests) == {'/evaluate_sufficiency_batch'}
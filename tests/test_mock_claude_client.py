@@ -59,3 +59,29 @@ async def test_cache_with_different_parameters():
     
     assert response1 != response2
     assert client.call_count == 2  # Two API calls should be made for different messages
+
+@pytest.mark.asyncio
+async def test_prompt_cache_write_then_read_pricing():
+    client = MockClaudeClient()
+    stable = {"type": "text", "text": "Project conventions and response format. " * 40, "cache_control": {"type": "ephemeral"}}
+    design = [stable, {"type": "text", "text": "Stage: Design", "cache_control": {"type": "ephemeral"}}]
+    build = [stable, {"type": "text", "text": "Stage: Build", "cache_control": {"type": "ephemeral"}}]
+    messages = [{"role": "user", "content": "What next?"}]
+
+    first = (await client.messages.create("claude-3-haiku-20240307", 100, messages, system=design))['usage']
+    second = (await client.messages.create("claude-3-haiku-20240307", 100, messages, system=design))['usage']
+    third = (await client.messages.create("claude-3-haiku-20240307", 100, messages, system=build))['usage']
+
+    assert first['cache_read_input_tokens'] == 0 and first['cache_creation_input_tokens'] > 0
+    assert second['cache_read_input_tokens'] == first['cache_creation_input_tokens']
+    assert second['cache_creation_input_tokens'] == 0
+    assert 0 < third['cache_creation_input_tokens'] < third['cache_read_input_tokens']
+    assert first['input_tokens'] == second['input_tokens'] == third['input_tokens']
+
+    prefix = first['cache_creation_input_tokens']
+    assert client.calculate_cost("claude-3-haiku-20240307", {**first, 'output_tokens': 0}) == pytest.approx(
+        (first['input_tokens'] + prefix * 1.25) * 0.25 / 1_000_000)
+    assert client.calculate_cost("claude-3-haiku-20240307", {**second, 'output_tokens': 0}) == pytest.approx(
+        (second['input_tokens'] + prefix * 0.1) * 0.25 / 1_000_000)
+    with pytest.raises(ValueError):
+        client.calculate_cost("gpt-4", first)
@@ -0,0 +1,77 @@
+import pytest
+import time
+from unittest.mock import patch
+from src.persistent_cache import PersistentCache
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "cache" / "responses.sqlite3")
+
+@pytest.fixture
+def persistent_cache(cache_path):
+    cache = PersistentCache(path=cache_path, default_ttl=3600)
+    yield cache
+    cache.close()
+
+def test_set_and_get(persistent_cache):
+    persistent_cache.set("prompt|context|balanced", {"response": "Test response", "tier": "balanced"})
+    assert persistent_cache.get("prompt|context|balanced") == {"response": "Test response", "tier": "balanced"}
+    assert persistent_cache.get("other|context|balanced") is None
+
+def test_keys_are_hashed(persistent_cache):
+    key = "x" * 10000
+    persistent_cache.set(key, {"response": "value"})
+    stored = persistent_cache.connection.execute("SELECT key FROM responses").fetchone()[0]
+    assert stored == PersistentCache.hash_key(key)
+    assert len(stored) == 64
+
+def test_entries_expire(persistent_cache):
+    persistent_cache.set("key", {"response": "value"}, ttl=1)
+    with patch('src.persistent_cache.time.time', return_value=time.time() + 2):
+        assert persistent_cache.get("key") is None
+    assert persistent_cache.size() == 0
+
+def test_shared_between_instances(cache_path):
+    writer = PersistentCache(path=cache_path)
+    reader = PersistentCache(path=cache_path)
+    writer.set("key", {"response": "value"})
+    assert reader.get("key") == {"response": "value"}
+    writer.close()
+    reader.close()
+
+def test_prune_enforces_max_entries(cache_path):
+    cache = PersistentCache(path=cache_path, max_entries=3, prune_interval=1000)
+    for i in range(5):
+        cache.set(f"key{i}", {"response": i})
+        time.sleep(0.01)
+    cache.get("key0")
+    cache.prune()
+    assert cache.size() == 3
+    assert cache.get("key0") == {"response": 0}
+    assert cache.get("key1") is None
+    cache.close()
+
+def test_reads_batch_their_access_times_into_the_next_write(persistent_cache):
+    persistent_cache.set("key", {"response": "value"})
+    written = persistent_cache.connection.total_changes
+    last_access = "SELECT last_access FROM responses WHERE key = ?"
+    stored = persistent_cache.connection.execute(last_access, (PersistentCache.hash_key("key"),)).fetchone()[0]
+
+    with patch('src.persistent_cache.time.time', return_value=time.time() + 60):
+        assert persistent_cache.get("key") == {"response": "value"}
+    assert persistent_cache.connection.total_changes == written
+    persistent_cache.set("other", {"response": "value"})
+    assert persistent_cache.connection.execute(last_access, (PersistentCache.hash_key("key"),)).fetchone()[0] > stored + 59
+
+def test_prune_enforces_max_bytes(cache_path):
+    cache = PersistentCache(path=cache_path, max_bytes=1000, prune_interval=1)
+    for i in range(10):
+        cache.set(f"key{i}", {"response": "x" * 200})
+    total = cache.connection.execute("SELECT SUM(size) FROM responses").fetchone()[0]
+    assert total <= 1000
+    cache.close()
+
+def test_clear(persistent_cache):
+    persistent_cache.set("key", {"response": "value"})
+    persistent_cache.clear()
+    assert persistent_cache.size() == 0
@@ -0,0 +1,97 @@
+import asyncio
+import time
+import pytest
+from unittest.mock import MagicMock
+from src.project_state_reporter import ProjectStateReporter
+
+class SlowLLMManager:
+    """LLM manager stub answering every query after `delay` seconds, or failing selected prompts."""
+
+    def __init__(self, delay=0.2, slow_prompts=(), failing_prompts=()):
+        self.delay = delay
+        self.slow_prompts = slow_prompts
+        self.failing_prompts = failing_prompts
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.priorities = set()
+
+    async def query(self, prompt, context=None, priority=None, deadline=None):
+        self.priorities.add(priority)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if any(prompt.startswith(slow) for slow in self.slow_prompts):
+                await asyncio.sleep(10)
+            await asyncio.sleep(self.delay)
+            if any(prompt.startswith(failing) for failing in self.failing_prompts):
+                raise RuntimeError("LLM unavailable")
+            return {'response': f"answer to: {prompt.split('.')[0]}"}
+        finally:
+            self.in_flight -= 1
+
+@pytest.fixture
+def workflow_director():
+    director = MagicMock()
+    director.stages = {"Project Initialization": {}, "Requirements Gathering": {}}
+    director.current_stage = "Project Initialization"
+    director.completed_stages = set()
+    director.get_current_stage.return_value = {"name": "Project Initialization", "tasks": ["Create project directory"]}
+    director.get_stage_progress.return_value = 0.5
+    director.state_manager.get_all.return_value = {"project_name": "Demo"}
+    director.state_manager.get.side_effect = lambda key, default=None: default
+    return director
+
+@pytest.fixture
+def reporter(workflow_director):
+    reporter = ProjectStateReporter(workflow_director, section_timeout=1.0)
+    reporter.doc_health_checker = MagicMock()
+    reporter.doc_health_checker.assess_documentation_health.return_value = "Healthy"
+    return reporter
+
+@pytest.mark.asyncio
+async def test_llm_sections_are_generated_concurrently(reporter, workflow_director):
+    workflow_director.llm_manager = SlowLLMManager(delay=0.2)
+    start = time.monotonic()
+    report = await reporter.generate_report('markdown')
+    elapsed = time.monotonic() - start
+
+    assert workflow_director.llm_manager.max_in_flight == 5
+    assert workflow_director.llm_manager.priorities == {'background'}
+    assert elapsed < 0.6
+    titles = [line[3:] for line in report.splitlines() if line.startswith('## ')]
+    assert titles == ["Project Summary", "Current Stage", "Completed Stages", "Requirements Summary",
+                      "Domain Model Overview", "Documentation Health", "Quantitative Metrics", "Next Steps",
+                      "Risk Assessment", "Workflow Visualization"]
+    assert "answer to: Generate a brief summary of the project based on the provided context" in report
+
+@pytest.mark.asyncio
+async def test_local_sections_overlap_llm_queries(reporter, workflow_director):
+    workflow_director.llm_manager = SlowLLMManager(delay=0.5)
+    in_flight_during_local_work = []
+
+    def slow_health_check(state_manager):
+        time.sleep(0.1)
+        in_flight_during_local_work.append(workflow_director.llm_manager.in_flight)
+        return "Healthy"
+
+    reporter.doc_health_checker.assess_documentation_health.side_effect = slow_health_check
+    await reporter.generate_report('plain')
+
+    assert in_flight_during_local_work == [5]
+
+@pytest.mark.asyncio
+async def test_slow_or_failing_sections_fall_back(reporter, workflow_director):
+    workflow_director.llm_manager = SlowLLMManager(delay=0.01, slow_prompts=("Based on the current project state, identify",),
+                                                  failing_prompts=("Summarize the project requirements",))
+    report = await reporter.generate_report('plain')
+
+    assert "Risk Assessment:\n---------------\nUnavailable: no response from the LLM within 1 seconds." in report
+    assert "Requirements Summary:\n--------------------\nUnavailable: LLM unavailable" in report
+    assert "answer to: Based on the current project state, suggest the next 3-5 steps" in report
+
+@pytest.mark.asyncio
+async def test_unsupported_format_raises_before_querying(reporter, workflow_director):
+    workflow_director.llm_manager = SlowLLMManager()
+    with pytest.raises(ValueError, match="Unsupported format: pdf"):
+        await reporter.generate_report('pdf')
+    assert workflow_director.llm_manager.max_in_flight == 0
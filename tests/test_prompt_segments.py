@@ -0,0 +1,118 @@
+import pytest
+from unittest.mock import MagicMock
+from src.claude_manager import ClaudeManager
+from src.llm_manager import LLMManager
+from src.prompt_segments import PromptPrefixTracker, PromptSegmentCache
+from src.tokenizer import BPETokenizer, TokenCounter
+
+@pytest.fixture
+def counter():
+    return TokenCounter(BPETokenizer())
+
+@pytest.fixture
+def segment_cache(counter):
+    return PromptSegmentCache(counter)
+
+def test_unchanged_segments_are_not_recounted(segment_cache, counter):
+    conventions = "Use snake_case for functions and PascalCase for classes."
+    for turn in range(3):
+        prompt = segment_cache.prompt()
+        prompt.add('conventions', conventions)
+        prompt.add('command', f"Command number {turn}")
+    assert segment_cache.get_stats() == {'segments': 2, 'hits': 2, 'misses': 4}
+    assert counter.get_stats()['misses'] == 4
+
+def test_token_count_sums_segments(segment_cache, counter):
+    prompt = segment_cache.prompt().add('a', "First block of text.\n").add('b', "Second block.")
+    assert prompt.token_count == counter.count("First block of text.\n") + counter.count("Second block.")
+    assert [segment.name for segment in prompt] == ['a', 'b']
+
+def test_render_records_count_for_joined_text(segment_cache, counter):
+    prompt = segment_cache.prompt().add('a', "Alpha beta gamma.\n").add('b', "Delta epsilon.")
+    text = prompt.render()
+    assert text == "Alpha beta gamma.\nDelta epsilon."
+    misses = counter.get_stats()['misses']
+    assert counter.count(text) == prompt.token_count
+    assert counter.get_stats()['misses'] == misses
+
+def test_segment_cache_is_bounded(counter):
+    cache = PromptSegmentCache(counter, max_entries=2)
+    for index in range(5):
+        cache.segment(f"history:{index}", f"entry {index}")
+    assert cache.get_stats()['segments'] == 2
+
+def _three_part_prompt(segment_cache, stage, question):
+    prompt = segment_cache.prompt().add('conventions', "Follow PEP 8.\n").cache_breakpoint()
+    prompt.add('stage', f"Stage: {stage}\n").cache_breakpoint()
+    return prompt.add('question', question)
+
+def test_system_blocks_split_at_breakpoints(segment_cache):
+    prompt = _three_part_prompt(segment_cache, 'Design', "What next?")
+    assert prompt.system_blocks() == [
+        {'type': 'text', 'text': "Follow PEP 8.\n", 'cache_control': {'type': 'ephemeral'}},
+        {'type': 'text', 'text': "Stage: Design\n", 'cache_control': {'type': 'ephemeral'}}
+    ]
+    assert prompt.render_suffix() == "What next?"
+    assert prompt.render() == "Follow PEP 8.\nStage: Design\nWhat next?"
+    assert prompt.prefix_tokens()[-1] == prompt.token_count - segment_cache.segment('question', "What next?").tokens
+
+def test_prefix_hashes_are_cumulative(segment_cache):
+    design = _three_part_prompt(segment_cache, 'Design', "First question")
+    again = _three_part_prompt(segment_cache, 'Design', "Second question")
+    build = _three_part_prompt(segment_cache, 'Build', "First question")
+    assert design.prefix_hashes() == again.prefix_hashes()
+    assert design.prefix_hashes()[0] == build.prefix_hashes()[0]
+    assert design.prefix_hashes()[1] != build.prefix_hashes()[1]
+
+def test_prefix_tracker_reads_longest_warm_prefix(segment_cache):
+    tracker = PromptPrefixTracker(ttl=300.0)
+    design = _three_part_prompt(segment_cache, 'Design', "q")
+    build = _three_part_prompt(segment_cache, 'Build', "q")
+    assert tracker.observe(design.prefix_hashes(), design.prefix_tokens(), now=0.0) == 0
+    assert tracker.observe(design.prefix_hashes(), design.prefix_tokens(), now=10.0) == design.prefix_tokens()[-1]
+    assert tracker.observe(build.prefix_hashes(), build.prefix_tokens(), now=20.0) == build.prefix_tokens()[0]
+    assert tracker.observe(design.prefix_hashes(), design.prefix_tokens(), now=1000.0) == 0
+    assert tracker.get_stats() == {'prefixes': 3, 'reads': 2, 'writes': 3,
+                                   'read_tokens': design.prefix_tokens()[-1] + build.prefix_tokens()[0],
+                                   'write_tokens': 2 * design.prefix_tokens()[-1] + build.prefix_tokens()[-1] - build.prefix_tokens()[0]}
+
+@pytest.fixture
+def llm_manager():
+    return LLMManager(claude_manager=MagicMock(spec=ClaudeManager))
+
+@pytest.mark.asyncio
+async def test_enhance_prompt_only_counts_changed_segments(llm_manager):
+    context = {
+        'workflow_stage': 'Design',
+        'stage_tasks': ['Draft the architecture'],
+        'project_structure_instructions': 'src/ holds the package, tests/ the test suite',
+        'coding_conventions': 'Follow PEP 8',
+        'workflow_config': {'stages': [{'name': 'Design'}], 'transitions': []}
+    }
+    await llm_manager._enhance_prompt("First question", context)
+    misses = llm_manager.prompt_segments.get_stats()['misses']
+    enhanced = await llm_manager._enhance_prompt("Second question", context)
+    assert llm_manager.prompt_segments.get_stats()['misses'] == misses + 1
+    assert "Second question" in enhanced
+    assert enhanced.index("Coding Conventions:") < enhanced.index("<task_progress>") < enhanced.index("Second question")
+
+@pytest.mark.asyncio
+async def test_generate_prompt_matches_str_format(llm_manager):
+    llm_manager.prompt_templates['custom'] = "Stage {stage}: {{literal}} {progress:.1%} {items!r}"
+    values = {'stage': 'Design', 'progress': 0.25, 'items': ['a']}
+    prompt = await llm_manager.generate_prompt('custom', values)
+    assert prompt == "Stage Design: {literal} 25.0% ['a']"
+
+@pytest.mark.asyncio
+async def test_prepare_prompt_sends_stable_blocks_as_cached_system_prefix(llm_manager):
+    context = {'workflow_stage': 'Design', 'coding_conventions': 'Follow PEP 8'}
+    system, prompt = await llm_manager._prepare_prompt("What next?", context)
+    assert [block['cache_control'] for block in system] == [{'type': 'ephemeral'}] * 2
+    assert "Follow PEP 8" in system[0]['text'] and "<task_progress>" in system[0]['text']
+    assert system[1]['text'].strip().startswith("Current Workflow Stage: Design")
+    assert "What next?" in prompt and "Follow PEP 8" not in prompt
+
+    await llm_manager._prepare_prompt("And then?", context)
+    stats = llm_manager.prefix_tracker.get_stats()
+    assert stats['reads'] == 1 and stats['writes'] == 1
+    assert stats['read_tokens'] == stats['write_tokens']
@@ -1,6 +1,9 @@
 import pytest
+import asyncio
 from unittest.mock import patch
-from src.rate_limiter import RateLimiter
+import multiprocessing
+from src.rate_limiter import RateLimiter, GCRALimit, SlidingWindowLimit, TokenBudgetLimiter, TokenWindow, SQLiteRateLimitBackend
+from src.exceptions import RateLimitError
 import time
 
 def test_rate_limiter_initialization():
@@ -39,3 +42,292 @@ def test_wait_for_next_slot():
         rate_limiter.wait_for_next_slot()
     
     assert rate_limiter.is_allowed()
+
+def _fast_limiter(limit, period):
+    rate_limiter = RateLimiter(requests_per_minute=limit, requests_per_hour=limit * 60)
+    rate_limiter.limits = [GCRALimit(limit, period)]
+    return rate_limiter
+
+def test_gcra_limit_computes_exact_delay():
+    limit = GCRALimit(limit=2, period=60)
+    now = 1000.0
+    assert limit.delay(1, now) == 0
+    limit.consume(1, now)
+    limit.consume(1, now)
+    assert limit.delay(1, now) == pytest.approx(30)
+    assert limit.delay(1, now + 30) == 0
+    assert limit.usage(now) == pytest.approx(2)
+
+@pytest.mark.asyncio
+async def test_is_allowed_enforces_minute_and_hour_limits():
+    rate_limiter = RateLimiter(requests_per_minute=2, requests_per_hour=3)
+    assert await rate_limiter.is_allowed()
+    assert await rate_limiter.is_allowed()
+    assert not await rate_limiter.is_allowed()
+    with patch('time.time', return_value=time.time() + 61):
+        assert await rate_limiter.is_allowed()
+        assert not await rate_limiter.is_allowed()  # Hour limit reached
+
+@pytest.mark.asyncio
+async def test_acquire_wakes_waiters_in_fifo_order():
+    rate_limiter = _fast_limiter(limit=1, period=0.05)
+    assert await rate_limiter.acquire() == 0.0
+    order = []
+
+    async def waiter(name):
+        await rate_limiter.acquire()
+        order.append(name)
+
+    await asyncio.gather(*(waiter(name) for name in ["first", "second", "third"]))
+    assert order == ["first", "second", "third"]
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_computed_time_not_polling_interval():
+    rate_limiter = _fast_limiter(limit=1, period=0.3)
+    await rate_limiter.acquire()
+    waited = await rate_limiter.acquire()
+    assert 0.25 <= waited < 0.4
+
+@pytest.mark.asyncio
+async def test_weighted_permits():
+    rate_limiter = _fast_limiter(limit=4, period=0.2)
+    await rate_limiter.acquire(weight=3)
+    assert not await rate_limiter.is_allowed(weight=2)
+    assert await rate_limiter.is_allowed(weight=1)
+    with pytest.raises(ValueError):
+        await rate_limiter.acquire(weight=5)
+
+@pytest.mark.asyncio
+async def test_acquire_timeout_releases_queue_position():
+    rate_limiter = _fast_limiter(limit=1, period=10)
+    await rate_limiter.acquire()
+    with pytest.raises(TimeoutError):
+        await rate_limiter.acquire(timeout=0.05)
+    assert not rate_limiter._waiters
+    assert rate_limiter._wakeup is None
+
+@pytest.mark.asyncio
+async def test_queued_waiters_block_is_allowed():
+    rate_limiter = _fast_limiter(limit=1, period=0.1)
+    await rate_limiter.acquire()
+    waiter = asyncio.create_task(rate_limiter.acquire())
+    await asyncio.sleep(0)
+    assert not await rate_limiter.is_allowed()
+    await waiter
+
+def test_sliding_window_prevents_boundary_bursts():
+    limit = SlidingWindowLimit(limit=2, period=60)
+    limit.consume(1, 59.0)
+    limit.consume(1, 59.5)
+    assert limit.delay(1, 61.0) == pytest.approx(58.0)
+    assert limit.delay(1, 119.0) == 0
+    assert limit.delay(2, 119.0) == pytest.approx(0.5)
+
+def test_sliding_window_memory_is_fixed():
+    limit = SlidingWindowLimit(limit=5, period=1)
+    for i in range(1000):
+        if limit.delay(1, i * 0.1) == 0:
+            limit.consume(1, i * 0.1)
+    assert len(limit._timestamps) == 5
+    assert limit.usage(100.0) <= 5
+
+@pytest.mark.asyncio
+async def test_sliding_window_is_default_and_exact():
+    rate_limiter = RateLimiter(requests_per_minute=2, requests_per_hour=100)
+    assert rate_limiter.algorithm == 'sliding_window'
+    start = time.time()
+    with patch('time.time', return_value=start):
+        assert await rate_limiter.is_allowed()
+        assert await rate_limiter.is_allowed()
+        assert not await rate_limiter.is_allowed()
+    with patch('time.time', return_value=start + 59):
+        assert not await rate_limiter.is_allowed()
+    with patch('time.time', return_value=start + 60):
+        assert await rate_limiter.is_allowed()
+
+@pytest.mark.asyncio
+async def test_get_usage_reports_time_to_next_permit():
+    rate_limiter = RateLimiter(requests_per_minute=1, requests_per_hour=100)
+    start = time.time()
+    with patch('time.time', return_value=start):
+        await rate_limiter.is_allowed()
+    with patch('time.time', return_value=start + 20):
+        usage = rate_limiter.get_usage()
+    assert usage['requests_this_minute'] == 1
+    assert usage['requests_this_hour'] == 1
+    assert usage['time_until_next_permit'] == pytest.approx(40)
+    assert usage['queued_waiters'] == 0
+
+def test_unknown_algorithm():
+    with pytest.raises(ValueError):
+        RateLimiter(requests_per_minute=1, requests_per_hour=1, algorithm='fixed_window')
+
+def test_token_window_delay_and_adjust():
+    window = TokenWindow(limit=1000, period=60)
+    entry = window.charge(600, 0.0)
+    window.charge(300, 10.0)
+    assert window.delay(100, 20.0) == 0
+    assert window.delay(200, 20.0) == pytest.approx(40)
+    window.adjust(entry, 200)
+    assert window.usage(20.0) == 500
+    assert window.delay(500, 20.0) == 0
+    assert window.usage(61.0) == 300
+    window.adjust(entry, 900)  # Expired entries no longer count against the window
+    assert window.usage(61.0) == 300
+
+def _token_budget():
+    return TokenBudgetLimiter.from_tiers({
+        'fast': {'model': 'haiku', 'max_tokens': 100, 'input_tokens_per_minute': 1000, 'output_tokens_per_minute': 200},
+        'balanced': {'model': 'sonnet', 'max_tokens': 4000}
+    })
+
+@pytest.mark.asyncio
+async def test_token_budget_reserves_max_tokens_and_settles_actual_usage():
+    budget = _token_budget()
+    reservation = await budget.reserve('haiku', 400)
+    usage = budget.get_usage('haiku')
+    assert usage['input_tokens_this_minute'] == 400
+    assert usage['output_tokens_this_minute'] == 100
+    budget.settle(reservation, 350, 20)
+    budget.settle(reservation, 0, 0)  # Settling twice is a no-op
+    usage = budget.get_usage('haiku')
+    assert usage['input_tokens_this_minute'] == 350
+    assert usage['output_tokens_this_minute'] == 20
+
+@pytest.mark.asyncio
+async def test_token_budget_rejects_oversized_requests():
+    budget = _token_budget()
+    with pytest.raises(RateLimitError):
+        await budget.reserve('haiku', 1001)
+    with pytest.raises(RateLimitError):
+        await budget.reserve('haiku', 10, output_tokens=201)
+
+@pytest.mark.asyncio
+async def test_token_budget_unlimited_models_pass_through():
+    budget = _token_budget()
+    reservation = await budget.reserve('sonnet', 10 ** 9)
+    assert reservation.output_tokens == 4000
+    budget.settle(reservation, 5, 5)
+    assert budget.get_usage('sonnet')['input_tokens_per_minute'] is None
+
+@pytest.mark.asyncio
+async def test_token_budget_delays_until_usage_leaves_window():
+    budget = TokenBudgetLimiter({'haiku': {'input_tokens_per_minute': 100}})
+    budget.input_windows['haiku'].period = 0.2
+    await budget.reserve('haiku', 80)
+    start = time.monotonic()
+    await budget.reserve('haiku', 50)
+    assert time.monotonic() - start >= 0.15
+
+@pytest.mark.asyncio
+async def test_token_budget_wait_times_out():
+    budget = TokenBudgetLimiter({'haiku': {'input_tokens_per_minute': 100}})
+    await budget.reserve('haiku', 100)
+    with pytest.raises(RateLimitError):
+        await budget.reserve('haiku', 1, timeout=0.05)
+
+def test_sliding_window_state_round_trip():
+    limit = SlidingWindowLimit(limit=3, period=10)
+    for now in (1.0, 2.0, 3.0, 12.0):
+        limit.delay(1, now)
+        limit.consume(1, now)
+    restored = SlidingWindowLimit(limit=3, period=10)
+    restored.set_state(limit.get_state())
+    assert restored.usage(12.5) == limit.usage(12.5) == 2
+    assert restored.delay(2, 12.5) == pytest.approx(limit.delay(2, 12.5))
+
+@pytest.mark.parametrize("algorithm", ["sliding_window", "gcra"])
+@pytest.mark.asyncio
+async def test_sqlite_backend_shares_quota_between_limiters(tmp_path, algorithm):
+    path = str(tmp_path / "limits.sqlite3")
+    first = RateLimiter(3, 100, algorithm, SQLiteRateLimitBackend(path))
+    second = RateLimiter(3, 100, algorithm, SQLiteRateLimitBackend(path))
+    assert await first.is_allowed()
+    assert await second.is_allowed()
+    assert await first.is_allowed()
+    assert not await second.is_allowed()
+    assert second.get_usage()['requests_this_minute'] == pytest.approx(3, abs=0.01)
+    assert second.time_until_allowed() > 0
+
+def _consume_shared_permits(path):
+    limiter = RateLimiter(10, 100, 'sliding_window', SQLiteRateLimitBackend(path))
+    return sum(asyncio.run(limiter.is_allowed()) for _ in range(10))
+
+def test_sqlite_backend_enforces_quota_across_processes(tmp_path):
+    path = str(tmp_path / "limits.sqlite3")
+    SQLiteRateLimitBackend(path).close()
+    with multiprocessing.Pool(4) as pool:
+        granted = pool.map(_consume_shared_permits, [path] * 4)
+    assert sum(granted) == 10
+
+def test_sqlite_backend_lock_timeout_raises_rate_limit_error(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "limits.sqlite3")
+    backend = SQLiteRateLimitBackend(path, timeout=0.05)
+    limits = [SlidingWindowLimit(3, 60)]
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(RateLimitError):
+        backend.try_consume(limits, 1, time.time())
+    other.execute("ROLLBACK")
+    assert backend.try_consume(limits, 1, time.time())
+
+@pytest.mark.asyncio
+async def test_sqlite_backend_waits_for_the_lock_off_the_event_loop(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "limits.sqlite3")
+    limiter = RateLimiter(3, 100, backend=SQLiteRateLimitBackend(path))
+    other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.create_task(tick())
+    asyncio.get_running_loop().call_later(0.2, other.execute, "ROLLBACK")
+    assert await limiter.is_allowed()
+    ticker.cancel()
+    assert ticks >= 5
+
+def test_rate_limiter_from_config(tmp_path):
+    limiter = RateLimiter.from_config({'requests_per_minute': 5, 'requests_per_hour': 50, 'algorithm': 'gcra'})
+    assert limiter.backend is None
+    assert isinstance(limiter.limits[0], GCRALimit)
+    shared = RateLimiter.from_config({'backend': 'sqlite', 'path': str(tmp_path / "limits.sqlite3"), 'name': 'workers'})
+    assert isinstance(shared.backend, SQLiteRateLimitBackend)
+    assert shared.backend.name == 'workers'
+    assert shared.backend.connection.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    with pytest.raises(ValueError):
+        RateLimiter.from_config({'backend': 'redis'})
+
+def test_shipped_config_leaves_token_budgets_disabled():
+    import yaml
+    with open('src/llm_config.yaml') as config_file:
+        tiers = yaml.safe_load(config_file)['tiers']
+    assert TokenBudgetLimiter.from_tiers(tiers).input_windows == {}
+    assert TokenBudgetLimiter.from_tiers(tiers).output_windows == {}
+
+@pytest.mark.asyncio
+async def test_claude_manager_reserves_the_max_tokens_it_sends():
+    from src.claude_manager import ClaudeManager
+    from src.mock_claude_client import MockClaudeClient
+    manager = ClaudeManager(client=MockClaudeClient(), tiers={
+        'fast': {'model': 'claude-3-haiku-20240307', 'max_tokens': 4000, 'output_tokens_per_minute': 500}
+    })
+    reserve = manager.token_budget.reserve
+    reserved = []
+
+    async def recording_reserve(model, input_tokens, output_tokens=None, timeout=60):
+        reservation = await reserve(model, input_tokens, output_tokens, timeout)
+        reserved.append(reservation.output_tokens)
+        return reservation
+
+    manager.token_budget.reserve = recording_reserve
+    response = await manager.generate_response("Hello", 'claude-3-haiku-20240307',
+                                               system=[{'type': 'text', 'text': "Be brief."}], max_tokens=100)
+    assert "Fallback" not in response
+    assert reserved == [100]
@@ -0,0 +1,213 @@
+import asyncio
+import pytest
+from src.claude_manager import ClaudeManager
+from src.concurrency_limiter import ConcurrencyLimiters
+from src.exceptions import DeadlineExceededError
+from src.llm_manager import LLMManager
+from src.request_scheduler import PriorityClass, RequestScheduler
+
+def _scheduler(max_concurrent=1, background_max_wait=60.0, interactive_weight=3):
+    return RequestScheduler({
+        'interactive': PriorityClass('interactive', interactive_weight, 60.0),
+        'background': PriorityClass('background', 1, background_max_wait)
+    }, max_concurrent=max_concurrent)
+
+async def _run_queued(scheduler, requests):
+    """Hold the only slot while `requests` ((name, priority_class, deadline) tuples) queue up,
+    then let them through one at a time, returning the names in dispatch order."""
+    held = await scheduler.acquire('background')
+    order = []
+
+    async def run(name, priority_class, deadline):
+        async with scheduler.slot(priority_class, deadline):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(run(*request)))
+        await asyncio.sleep(0)
+    scheduler.release(held)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return order
+
+class RecordingClaudeManager:
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.prompts = []
+        self.priorities = []
+
+    async def generate_response(self, prompt, model=None, priority=0):
+        self.prompts.append(prompt)
+        self.priorities.append(priority)
+        await asyncio.sleep(self.delay)
+        return f"<response>{prompt[-20:]}</response>"
+
+    async def count_tokens(self, text):
+        return max(1, len(text.split()))
+
+@pytest.mark.asyncio
+async def test_weighted_fair_queuing_shares_slots_by_weight():
+    scheduler = _scheduler(interactive_weight=4)
+    requests = [(f"b{i}", 'background', None) for i in range(8)] + [(f"i{i}", 'interactive', None) for i in range(8)]
+    order = await _run_queued(scheduler, requests)
+
+    # 4:1 by weight, with the slot held during queueing counted against background.
+    assert [name[0] for name in order[:10]] == ['i'] * 7 + ['b', 'i', 'b']
+    assert [name for name in order if name.startswith('i')] == [f"i{i}" for i in range(8)]
+    assert [name for name in order if name.startswith('b')] == [f"b{i}" for i in range(8)]
+
+@pytest.mark.asyncio
+async def test_idle_classes_leave_their_share_to_others():
+    scheduler = _scheduler(max_concurrent=4)
+    requests = [scheduler.acquire('background') for _ in range(4)]
+    granted = await asyncio.gather(*requests)
+    assert scheduler.in_flight == 4
+    for request in granted:
+        scheduler.release(request)
+    assert scheduler.get_stats()['classes']['background']['dispatched'] == 4
+
+@pytest.mark.asyncio
+async def test_starved_requests_are_promoted():
+    scheduler = _scheduler(background_max_wait=0.05, interactive_weight=100)
+    held = await scheduler.acquire('interactive')
+    background = asyncio.create_task(scheduler.acquire('background'))
+    await asyncio.sleep(0.06)
+    interactive = [asyncio.create_task(scheduler.acquire('interactive')) for _ in range(3)]
+    await asyncio.sleep(0)
+    scheduler.release(held)
+    await asyncio.sleep(0)
+
+    assert background.done() and not any(task.done() for task in interactive)
+    assert scheduler.get_stats()['classes']['background']['promoted'] == 1
+    scheduler.release(background.result())
+    for task in interactive:
+        scheduler.release(await task)
+
+@pytest.mark.asyncio
+async def test_requests_near_their_deadline_go_first():
+    scheduler = _scheduler()
+    order = await _run_queued(scheduler, [('early', 'interactive', None), ('urgent', 'background', 0.5),
+                                          ('relaxed', 'background', 30.0)])
+    assert order == ['urgent', 'early', 'relaxed']
+    assert scheduler.get_stats()['classes']['background']['deadline_dispatches'] == 1
+
+@pytest.mark.asyncio
+async def test_expired_requests_are_dropped_without_holding_a_slot():
+    scheduler = _scheduler()
+    held = await scheduler.acquire()
+    with pytest.raises(DeadlineExceededError):
+        await scheduler.acquire('background', deadline=0.01)
+    waiting = asyncio.create_task(scheduler.acquire('background'))
+    await asyncio.sleep(0)
+    assert scheduler.get_stats()['classes']['background']['queue_depth'] == 1
+    scheduler.release(held)
+
+    request = await asyncio.wait_for(waiting, 1)
+    stats = scheduler.get_stats()
+    assert stats['in_flight'] == 1 and stats['classes']['background']['expired'] == 1
+    assert stats['classes']['background']['max_wait'] > 0
+    scheduler.release(request)
+
+def test_scheduler_from_config_rejects_unknown_classes():
+    scheduler = RequestScheduler.from_config({'max_concurrent': 2, 'default_class': 'batch',
+                                              'classes': {'batch': {'weight': 2, 'max_wait': 10}}})
+    assert scheduler.max_concurrent == 2 and scheduler.classes['batch'].weight == 2
+    with pytest.raises(ValueError):
+        RequestScheduler.from_config({'default_class': 'interactive', 'classes': {'batch': {}}})
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.acquire('interactive'))
+
+@pytest.mark.asyncio
+async def test_llm_manager_serves_interactive_queries_ahead_of_batches():
+    claude_manager = RecordingClaudeManager()
+    manager = LLMManager(claude_manager=claude_manager)
+    manager.scheduler = RequestScheduler(max_concurrent=1)
+    batch = asyncio.create_task(manager.query_batch([(f"Background section {i}", None, 'fast') for i in range(6)]))
+    await asyncio.sleep(0.01)
+    result = await manager.query("Interactive command", tier='fast')
+
+    assert "Interactive command" in result['response']
+    position = next(index for index, prompt in enumerate(claude_manager.prompts) if "Interactive command" in prompt)
+    assert position <= 2
+    await batch
+    stats = manager.scheduler.get_stats()['classes']
+    assert stats['background']['dispatched'] == 6 and stats['interactive']['dispatched'] == 1
+
+@pytest.mark.asyncio
+async def test_llm_manager_query_past_deadline_raises():
+    manager = LLMManager(claude_manager=RecordingClaudeManager(delay=0.5))
+    manager.scheduler = RequestScheduler(max_concurrent=1)
+    running = asyncio.create_task(manager.query("Long running query", tier='fast'))
+    await asyncio.sleep(0.01)
+    with pytest.raises(DeadlineExceededError):
+        await manager.query("Report section", tier='fast', priority='background', deadline=0.05)
+    await running
+
+@pytest.mark.asyncio
+async def test_llm_manager_passes_class_rank_as_limiter_priority():
+    claude_manager = RecordingClaudeManager(delay=0)
+    manager = LLMManager(claude_manager=claude_manager)
+    assert [manager.scheduler.rank(name) for name in ('interactive', 'sufficiency', 'background')] == [0, 1, 2]
+    await manager.query("Interactive command", tier='fast')
+    await manager.query("Report section", tier='fast', priority='background')
+    await manager.query("Stage check", tier='fast', priority='sufficiency')
+    assert claude_manager.priorities == [0, 2, 1]
+
+class CountingClient:
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def generate_response(self, prompt, model):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.02)
+        self.in_flight -= 1
+        return f"<response>answer to {prompt[:20]}</response>"
+
+class GatedRateLimiter:
+    """Rate limiter holding every request until `gate` is set."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.waiting = 0
+
+    async def acquire(self):
+        self.waiting += 1
+        await self.gate.wait()
+        return 0.0
+
+def _llm_manager(monkeypatch, client, **concurrency):
+    monkeypatch.setattr(ClaudeManager, 'create_client', staticmethod(lambda: client))
+    manager = LLMManager()
+    if concurrency:
+        manager.claude_manager.concurrency = ConcurrencyLimiters(**concurrency)
+    return manager
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("limit", [3, 12])
+async def test_scheduler_slots_follow_the_adaptive_concurrency_limit(monkeypatch, limit):
+    client = CountingClient()
+    manager = _llm_manager(monkeypatch, client, algorithm='aimd', initial_limit=limit, max_limit=limit)
+    assert manager.claude_manager.scheduler is manager.scheduler
+    await asyncio.gather(*(manager.query(f"Report section {index}", tier='fast', priority='background')
+                           for index in range(30)))
+
+    assert manager.scheduler.max_concurrent == limit
+    assert client.max_in_flight == limit
+    assert manager.scheduler.get_stats()['classes']['background']['dispatched'] == 30
+
+@pytest.mark.asyncio
+async def test_requests_waiting_on_the_rate_limiter_hold_no_slot(monkeypatch):
+    manager = _llm_manager(monkeypatch, CountingClient())
+    manager.scheduler.max_concurrent = 1
+    rate_limiter = manager.claude_manager.rate_limiter = GatedRateLimiter()
+    queries = [asyncio.create_task(manager.query(f"Report section {index}", tier='fast')) for index in range(3)]
+    while rate_limiter.waiting < 3:
+        await asyncio.sleep(0.01)
+
+    assert manager.scheduler.in_flight == 0
+    rate_limiter.gate.set()
+    results = await asyncio.gather(*queries)
+    assert all(result['response'].startswith("answer to") for result in results)
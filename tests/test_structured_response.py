@@ -0,0 +1,115 @@
+import re
+import pytest
+from src.structured_response import ResponseSection, SectionParser, parse_sections, parse_structured_response, stream_sections
+
+RESPONSE = (
+    "Sure. <task_progress>0.5</task_progress>\n"
+    "<state_updates>\n{'phase': 'design'}\n</state_updates>\n"
+    "<actions>review, test</actions><response>\nUse <b>bold</b> text here.\n</response>"
+)
+
+def _feed_in_chunks(text, size):
+    parser = SectionParser()
+    sections = []
+    for start in range(0, len(text), size):
+        sections.extend(parser.feed(text[start:start + size]))
+    return sections + parser.close()
+
+def test_parse_sections_inline_tags():
+    assert [(section.name, section.value) for section in parse_sections(RESPONSE)] == [
+        ('task_progress', '0.5'),
+        ('state_updates', "\n{'phase': 'design'}\n"),
+        ('actions', 'review, test'),
+        ('response', '\nUse <b>bold</b> text here.\n')
+    ]
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16])
+def test_tags_split_across_chunks(size):
+    assert _feed_in_chunks(RESPONSE, size) == parse_sections(RESPONSE)
+
+def test_feed_returns_sections_as_closing_tags_arrive():
+    parser = SectionParser()
+    assert parser.feed("<response>Hello") == []
+    assert parser.feed(" world</resp") == []
+    assert parser.feed("onse><actions>a") == [ResponseSection('response', 'Hello world')]
+    assert parser.feed("</actions>") == [ResponseSection('actions', 'a')]
+
+def test_unclosed_section_runs_to_end_on_close():
+    parser = SectionParser()
+    assert parser.feed("<response>Partial answer </res") == []
+    assert parser.close() == [ResponseSection('response', 'Partial answer </res')]
+
+def test_names_restrict_recognized_tags():
+    text = "<note>ignored</note><evaluation>SUFFICIENT</evaluation><reasoning>Enough <note>data</note></reasoning>"
+    sections = parse_sections(text, ('evaluation', 'reasoning'))
+    assert sections == [ResponseSection('evaluation', 'SUFFICIENT'), ResponseSection('reasoning', 'Enough <note>data</note>')]
+
+def test_text_outside_sections_is_not_retained():
+    parser = SectionParser()
+    for _ in range(1000):
+        parser.feed("free text with a < sign and <partial")
+    assert len(parser._carry) <= len("<partial")
+    assert parser.feed(" done <response>x</response>") == [ResponseSection('response', 'x')]
+
+@pytest.mark.asyncio
+async def test_stream_sections():
+    async def chunks():
+        for start in range(0, len(RESPONSE), 5):
+            yield RESPONSE[start:start + 5]
+
+    assert [section async for section in stream_sections(chunks())] == parse_sections(RESPONSE)
+
+def _large_response(size=100 * 1024):
+    body = "The quick brown fox jumps over the lazy dog; if x < y, swap them.\n" * (size // 64)
+    return (f"<task_progress>0.9</task_progress><state_updates>{{'a': 1}}</state_updates>"
+            f"<actions>{', '.join(f'action{i}' for i in range(200))}</actions><response>{body}</response>")
+
+def _stream_incremental(text, chunk_size=64):
+    return _feed_in_chunks(text, chunk_size)
+
+def _stream_rescanning(text, chunk_size=64):
+    # The buffer-and-rescan approach: append every chunk and search the whole pending text again.
+    pattern = re.compile(r'<(\w+)>(.*?)</\1>', re.DOTALL)
+    sections, pending = [], ''
+    for start in range(0, len(text), chunk_size):
+        pending += text[start:start + chunk_size]
+        consumed = 0
+        for match in pattern.finditer(pending):
+            sections.append(ResponseSection(match.group(1), match.group(2)))
+            consumed = match.end()
+        pending = pending[consumed:]
+    return sections
+
+def test_large_response_sections():
+    text = _large_response()
+    assert [section.name for section in _stream_incremental(text)] == ['task_progress', 'state_updates', 'actions', 'response']
+    assert _stream_incremental(text)[-1] == parse_sections(text)[-1]
+
+@pytest.mark.benchmark(group="structured_response_100kb_stream")
+def test_section_parser_benchmark_incremental(benchmark):
+    text = _large_response()
+    sections = benchmark.pedantic(_stream_incremental, args=(text,), rounds=5, iterations=1)
+    assert len(sections) == 4
+
+@pytest.mark.slow
+@pytest.mark.benchmark(group="structured_response_100kb_stream")
+def test_section_parser_benchmark_rescanning(benchmark):
+    text = _large_response()
+    sections = benchmark.pedantic(_stream_rescanning, args=(text,), rounds=3, iterations=1)
+    assert sections == _stream_incremental(text)
+
+@pytest.mark.benchmark(group="structured_response_100kb_whole")
+def test_section_parser_benchmark_whole_response(benchmark):
+    text = _large_response()
+    sections = benchmark.pedantic(parse_sections, args=(text,), rounds=5, iterations=1)
+    assert sections[-1].name == 'response'
+
+def test_parse_structured_response_unwraps_a_wrapped_reply():
+    wrapped = f"<response>{RESPONSE}</response>"
+    assert [(section.name, section.value.strip()) for section in parse_structured_response(wrapped)] == [
+        ('task_progress', '0.5'), ('state_updates', "{'phase': 'design'}"), ('actions', 'review, test'),
+        ('response', 'Use <b>bold</b> text here.')
+    ]
+    assert [section.value for section in parse_structured_response("<response>Plain <b>text</b></response>")] == [
+        "Plain <b>text</b>"
+    ]
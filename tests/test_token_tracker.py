@@ -1,5 +1,8 @@
+import asyncio
+import logging
+import threading
 import pytest
-from src.token_tracker import TokenTracker, TokenOptimizer
+from src.token_tracker import TokenTracker, TokenOptimizer, TokenUsageRecord
 
 def test_token_tracker_initialization():
     tracker = TokenTracker()
@@ -81,3 +84,110 @@ def test_token_optimizer_generate_report(token_optimizer):
     assert "Task task3: 450 tokens" in report
     assert "Task task2: 300 tokens" in report
     assert "Task task1: 150 tokens" in report
+
+@pytest.mark.asyncio
+async def test_add_tokens_records_structured_usage(token_tracker):
+    await token_tracker.add_tokens("task1", 100, 50, label="fast: Summarize")
+    await token_tracker.add_tokens("task1", 10, 5)
+    await token_tracker.add_tokens("task2", 1, 1)
+    assert token_tracker.get_record("task1") == TokenUsageRecord("task1", 110, 55, 2)
+    assert token_tracker.get_record("task1").total_tokens == 165
+    assert await token_tracker.get_token_usage("task1") == 165
+    assert await token_tracker.get_total_token_usage() == 167
+    assert token_tracker.token_usage == {"task1": 165, "task2": 2}
+    assert token_tracker.get_label("task1") == "fast: Summarize"
+    assert token_tracker.get_label("task2") == "task2"
+    await token_tracker.reset()
+    assert await token_tracker.get_total_tokens() == 0
+    assert token_tracker.get_records() == {}
+
+@pytest.mark.asyncio
+async def test_concurrent_add_tokens_are_not_lost(token_tracker):
+    await asyncio.gather(*(token_tracker.add_tokens(f"task{i % 10}", 2, 1) for i in range(1000)))
+    assert await token_tracker.get_total_token_usage() == 3000
+    assert all(record.calls == 100 for record in token_tracker.get_records().values())
+
+def test_threaded_record_merges_shards(token_tracker):
+    def worker():
+        for _ in range(1000):
+            token_tracker.record("shared", 1, 1)
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert token_tracker.get_record("shared") == TokenUsageRecord("shared", 8000, 8000, 8000)
+    assert len(token_tracker._shards) == 8
+
+@pytest.mark.asyncio
+async def test_reset_retires_shards_held_by_writers(token_tracker):
+    record_again = threading.Event()
+    recorded = threading.Event()
+
+    def worker():
+        token_tracker.record("shared", 5, 5)
+        recorded.set()
+        record_again.wait()
+        token_tracker.record("shared", 1, 1)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    recorded.wait()
+    await token_tracker.reset()
+    assert token_tracker.get_records() == {}
+    record_again.set()
+    thread.join()
+    assert token_tracker.get_record("shared") == TokenUsageRecord("shared", 1, 1, 1)
+    assert len(token_tracker._shards) == 1
+
+def test_labels_are_capped_oldest_first():
+    tracker = TokenTracker(max_labels=3)
+    for i in range(5):
+        tracker.record(f"task{i}", 1, 1, label=f"label {i}")
+    tracker.record("task2", 1, 1, label="label 2")
+    assert list(tracker.labels) == ["task2", "task3", "task4"]
+    assert tracker.get_label("task0") == "task0" and tracker.get_label("task4") == "label 4"
+    assert len(tracker.get_records()) == 5
+
+def test_add_tokens_logs_constant_size_records(token_tracker, caplog):
+    with caplog.at_level(logging.DEBUG, logger="src.token_tracker"):
+        for i in range(50):
+            token_tracker.record(f"task{i}", 1, 1)
+    assert len(caplog.records) == 50
+    assert caplog.records[-1].key == "task49"
+    assert all("task0" not in record.getMessage() for record in caplog.records[1:])
+
+class _LockedTokenTracker:
+    """The previous tracker design: an asyncio.Lock around every write, a dump of the whole
+    usage dict on every call and a locked re-read to "verify" the write."""
+
+    def __init__(self):
+        self.logger = logging.getLogger("benchmark.locked_token_tracker")
+        self.token_usage = {}
+        self.total_tokens = 0
+        self.lock = asyncio.Lock()
+
+    async def add_tokens(self, key, input_tokens, output_tokens):
+        async with self.lock:
+            self.token_usage[key] = self.token_usage.get(key, 0) + input_tokens + output_tokens
+            self.total_tokens += input_tokens + output_tokens
+            self.logger.info(f"Added {input_tokens + output_tokens} tokens for task {key}. Total tokens: {self.total_tokens}")
+        self.logger.debug(f"Current token usage: {self.token_usage}")
+        self.logger.debug(f"Total tokens: {self.total_tokens}")
+        async with self.lock:
+            usage = self.token_usage.get(key, 0)
+            self.logger.debug(f"Token usage for task {key}: {usage}")
+        self.logger.debug(f"Verified token usage for task {key}: {usage}")
+
+def _run_concurrent_adds(tracker, count=10000):
+    async def run():
+        await asyncio.gather(*(tracker.add_tokens(f"task{i % 100}", 10, 5) for i in range(count)))
+    asyncio.run(run())
+
+@pytest.mark.benchmark(group="token_tracker_concurrent_adds")
+def test_token_tracker_benchmark_sharded(benchmark):
+    benchmark.pedantic(_run_concurrent_adds, setup=lambda: ((TokenTracker(),), {}), rounds=5, iterations=1)
+
+@pytest.mark.benchmark(group="token_tracker_concurrent_adds")
+def test_token_tracker_benchmark_locked(benchmark):
+    benchmark.pedantic(_run_concurrent_adds, setup=lambda: ((_LockedTokenTracker(),), {}), rounds=5, iterations=1)
@@ -0,0 +1,69 @@
+import pytest
+from src.claude_manager import ClaudeManager
+from src.tokenizer import BPETokenizer, TokenCounter, get_token_counter, train_bpe
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return BPETokenizer()
+
+def test_bundled_merges_load(tokenizer):
+    assert len(tokenizer.ranks) > 1000
+
+@pytest.mark.parametrize("text", [
+    "This is a test sentence.",
+    "def count_tokens(self, text: str) -> int:\n    return 42\n",
+    "Ünïcödé text — with emoji 🚀 and   irregular\t\twhitespace",
+])
+def test_encode_round_trips(tokenizer, text):
+    tokens = tokenizer.encode(text)
+    assert tokenizer.decode(tokens) == text
+    assert tokenizer.count(text) == len(tokens)
+
+def test_common_words_are_single_tokens(tokenizer):
+    assert tokenizer.count("This is a test") == 4
+    assert tokenizer.count("") == 0
+    # Subword merges make long inputs cheaper than one token per character.
+    text = "The workflow director evaluates the project state before each stage."
+    assert tokenizer.count(text) < len(text) / 2
+
+def test_truncate_respects_budget(tokenizer):
+    text = "one two three four five six seven eight nine ten"
+    truncated = tokenizer.truncate(text, 5)
+    assert text.startswith(truncated)
+    assert tokenizer.count(truncated) <= 5
+    assert tokenizer.truncate(text, 1000) == text
+
+def test_train_bpe_learns_frequent_pairs():
+    merges = train_bpe(["low lower lowest"] * 10 + ["newer wider"] * 3, num_merges=10)
+    assert merges[0] in {('l', 'o'), ('o', 'w'), ('Ġ', 'l')}
+    tokenizer = BPETokenizer(merges=merges)
+    assert tokenizer.count("low low") < len("low low")
+    assert train_bpe(["low lower lowest"] * 10, num_merges=10) == train_bpe(["low lower lowest"] * 10, num_merges=10)
+
+def test_counter_memoizes_by_content(tokenizer):
+    counter = TokenCounter(tokenizer, max_entries=2)
+    assert counter.count("alpha beta") == counter.count("alpha beta")
+    assert counter.get_stats() == {'entries': 1, 'hits': 1, 'misses': 1}
+    counter.count("gamma")
+    counter.count("delta")
+    assert counter.get_stats()['entries'] == 2
+    counter.count("alpha beta")
+    assert counter.get_stats()['misses'] == 4
+
+def test_count_many_counts_each_distinct_text_once(tokenizer):
+    counter = TokenCounter(tokenizer)
+    counts = counter.count_many(["alpha", "beta gamma", "alpha", ""])
+    assert counts == [tokenizer.count("alpha"), tokenizer.count("beta gamma"), tokenizer.count("alpha"), 0]
+    assert counter.get_stats()['misses'] == 2
+
+class EchoClient:
+    async def generate_response(self, prompt, model):
+        return f"<response>Echo of {prompt}</response>"
+
+@pytest.mark.asyncio
+async def test_generate_response_tokenizes_each_text_once():
+    manager = ClaudeManager(client=EchoClient())
+    counter = get_token_counter()
+    counter.clear()
+    await manager.generate_response("Summarize the unique tokenizer test prompt", model="claude-3-haiku-20240307")
+    assert counter.get_stats()['misses'] == 2
@@ -0,0 +1,88 @@
+import pytest
+from src.cost_analyzer import CostAnalyzer
+from src.usage_ledger import UsageLedger, UsageRecord, UsageTotals
+
+DAY_START = 1_700_006_400.0  # Midnight UTC, so every rollup bucket starts here.
+
+@pytest.fixture
+def ledger():
+    ledger = UsageLedger()
+    ledger.record("haiku", "fast", 100, 20, latency=0.5, timestamp=DAY_START + 5)
+    ledger.record("haiku", "fast", 50, 10, latency=0.3, timestamp=DAY_START + 30)
+    ledger.record("opus", "powerful", 400, 200, latency=2.0, timestamp=DAY_START + 65)
+    ledger.record("haiku", "fast", latency=0.01, cache_hit=True, timestamp=DAY_START + 70)
+    ledger.record("opus", "powerful", latency=1.0, success=False, timestamp=DAY_START + 3700)
+    return ledger
+
+def test_minute_rollups_per_model(ledger):
+    rows = ledger.query('1m', since=DAY_START, until=DAY_START + 120)
+    assert [(row['bucket_start'] - DAY_START, row['model'], row['total_tokens']) for row in rows] == [
+        (0, "haiku", 180), (60, "opus", 600), (60, "haiku", 0)
+    ]
+    assert rows[0]['requests'] == 2
+    assert rows[0]['avg_latency'] == pytest.approx(0.4)
+    assert rows[2]['cache_hits'] == 1
+
+def test_query_filters_and_groups(ledger):
+    rows = ledger.query('1h', model="opus")
+    assert [(row['bucket_start'] - DAY_START, row['requests'], row['errors']) for row in rows] == [(0, 1, 0), (3600, 1, 1)]
+    daily = ledger.query('1d', group_by='tier')
+    assert {row['tier']: row['requests'] for row in daily} == {"fast": 3, "powerful": 2}
+    with pytest.raises(ValueError):
+        ledger.query('5m')
+
+def test_totals_all_time_and_windowed(ledger):
+    totals = ledger.totals('model')
+    assert totals["haiku"] == UsageTotals(3, 150, 30, pytest.approx(0.81), 1, 0)
+    assert totals["opus"].errors == 1
+    assert ledger.totals('tier', since=DAY_START + 3600, resolution='1h') == {"powerful": UsageTotals(1, 0, 0, 1.0, 0, 1)}
+    assert set(ledger.totals(('model', 'tier'))) == {("haiku", "fast"), ("opus", "powerful")}
+
+def test_old_buckets_expire():
+    ledger = UsageLedger(retention={'1m': 120})
+    for offset in (0, 60, 120):
+        ledger.record("haiku", "fast", 1, 1, timestamp=DAY_START + offset)
+    assert [row['bucket_start'] - DAY_START for row in ledger.query('1m')] == [60, 120]
+    ledger.record("haiku", "fast", 1, 1, timestamp=DAY_START + 300)
+    assert [row['bucket_start'] - DAY_START for row in ledger.query('1m')] == [300]
+    assert ledger.totals('model')["haiku"].requests == 4
+
+def test_spill_writes_columns_and_keeps_rollups(tmp_path):
+    ledger = UsageLedger(spill_dir=str(tmp_path), max_records=2)
+    for index in range(5):
+        ledger.record("sonnet", "balanced", 10, 5, latency=0.25, cache_hit=index == 4, timestamp=DAY_START + index)
+    assert ledger.spilled_records == 4
+    assert (tmp_path / "input_tokens.bin").stat().st_size == 4 * 8
+    records = list(ledger.records())
+    assert len(records) == 5
+    assert records[0] == UsageRecord(DAY_START, "sonnet", "balanced", 10, 5, 0.25, False, True)
+    assert records[-1].cache_hit
+    assert ledger.totals('model')["sonnet"].total_tokens == 75
+
+def test_reopened_ledger_reads_earlier_spills(tmp_path):
+    first = UsageLedger(spill_dir=str(tmp_path), max_records=2)
+    for index in range(3):
+        first.record("sonnet", "balanced", 10, 5, timestamp=DAY_START + index)
+
+    reopened = UsageLedger(spill_dir=str(tmp_path), max_records=2)
+    assert reopened.spilled_records == 2
+    for index in range(3):
+        reopened.record("haiku", "fast", 1, 1, timestamp=DAY_START + 10 + index)
+    assert reopened.spilled_records == 4
+    assert [(record.model, record.tier) for record in reopened.records()] == [
+        ("sonnet", "balanced")] * 2 + [("haiku", "fast")] * 3
+
+def test_discards_raw_records_without_spill_dir():
+    ledger = UsageLedger(max_records=3)
+    for index in range(7):
+        ledger.record("haiku", "fast", 1, 0, timestamp=DAY_START + index)
+    assert len(list(ledger.records())) == 1
+    assert ledger.totals('model')["haiku"].requests == 7
+
+def test_cost_report_reads_ledger_window(ledger):
+    analyzer = CostAnalyzer(ledger)
+    analyzer.model_costs.update({"haiku": 0.001, "opus": 0.01})
+    report = analyzer.generate_cost_report(since=DAY_START + 60, until=DAY_START + 120)
+    assert "Total Cost: $0.0060" in report
+    assert "- haiku:\n  Tokens: 0" in report
+    assert analyzer.get_model_usage("haiku") == {"tokens": 180, "cost": pytest.approx(0.00018)}
@@ -917,3 +917,23 @@ def test_workflow_director_initialization(mock_state_manager, mock_llm_manager,
     assert director.user_interaction_handler == mock_user_interaction_handler
     assert director._test_mode == True
     mock_logger.info.assert_called_with("Initializing WorkflowDirector", extra={'test_mode': True})
+
+@pytest.mark.asyncio
+async def test_stream_llm_response_applies_sections_while_streaming(mock_workflow_director):
+    from src.structured_response import ResponseSection
+    director = mock_workflow_director
+    state_updates_seen = []
+
+    class StreamingLLMManager:
+        async def query_stream(self, prompt, context=None, tier=None):
+            yield ResponseSection('state_updates', {'phase': 'design'})
+            state_updates_seen.append(director.state_manager.set.call_args_list[:])
+            yield ResponseSection('response', 'Partial answer')
+            yield ResponseSection('result', {'response': 'Partial answer', 'state_updates': {'phase': 'design'}})
+
+    director.llm_manager = StreamingLLMManager()
+    result = await director._stream_llm_response("prompt", {}, 'fast')
+
+    assert state_updates_seen == [[call('phase', 'design')]]
+    director.user_interaction_handler.display_message.assert_any_call("LLM Response: Partial answer")
+    assert result == {'response': 'Partial answer', 'state_updates': {'phase': 'design'}}